@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест web_ui: несколько «панелей» опрашивают /api/status, пока параллельно
+идут длинные импульсы реле. Печатает перцентили задержки статуса — при однопоточном сервере
+p99 был равен длительности импульса, с пулом обработчиков должен оставаться в миллисекундах.
+
+  python3 bench_web.py --url http://127.0.0.1:8000 --pollers 4 --seconds 10 --pulse-relay R08 --pulse-ms 2000
+
+Реле для импульсов выбирай безопасное (R08 — запас, не цилиндр); без --pulse-relay меряется только опрос.
+"""
+import time
+import argparse
+import threading
+
+import requests
+
+from ser_broker import pct
+
+
+def poller(url: str, path: str, t_end: float, interval: float, out: list, errors: list):
+    s = requests.Session()
+    while time.time() < t_end:
+        t0 = time.perf_counter()
+        try:
+            s.get(url + path, timeout=10).raise_for_status()
+            out.append((time.perf_counter() - t0) * 1000.0)
+        except Exception as e:
+            errors.append(str(e))
+        if interval > 0:
+            time.sleep(interval)
+
+
+def pulser(url: str, t_end: float, relay: str, ms: int, out: list, errors: list):
+    s = requests.Session()
+    while time.time() < t_end:
+        t0 = time.perf_counter()
+        try:
+            s.post(url + "/api/relay", json={"name": relay, "action": "pulse", "ms": ms}, timeout=30).raise_for_status()
+            out.append((time.perf_counter() - t0) * 1000.0)
+        except Exception as e:
+            errors.append(str(e))
+        time.sleep(ms / 1000.0)
+
+
+def report(title: str, lat: list):
+    lat.sort()
+    if not lat:
+        print(f"{title:<14} no samples")
+        return
+    print(f"{title:<14} n={len(lat):<6} p50={pct(lat, 50):8.2f}  p95={pct(lat, 95):8.2f}  "
+          f"p99={pct(lat, 99):8.2f}  max={lat[-1]:8.2f}  ms")
+
+
+def main():
+    p = argparse.ArgumentParser(description="web_ui load test: /api/status latency while relay pulses run")
+    p.add_argument("--url", default="http://127.0.0.1:8000")
+    p.add_argument("--pollers", type=int, default=4, help="Concurrent status pollers")
+    p.add_argument("--path", default="/api/status", help="Polled endpoint (/api/state — compact status)")
+    p.add_argument("--interval", type=float, default=0.05, help="Pause between polls per poller, s")
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--pulse-relay", default="", help="Relay to pulse during the test (empty = none)")
+    p.add_argument("--pulse-ms", type=int, default=2000)
+    args = p.parse_args()
+
+    t_end = time.time() + args.seconds
+    status_lat, pulse_lat, errors = [], [], []
+    threads = [threading.Thread(target=poller, args=(args.url, args.path, t_end, args.interval, status_lat, errors))
+               for _ in range(args.pollers)]
+    if args.pulse_relay:
+        threads.append(threading.Thread(target=pulser,
+                                        args=(args.url, t_end, args.pulse_relay, args.pulse_ms, pulse_lat, errors)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report("GET status", status_lat)
+    if args.pulse_relay:
+        report("POST pulse", pulse_lat)
+    if errors:
+        print(f"{len(errors)} errors, first: {errors[0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,9 @@
 TRIGGER_HOST = "127.0.0.1"
 TRIGGER_PORT = 8765
 
+import sys
 import time
+import json
 import threading
 from datetime import datetime
 import os
@@ -25,6 +27,28 @@ try:
     import socket
 except Exception:
     socket = None
+
+# Брокер serial-порта (ser_broker.py): если запущен — ходим через него, порт не открываем
+try:
+    from ser_broker import BrokerSerial, BROKER_SOCK, broker_available, PositionCache
+except Exception:
+    BrokerSerial = None
+    PositionCache = None
+
+# Арбитр GPIO (gpio_arbiter.py): если запущен — пины у него, цикл берёт аренду на запись
+try:
+    from gpio_arbiter import RemoteIO, GPIO_SOCK, arbiter_available
+except Exception:
+    RemoteIO = None
+
+# Запись обмена с прошивкой (SER_RECORD=/путь/файл.sdxy), просмотр/воспроизведение — ser_replay.py
+try:
+    from ser_record import SER_RECORD, SerialRecorder, RecordingSerial
+except Exception:
+    SER_RECORD = ""
+
+# Счётчики для /metrics web_ui (prometheus_client); цикл отдаёт их по каналу StartTrigger (METRICS)
+from prometheus_client import CollectorRegistry, Counter, Histogram
 # =====================[ КОНФИГ ]=====================
 RELAY_ACTIVE_LOW = True  # твоя 8-релейка, как правило, LOW-trigger
 BUSY_FLAG = "/tmp/screw_cycle_busy"
@@ -76,10 +100,36 @@ POINTS = [
 
 # Серийный порт
 SERIAL_PORT = "/dev/ttyACM0"
-SERIAL_BAUD = 115200
+SERIAL_BAUD = 115200              # стартовая скорость прошивки (после ресета всегда она)
+SERIAL_BAUD_FAST = 250000         # до какой скорости договариваемся (0 — не повышать)
+BAUD_CONFIRM_S = 2.0              # прошивка откатывается, если новая скорость не подтверждена PING
+LINK_ERR_MAX = 2                  # столько 'err NOISE' подряд — откат на SERIAL_BAUD
 SERIAL_TIMEOUT = 0.5
 SERIAL_WTIMEOUT = 0.5
 
+# Хоуминг: пропускаем G28, если прошивка говорит, что позиция валидна (HOMED:1)
+HOME_SKIP_IF_VALID = True
+HOME_SANITY_MM = 1.0              # дальше этого от нуля концевик обязан быть open
+HOME_WARN_S = 3.0                 # хоуминг оси дольше этого — предупреждение в лог
+
+# Модель времени перемещения (трапеция AccelStepper, параметры из M503)
+MOTION_STEP_RATE_MAX = 4000       # шаг/с на ось, быстрее Mega+AccelStepper не шагает (уточнить по логу [move])
+MOTION_OVERHEAD_S = 0.003         # разбор команды + ok по serial
+PRETRIGGER_LEAD_S = 0.0           # подача винта за столько секунд до прибытия в точку (0 — после ok, как раньше)
+POS_REPORT_HZ = 10                # автоотчёт позиции прошивки (M154) при прямом подключении; 0 — выкл
+
+_trg: Optional["StartTrigger"] = None   # канал управления (main), через него фазы уходят и подписчикам
+
+def report_phase(phase: str, detail: str = ""):
+    """
+    Фаза жизненного цикла для web_ui (читает stdout): initializing, homing, ready, busy, stopping, failed.
+    Отдельная строка с префиксом "@@PHASE", flush — чтобы web_ui узнал о ней сразу.
+    """
+    print(f"@@PHASE {phase} {detail}".rstrip(), flush=True)
+    if _trg is not None:
+        _trg.phase = phase
+        _trg.emit("PHASE", f"{phase} {detail}".rstrip())
+
 def set_cycle_busy(on: bool):
     try:
         if on:
@@ -98,6 +148,29 @@ def is_port_open(host="127.0.0.1", port=8765, timeout=0.2) -> bool:
             return True
     except Exception:
         return False
+# =====================[ МЕТРИКИ ]=====================
+# свой реестр: web_ui импортирует модуль «за компанию» и не должен выставлять эти счётчики нулями от себя
+CYCLE_REGISTRY = CollectorRegistry()
+CYCLES = Counter("screw_cycles_total", "Completed cycles (all points)", registry=CYCLE_REGISTRY)
+CYCLE_SECONDS = Histogram("screw_cycle_seconds", "Cycle duration from start to return",
+                          buckets=(4, 6, 8, 10, 12, 15, 20, 30, 60), registry=CYCLE_REGISTRY)
+SCREWS = Counter("screw_screws_total", "Screws driven, by result", ("result",),   # ok | torque_timeout | up_timeout
+                 registry=CYCLE_REGISTRY)
+FEED_RETRIES = Counter("screw_feed_retries_total", "Feeder pulses repeated in feed_until_detect",
+                       registry=CYCLE_REGISTRY)
+TORQUE_TIMEOUTS = Counter("screw_torque_timeouts_total", "DO2_OK not reached within TIMEOUT_SEC",
+                          registry=CYCLE_REGISTRY)
+SENSOR_WAIT = Histogram("screw_sensor_wait_seconds", "wait_sensor duration, by sensor and result",
+                        ("sensor", "result"), buckets=(0.02, 0.05, 0.1, 0.2, 0.35, 0.5, 0.75, 1, 1.5, 2.5, 5, 10),
+                        registry=CYCLE_REGISTRY)
+RELAY_ACTUATIONS = Counter("screw_relay_actuations_total", "Relay OFF->ON switches", ("relay",),
+                           registry=CYCLE_REGISTRY)
+
+def metrics_snapshot(registry) -> list:
+    """[[имя, help, тип, [[имя_сэмпла, {метки}, значение], ...]], ...] из реестра — годится для json."""
+    return [[m.name, m.documentation, m.type, [[s.name, s.labels, s.value] for s in m.samples]]
+            for m in registry.collect()]
+
 # =====================[ ВСПОМОГАТЕЛЬНОЕ ]=====================
 def ts():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
@@ -118,6 +191,9 @@ class IOController:
             GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
         self.relays = {name: False for name in RELAY_PINS.keys()}
+        # необязательный наблюдатель: on_change(kind, name, value), kind = "relay" | "sensor"
+        self.on_change = None
+        self.actuations = RELAY_ACTUATIONS   # Counter с меткой relay; web_ui подставляет свой
 
         # Попытка повесить edge; если не выйдет — polling fallback
         self._use_poll_fallback = False
@@ -160,8 +236,19 @@ class IOController:
     def _apply_relay(self, relay_name: str, on: bool):
         pin = RELAY_PINS[relay_name]
         GPIO.output(pin, relay_gpio_value(on))
+        if on and not self.relays[relay_name] and self.actuations is not None:
+            self.actuations.labels(relay_name).inc()
         self.relays[relay_name] = on
         print(f"[{ts()}] {relay_name} -> {'ON' if on else 'OFF'}")
+        self._notify("relay", relay_name, on)
+
+    def _notify(self, kind: str, name: str, value: bool):
+        cb = self.on_change
+        if cb is not None:
+            try:
+                cb(kind, name, value)
+            except Exception as e:
+                print(f"[{ts()}] WARN: on_change: {e}")
 
     def set_relay(self, relay_name: str, on: bool):
         if relay_name not in RELAY_PINS:
@@ -188,7 +275,9 @@ class IOController:
         # просто печать изменений; логика цикла опрашивает синхронно
         for n, p in SENSOR_PINS.items():
             if p == ch_pin:
-                print(f"[{ts()}] SENSOR {n}: {'CLOSE' if self.sensor_state(n) else 'OPEN'}")
+                closed = self.sensor_state(n)
+                print(f"[{ts()}] SENSOR {n}: {'CLOSE' if closed else 'OPEN'}")
+                self._notify("sensor", n, closed)
                 break
 
     def _poll_loop(self):
@@ -203,12 +292,40 @@ class IOController:
                         self._last_state[name] = closed_now
                         counters[name] = 0
                         print(f"[{ts()}] SENSOR {name}: {'CLOSE' if closed_now else 'OPEN'}")
+                        self._notify("sensor", name, closed_now)
                 else:
                     counters[name] = 0
             time.sleep(POLL_INTERVAL_MS / 1000.0)
 
+def open_io():
+    """IOController или, если запущен арбитр, RemoteIO с арендой (ждёт, пока веб-панель её отдаст)."""
+    if RemoteIO is not None and arbiter_available(GPIO_SOCK):
+        try:
+            rio = RemoteIO(GPIO_SOCK, name="cycle")
+            print(f"[{ts()}] GPIO через арбитр {GPIO_SOCK}")
+            rio.actuations = RELAY_ACTUATIONS
+            return rio
+        except OSError as e:
+            print(f"[{ts()}] WARN: арбитр {GPIO_SOCK} не отвечает ({e}) — GPIO напрямую")
+    return IOController()
+
 # =====================[ SERIAL / G-КОД ]=======================
 def open_serial():
+    ser = _open_serial_raw()
+    if SER_RECORD:
+        print(f"[{ts()}] Serial: запись обмена в {SER_RECORD}")
+        ser = RecordingSerial(ser, SerialRecorder(SER_RECORD))
+    return ser
+
+def _open_serial_raw():
+    if BrokerSerial is not None and broker_available(BROKER_SOCK):
+        try:
+            # подписка — ради кадров позиции '* @P ...' (их разбирает _xfer)
+            ser = BrokerSerial(BROKER_SOCK, timeout=SERIAL_TIMEOUT, name="cycle", subscribe=True)
+            print(f"[{ts()}] Serial через брокер {BROKER_SOCK}")
+            return ser
+        except OSError as e:
+            print(f"[{ts()}] WARN: брокер {BROKER_SOCK} не отвечает ({e}) — открываю порт напрямую")
     ser = serial.Serial(
         port=SERIAL_PORT,
         baudrate=SERIAL_BAUD,
@@ -225,35 +342,265 @@ def open_serial():
 def wait_ready(ser: serial.Serial, timeout: float = 5.0) -> bool:
     """
     Ждём строку 'ok READY' от прошивки Arduino.
+    Если плата не перезагрузилась при открытии порта (баннера не будет),
+    раз в секунду тишины шлём PING и принимаем PONG как готовность.
     Возвращает True при успехе, False при таймауте.
     """
     t_end = time.time() + timeout
+    # через брокер порт уже открыт и плата готова — пингуем сразу
+    t_ping = time.time() + (0.0 if getattr(ser, "is_broker", False) else 1.0)
     while time.time() < t_end:
         s = ser.readline().decode(errors="ignore").strip()
         if not s:
+            if time.time() >= t_ping:
+                ser.write(b"PING\n")
+                t_ping = time.time() + 1.0
             continue
         print(f"[SER] {s}")
         # допускаем разные регистры/пробелы
-        if s.lower().replace("  ", " ").strip() == "ok ready":
+        if s.lower().replace("  ", " ").strip() == "ok ready" or s == "PONG":
             return True
     print("[SER] TIMEOUT: не получили 'ok READY'")
     return False
 
 
-def send_cmd(ser: serial.Serial, line: str):
-    """Отправить команду и дождаться ok/err; печатаем ответы."""
+# Последняя позиция стола по кадрам автоотчёта (M154); читается без запросов в порт
+_pos = PositionCache() if PositionCache is not None else None
+
+def _xfer(ser: serial.Serial, line: str, timeout: float | None) -> list[str]:
     payload = (line.strip() + "\n").encode()
     ser.write(payload)
+    out = []
+    t_end = None if timeout is None else time.time() + timeout
     while True:
         s = ser.readline().decode(errors="ignore").strip()
         if not s:
+            if t_end is not None and time.time() > t_end:
+                break
             continue
+        if _pos is not None and _pos.update_from_line(s):
+            continue                      # кадр позиции — не часть ответа
+        if s.startswith("* "):
+            continue                      # непрошенная строка от брокера (подписка)
         print(f"[SER] {s}")
-        if s.startswith("ok") or s.startswith("err"):
+        out.append(s)
+        if s.startswith("ok") or s.startswith("err") or s == "PONG":
             break
+    return out
+
+_link_errors = 0
 
-def move_xy(ser: serial.Serial, x: float, y: float, f: int = MOVE_F):
-    send_cmd(ser, f"G X{x} Y{y} F{f}")
+def send_cmd(ser: serial.Serial, line: str, timeout: float | None = None) -> list[str]:
+    """
+    Отправить команду и дождаться ok/err (PING — PONG); печатаем ответы. Возвращает все строки ответа
+    (при timeout — то, что успело прийти). 'err NOISE' = команда не дошла: повторяем,
+    а если помехи повторяются на повышенной скорости — откатываемся на SERIAL_BAUD.
+    """
+    global _link_errors
+    while True:
+        out = _xfer(ser, line, timeout)
+        if not out or out[-1] != "err NOISE":
+            _link_errors = 0
+            return out
+        _link_errors += 1
+        if _link_errors >= LINK_ERR_MAX and getattr(ser, "baudrate", SERIAL_BAUD) != SERIAL_BAUD:
+            print(f"[SER] помехи на {ser.baudrate} — откат на {SERIAL_BAUD}")
+            fallback_baud(ser)
+            _link_errors = 0
+        elif _link_errors > LINK_ERR_MAX:
+            return out
+
+def set_link_baud(ser: serial.Serial, target: int) -> bool:
+    """
+    Договориться с прошивкой о скорости target: BAUD <target> на текущей скорости,
+    переключить порт, подтвердить PING. Не подтвердилось — вернуться на SERIAL_BAUD
+    (прошивка сама откатывается через BAUD_CONFIRM_S).
+    """
+    if getattr(ser, "is_broker", False):
+        return False              # скоростью порта управляет брокер
+    if ser.baudrate == target:
+        return True
+    out = _xfer(ser, f"BAUD {target}", timeout=1.0)
+    if not out or out[-1] != f"ok BAUD {target}":
+        print(f"[SER] прошивка не приняла BAUD {target}")
+        return False
+    time.sleep(0.01)              # прошивка дописывает ответ и перезапускает UART
+    ser.baudrate = target
+    ser.reset_input_buffer()
+    for _ in range(3):
+        if _xfer(ser, "PING", timeout=0.3)[-1:] == ["PONG"]:
+            print(f"[{ts()}] Serial: скорость {target} подтверждена")
+            return True
+    print(f"[SER] нет PONG на {target} — откат на {SERIAL_BAUD}")
+    ser.baudrate = SERIAL_BAUD
+    time.sleep(BAUD_CONFIRM_S + 0.2)
+    ser.reset_input_buffer()
+    _xfer(ser, "PING", timeout=0.5)
+    return False
+
+def fallback_baud(ser: serial.Serial):
+    """Вернуться на SERIAL_BAUD: попросить прошивку; если не слышит — переключиться самим и пинговать."""
+    if set_link_baud(ser, SERIAL_BAUD):
+        return
+    ser.baudrate = SERIAL_BAUD
+    ser.reset_input_buffer()
+    # мусор на её скорости прошивка тоже считает помехой и сама откатывается
+    for _ in range(10):
+        if _xfer(ser, "PING", timeout=0.3)[-1:] == ["PONG"]:
+            return
+
+def parse_report(lines: list[str], tag: str = "STATUS") -> dict:
+    """'STATUS X:1.000 Y:2.000 X_MIN:open ... HOMED:1' -> {'X': '1.000', 'Y': '2.000', ...}"""
+    prefix = tag + " "
+    for s in lines:
+        if s.startswith(prefix):
+            return dict(t.split(":", 1) for t in s[len(prefix):].split() if ":" in t)
+    return {}
+
+def home_all(ser: serial.Serial) -> bool:
+    """G28 (обе оси одновременно) + лог времени хоуминга по осям из строки 'HOME X_MS:.. Y_MS:..'."""
+    lines = send_cmd(ser, "G28")
+    times = parse_report(lines, "HOME")
+    for ax in ("X", "Y"):
+        ms = times.get(f"{ax}_MS")
+        if ms is None:
+            continue
+        sec = int(ms) / 1000.0
+        warn = "  <-- МЕДЛЕННО" if sec > HOME_WARN_S else ""
+        print(f"[{ts()}] [home] {ax}: {sec:.3f} с{warn}")
+    return bool(lines) and lines[-1].startswith("ok")
+
+def home_if_needed(ser: serial.Serial):
+    """
+    G28 только если прошивка не доверяет своей позиции.
+    Иначе — быстрая проверка без движения: вдали от нуля концевики должны быть open.
+    """
+    if HOME_SKIP_IF_VALID:
+        st = parse_report(send_cmd(ser, "M114"))
+        if st.get("HOMED") == "1" and st.get("ESTOP") == "0":
+            try:
+                sane = all(
+                    not (float(st[ax]) > HOME_SANITY_MM and st[f"{ax}_MIN"] == "TRIG")
+                    for ax in ("X", "Y")
+                )
+            except (KeyError, ValueError):
+                sane = False
+            if sane:
+                print(f"[home] Позиция валидна (X={st['X']} Y={st['Y']}) — G28 пропущен")
+                return
+            print("[home] Концевики не согласуются с позицией — делаю G28")
+    home_all(ser)
+
+class MotionModel:
+    """
+    Прогноз длительности 'G X.. Y.. F..' по параметрам прошивки (M503).
+    Оси едут независимо (у каждой свой AccelStepper): время хода — максимум из двух трапеций.
+    Последняя заданная точка запоминается, поэтому следующий прогноз считается от неё.
+    """
+    def __init__(self, cfg: dict):
+        self.steps = {"X": float(cfg["STEPS_X"]), "Y": float(cfg["STEPS_Y"])}
+        self.feed = float(cfg["FEED"])        # мм/с
+        self.acc = float(cfg["ACC"])          # мм/с^2
+        self.max_mm = {"X": float(cfg["X_MAX"]), "Y": float(cfg["Y_MAX"])}
+        self.pos: dict | None = None          # мм, None — неизвестна (до первого M114)
+
+    @staticmethod
+    def axis_time(dist: float, v: float, a: float) -> float:
+        """Время хода на dist при разгоне a до v и торможении (треугольник, если v не достигается)."""
+        if dist <= 0 or v <= 0 or a <= 0:
+            return 0.0
+        if dist >= v * v / a:
+            return dist / v + v / a
+        return 2.0 * (dist / a) ** 0.5
+
+    def target(self, x: float, y: float) -> dict:
+        """Куда реально приедет прошивка: constrain по лимитам и усечение до целого шага."""
+        out = {}
+        for ax, val in (("X", x), ("Y", y)):
+            val = min(max(val, 0.0), self.max_mm[ax])
+            out[ax] = int(val * self.steps[ax]) / self.steps[ax]
+        return out
+
+    def predict(self, x: float, y: float, f: float) -> float:
+        if self.pos is None:
+            return 0.0
+        tgt = self.target(x, y)
+        v_cmd = (f / 60.0) if f > 0 else 1.0 / 60.0
+        t = 0.0
+        for ax in ("X", "Y"):
+            v = min(v_cmd, self.feed)
+            if MOTION_STEP_RATE_MAX:
+                v = min(v, MOTION_STEP_RATE_MAX / self.steps[ax])
+            t = max(t, self.axis_time(abs(tgt[ax] - self.pos[ax]), v, self.acc))
+        return t + MOTION_OVERHEAD_S
+
+    def moved(self, x: float, y: float):
+        self.pos = self.target(x, y)
+
+_motion: Optional[MotionModel] = None
+
+def query_motion_model(ser: serial.Serial) -> Optional[MotionModel]:
+    """M503 (кинематика) + M114 (стартовая позиция). Старая прошивка без M503 — None, прогнозов не будет."""
+    cfg = parse_report(send_cmd(ser, "M503", timeout=1.0), "CONFIG")
+    try:
+        model = MotionModel(cfg)
+    except (KeyError, ValueError):
+        print("[move] Прошивка не отдаёт CONFIG (M503) — прогноз времени перемещений выключен")
+        return None
+    st = parse_report(send_cmd(ser, "M114"))
+    try:
+        model.pos = {"X": float(st["X"]), "Y": float(st["Y"])}
+    except (KeyError, ValueError):
+        pass
+    print(f"[move] Кинематика: {model.steps['X']:g}/{model.steps['Y']:g} шаг/мм, "
+          f"{model.feed:g} мм/с, {model.acc:g} мм/с^2")
+    return model
+
+def move_xy(ser: serial.Serial, x: float, y: float, f: int = MOVE_F, before_arrival=None) -> bool:
+    """
+    G X.. Y.. F.. и ожидание ok. before_arrival — быстрое (неблокирующее) действие к прибытию:
+    при PRETRIGGER_LEAD_S > 0 и известном прогнозе оно вызывается из потока таймера
+    за PRETRIGGER_LEAD_S до расчётного прибытия (если ok пришёл раньше — сразу по ok).
+    Возвращает True, если before_arrival запущено (вызывающий не должен повторять действие).
+    В лог — прогноз против факта для каждого хода.
+    """
+    predicted = _motion.predict(x, y, f) if _motion is not None else 0.0
+    fire = None
+    if before_arrival is not None and PRETRIGGER_LEAD_S > 0 and predicted > 0:
+        fired = threading.Lock()
+        def fire():
+            if fired.acquire(blocking=False):
+                before_arrival()
+        timer = threading.Timer(max(0.0, predicted - PRETRIGGER_LEAD_S), fire)
+        timer.daemon = True
+    t0, t0_mono = time.time(), time.monotonic()
+    if fire is not None:
+        timer.start()
+    lines = send_cmd(ser, f"G X{x} Y{y} F{f}")
+    actual = time.time() - t0
+    ok = bool(lines) and lines[-1].startswith("ok")
+    if fire is not None:
+        timer.cancel()
+        if ok:
+            fire()                    # прибыли раньше прогноза — запускаем сейчас
+    if _motion is not None:
+        if ok:
+            _motion.moved(x, y)
+            if predicted > 0:
+                print(f"[move] X{x} Y{y}: прогноз {predicted * 1000:.0f} мс, факт {actual * 1000:.0f} мс, "
+                      f"ошибка {(actual - predicted) * 1000:+.0f} мс")
+        else:
+            # после err (ESTOP, концевик) — фактическая позиция: из автоотчёта, иначе M114
+            snap = _pos.get() if _pos is not None else None
+            if snap is not None and snap[3] >= t0_mono:
+                _motion.pos = {"X": snap[0], "Y": snap[1]}
+            else:
+                st = parse_report(send_cmd(ser, "M114"))
+                try:
+                    _motion.pos = {"X": float(st["X"]), "Y": float(st["Y"])}
+                except (KeyError, ValueError):
+                    _motion.pos = None
+    return fire is not None and fired.locked()
 
 # =====================[ ХЕЛПЕРЫ ЛОГИКИ ]=======================
 def wait_sensor(io: IOController, sensor_name: str, target_close: bool, timeout: float | None) -> bool:
@@ -261,9 +608,11 @@ def wait_sensor(io: IOController, sensor_name: str, target_close: bool, timeout:
     wanted = "CLOSE" if target_close else "OPEN"
     while True:
         if io.sensor_state(sensor_name) == target_close:
+            SENSOR_WAIT.labels(sensor_name, "ok").observe(time.time() - start)
             return True
         if timeout is not None and (time.time() - start) > timeout:
             print(f"[wait_sensor] TIMEOUT: {sensor_name} не достиг состояния {wanted} за {timeout} с")
+            SENSOR_WAIT.labels(sensor_name, "timeout").observe(time.time() - start)
             return False
         time.sleep(0.01)
 
@@ -288,13 +637,39 @@ def wait_new_press(io: IOController, sensor_name: str, timeout: float | None) ->
             return False
         time.sleep(0.01)
 
+# Параметры, которые можно менять на лету командой SET (читаются в момент использования)
+# параметр -> (тип, минимум, максимум); вне пределов — ERR RANGE (линия работает, ноль/минус её остановит)
+TRIGGER_SETTABLE = {
+    "TIMEOUT_SEC": (float, 0.2, 30.0),
+    "FEED_PULSE_MS": (int, 20, 2000),
+    "IND_PULSE_WINDOW_MS": (int, 100, 10000),
+    "PRETRIGGER_LEAD_S": (float, 0.0, 2.0),
+    "MOVE_F": (int, 100, 60000),
+}
+
 class StartTrigger:
+    """
+    Канал управления циклом: TCP 127.0.0.1:8765, построчный протокол, соединение держится постоянно
+    (клиент — trigger_link.TriggerLink), клиентов несколько.
+      клиент -> цикл:  [#id] START | STOP | PAUSE | RESUME | STATUS | PING | METRICS | SET <параметр> <значение> | SUB | UNSUB
+      цикл -> клиент:  [#id] OK [данные] | [#id] ERR <причина>     (id — как в запросе, если был)
+                       ! <событие> [данные]   подписчикам (SUB): PHASE, STARTED, CYCLE, PAUSED, RESUMED, STOPPING
+    Старый одноразовый клиент ("START\n", ждёт OK, закрывает соединение) работает как раньше.
+    """
     def __init__(self, host: str = TRIGGER_HOST, port: int = TRIGGER_PORT):
         self.host = host
         self.port = port
-        self.event = threading.Event()
+        self.event = threading.Event()           # START (педаль из UI)
+        self.stop_requested = threading.Event()  # STOP: выйти после текущего цикла
+        self.paused = threading.Event()
+        self.t_start_cmd = 0.0                   # monotonic приёма последнего START (для задержки до старта)
+        self.phase = "initializing"
+        self.cycles = 0
+        self.last_cycle_s: Optional[float] = None
         self._stop = threading.Event()
         self._thr: Optional[threading.Thread] = None
+        self._clients: list = []                 # {"conn", "wlock", "sub"} на каждое соединение
+        self._lock = threading.Lock()
 
     def start(self):
         if self._thr and self._thr.is_alive():
@@ -304,24 +679,42 @@ class StartTrigger:
 
     def stop(self):
         self._stop.set()
-        # разбудить accept()
-        try:
-            with socket.create_connection((self.host, self.port), timeout=0.2):
+        with self._lock:
+            clients = list(self._clients)
+        for c in clients:
+            try:
+                c["conn"].shutdown(socket.SHUT_RDWR)
+            except Exception:
                 pass
-        except Exception:
-            pass
         if self._thr:
             self._thr.join(timeout=0.5)
 
     def trigger_once(self):
         self.event.clear()
 
+    # ---- события
+    def emit(self, event: str, data: str = ""):
+        line = f"! {event} {data}".rstrip() + "\n"
+        with self._lock:
+            subs = [c for c in self._clients if c["sub"]]
+        for c in subs:
+            self._send(c, line)
+
+    @staticmethod
+    def _send(c: dict, line: str):
+        try:
+            with c["wlock"]:
+                c["conn"].sendall(line.encode("utf-8", "ignore"))
+        except OSError:
+            pass
+
+    # ---- сервер
     def _server_loop(self):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((self.host, self.port))
-            s.listen(1)
+            s.listen(8)
             s.settimeout(0.5)
             print(f"[trigger] LISTEN {self.host}:{self.port}")
         except Exception as e:
@@ -336,61 +729,183 @@ class StartTrigger:
             except Exception as e:
                 print(f"[trigger] accept error: {e}")
                 continue
-
-            with conn:
-                try:
-                    data = conn.recv(64)
-                    if data and b"START" in data.upper():
-                        print("[trigger] Получена команда START от UI")
-                        self.event.set()
-                        conn.sendall(b"OK\n")
-                    else:
-                        conn.sendall(b"ERR\n")
-                except Exception as e:
-                    print(f"[trigger] recv/send error: {e}")
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            c = {"conn": conn, "wlock": threading.Lock(), "sub": False}
+            with self._lock:
+                self._clients.append(c)
+            threading.Thread(target=self._client_loop, args=(c,), daemon=True).start()
         try:
             s.close()
         except Exception:
             pass
         print("[trigger] listener stopped")
 
+    def _client_loop(self, c: dict):
+        try:
+            for raw in c["conn"].makefile("rb"):
+                line = raw.decode(errors="ignore").strip()
+                if not line:
+                    continue
+                rid = ""
+                if line.startswith("#"):
+                    rid, _, line = line.partition(" ")
+                ok, data = self._handle(c, line)
+                reply = f"{'OK' if ok else 'ERR'} {data}".rstrip()
+                self._send(c, f"{rid} {reply}\n" if rid else reply + "\n")
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if c in self._clients:
+                    self._clients.remove(c)
+            try:
+                c["conn"].close()
+            except Exception:
+                pass
+
+    def _handle(self, c: dict, line: str) -> tuple:
+        parts = line.split()
+        cmd = parts[0].upper()
+        if cmd == "START":
+            if self.paused.is_set():
+                return False, "PAUSED"
+            if self.stop_requested.is_set():
+                return False, "STOPPING"
+            self.t_start_cmd = time.monotonic()
+            self.event.set()
+            print("[trigger] Получена команда START от UI")
+            return True, ""
+        if cmd == "STOP":
+            self.stop_requested.set()
+            self.emit("STOPPING")
+            print("[trigger] Получена команда STOP — выход после текущего цикла")
+            return True, ""
+        if cmd == "PAUSE":
+            self.paused.set()
+            self.event.clear()
+            self.emit("PAUSED")
+            return True, ""
+        if cmd == "RESUME":
+            self.paused.clear()
+            self.emit("RESUMED")
+            return True, ""
+        if cmd == "STATUS":
+            return True, json.dumps(self.status())
+        if cmd == "PING":
+            return True, "PONG"
+        if cmd == "METRICS":
+            return True, json.dumps(metrics_snapshot(CYCLE_REGISTRY))
+        if cmd == "SUB":
+            c["sub"] = True
+            return True, ""
+        if cmd == "UNSUB":
+            c["sub"] = False
+            return True, ""
+        if cmd == "SET":
+            if len(parts) != 3 or parts[1].upper() not in TRIGGER_SETTABLE:
+                return False, "SET " + "|".join(TRIGGER_SETTABLE) + " <value>"
+            key = parts[1].upper()
+            kind, lo, hi = TRIGGER_SETTABLE[key]
+            try:
+                value = kind(parts[2])
+            except ValueError:
+                return False, f"BAD_VALUE {parts[2]}"
+            if not lo <= value <= hi:                  # nan тоже сюда
+                return False, f"RANGE {key} {lo}..{hi}"
+            globals()[key] = value
+            print(f"[trigger] SET {key} = {value}")
+            return True, f"{key}={value}"
+        return False, "UNKNOWN"
+
+    def status(self) -> dict:
+        return {
+            "phase": self.phase,
+            "paused": self.paused.is_set(),
+            "stopping": self.stop_requested.is_set(),
+            "cycles": self.cycles,
+            "last_cycle_s": self.last_cycle_s,
+            "settings": {k: globals()[k] for k in TRIGGER_SETTABLE},
+        }
 
 
 def wait_pedal_or_command(io: IOController, trg: "StartTrigger") -> bool:
-   
-    while True:
-        if not io.sensor_state("PED_START"): 
-            break
+    """Ждать педаль (новое нажатие) или START; False — пришёл STOP. На паузе педаль и START игнорируются."""
+    def command() -> Optional[bool]:
+        if trg.stop_requested.is_set():
+            return False
         if trg.event.is_set():
             trg.trigger_once()
+            lat = (time.monotonic() - trg.t_start_cmd) * 1000.0
+            trg.emit("STARTED", f"command {lat:.1f}")
             return True
+        return None
+
+    while True:
+        r = command()
+        if r is not None:
+            return r
+        if not io.sensor_state("PED_START"):
+            break
         time.sleep(0.01)
 
     while True:
-        if io.sensor_state("PED_START"): 
-            return True
-        if trg.event.is_set():
-            trg.trigger_once()
+        r = command()
+        if r is not None:
+            return r
+        if io.sensor_state("PED_START") and not trg.paused.is_set():
+            trg.emit("STARTED", "pedal")
             return True
         time.sleep(0.01)
 
 
-def wait_close_pulse(io: IOController, sensor_name: str, window_ms: int) -> bool:
-    """Ждём, что датчик станет CLOSE хотя бы импульсно в течение window_ms."""
-    t_end = time.time() + (window_ms / 1000.0)
-    while time.time() < t_end:
-        if io.sensor_state(sensor_name): 
-            return True
-        time.sleep(0.005)
-    return False
+class FeedShot:
+    """
+    Одна подача винта (импульс R01_PIT в своём потоке) с защёлкой IND_SCRW: датчик опрашивается
+    с момента подачи, а не после ok хода, поэтому короткий импульс, пришедший раньше, не теряется.
+    fire() не блокирует (годится для before_arrival); wait() дожидается конца импульса R01 —
+    к моменту torque_sequence подача завершена.
+    """
+    def __init__(self, io: IOController):
+        self.io = io
+        self.seen = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pulse_end = 0.0
+
+    def fire(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        threading.Thread(target=self._watch, daemon=True).start()
+        try:
+            self.io.pulse("R01_PIT", ms=FEED_PULSE_MS)
+        finally:
+            self._pulse_end = time.monotonic()
+
+    def _watch(self):
+        while not self._stop.is_set():
+            if self.io.sensor_state("IND_SCRW"):
+                self.seen.set()
+                return
+            time.sleep(0.005)
+
+    def wait(self, window_ms: int) -> bool:
+        """Был ли импульс IND_SCRW от подачи до window_ms после конца импульса R01 (подаёт, если ещё не)."""
+        self.fire()
+        self._thread.join()
+        ok = self.seen.wait(max(0.0, self._pulse_end + window_ms / 1000.0 - time.monotonic()))
+        self._stop.set()
+        return ok
 
 def feed_until_detect(io: IOController):
     """Подача винта (п.9/16/23) с повтором, пока не придёт импульс IND_SCRW (п.10/17/24)."""
     while True:
-        io.pulse("R01_PIT", ms=FEED_PULSE_MS)
-        if wait_close_pulse(io, "IND_SCRW", IND_PULSE_WINDOW_MS):
+        if FeedShot(io).wait(IND_PULSE_WINDOW_MS):
             return
         print("[feed] Нет импульса IND_SCRW, повторяю подачу...")
+        FEED_RETRIES.inc()
 
 def torque_sequence(io: IOController) -> bool:
     """
@@ -403,6 +918,8 @@ def torque_sequence(io: IOController) -> bool:
     ok = wait_sensor(io, "DO2_OK", True, TIMEOUT_SEC)
     if not ok:
         print("[torque] TIMEOUT по DO2_OK — выключаю и поднимаю C2")
+        TORQUE_TIMEOUTS.inc()
+        SCREWS.labels("torque_timeout").inc()
         io.set_relay("R04_C2", False)
         io.set_relay("R06_DI1_POT", False)
         wait_sensor(io, "GER_C2_UP", True, TIMEOUT_SEC)
@@ -413,7 +930,9 @@ def torque_sequence(io: IOController) -> bool:
     io.set_relay("R06_DI1_POT", False)          # п.13 / 20 / 27 (часть 2)
     ok_up = wait_sensor(io, "GER_C2_UP", True, TIMEOUT_SEC)
     if not ok_up:
+        SCREWS.labels("up_timeout").inc()
         return False
+    SCREWS.labels("ok").inc()
 
     # free-run импульс 100 мс (п.14 / 21 / 28)
     io.pulse("R05_DI4_FREE", ms=FREE_BURST_MS)
@@ -429,9 +948,12 @@ def torque_fallback(io: IOController):
     wait_sensor(io, "GER_C2_UP", True, TIMEOUT_SEC)
 
 # =====================[ ГЛАВНАЯ ЛОГИКА ]=======================
-def main():
-    io = IOController()
-    trg = StartTrigger(TRIGGER_HOST, TRIGGER_PORT)
+def main() -> int:
+    """Код выхода: 0 — остановлен (SIGINT/STOP), 1 — отказ (перед ним "@@PHASE failed <причина>")."""
+    global _motion, _trg
+    report_phase("initializing")
+    io = open_io()
+    trg = _trg = StartTrigger(TRIGGER_HOST, TRIGGER_PORT)
     trg.start()
     # --- Открыть serial и держать открытым до завершения процесса ---
     print(f"[{ts()}] Открываю сериал порт {SERIAL_PORT} @ {SERIAL_BAUD}")
@@ -449,15 +971,24 @@ def main():
         # если нужно — можно прервать работу:
         # return
         # либо просто продолжить, но по ТЗ корректнее остановиться
-        return
+        report_phase("failed", "no READY from XY table")
+        return 1
 
+    if SERIAL_BAUD_FAST and SERIAL_BAUD_FAST != SERIAL_BAUD:
+        set_link_baud(ser, SERIAL_BAUD_FAST)
+    # через брокер автоотчёт включает сам брокер
+    if POS_REPORT_HZ and not getattr(ser, "is_broker", False):
+        send_cmd(ser, f"M154 S{POS_REPORT_HZ}", timeout=1.0)
 
     try:
         print("=== Старт скрипта ===")
 
 
-        # 3. G28 — хоуминг, ждём ok
-        send_cmd(ser, "G28")
+        # 3. G28 — хоуминг, ждём ok (пропускается, если позиция ещё валидна)
+        report_phase("homing")
+        home_if_needed(ser)
+        _motion = query_motion_model(ser)
+        report_phase("initializing", "cylinders")
 
         # 4. Проверяем GER_C1_UP; если OPEN — поднять до CLOSE
         if not io.sensor_state("GER_C1_UP"):
@@ -466,7 +997,8 @@ def main():
             io.set_relay("R02_C1_UP", False)
             if not ok:
                 print("[init] Не удалось поднять C1 до верха")
-                return
+                report_phase("failed", "C1 not up")
+                return 1
 
         # 5. Включаем R04_C2 до GER_C2_DOWN=CLOSE
         io.set_relay("R04_C2", True)
@@ -474,19 +1006,22 @@ def main():
         if not ok:
             io.set_relay("R04_C2", False)
             print("[init] Не удалось опустить C2 до низа")
-            return
+            report_phase("failed", "C2 not down")
+            return 1
 
         # 6. Выключаем R04_C2, ждём GER_C2_UP=CLOSE
         io.set_relay("R04_C2", False)
         ok = wait_sensor(io, "GER_C2_UP", True, TIMEOUT_SEC)
         if not ok:
             print("[init] Не удалось поднять C2 до верха")
-            return
+            report_phase("failed", "C2 not up")
+            return 1
 
         # ---------- Основной цикл: п.7..29 ----------
         while True:
             print("[cycle] Жду педаль PED_START ИЛИ команду START от UI...")
             set_cycle_busy(False)  # <-- цикл свободен, ждём триггера
+            report_phase("ready")
             if not wait_pedal_or_command(io, trg):
                 break
 
@@ -497,56 +1032,76 @@ def main():
 
 
             set_cycle_busy(True)
+            report_phase("busy")
+            t_cycle = time.monotonic()
 
             # --- Точка 1: X35 Y155 (пп.8–14) ---
             x, y = POINTS[0]
-            move_xy(ser, x, y, MOVE_F)               # 8
-            feed_until_detect(io)                     # 9 + 10
+            # Подача (п.9) — по ok или заранее, за PRETRIGGER_LEAD_S до прибытия; IND_SCRW ловится с момента подачи
+            shot = FeedShot(io)
+            move_xy(ser, x, y, MOVE_F, before_arrival=shot.fire)   # 8 (+9 заранее)
+            if not shot.wait(IND_PULSE_WINDOW_MS):   # 9 + 10
+                feed_until_detect(io)
             if not torque_sequence(io):              # 11–14 (с free-run)
                 # При таймауте по моменту возвращаемся к ожиданию педали
                 move_xy(ser, 35, 20, MOVE_F)
-                return
+                report_phase("failed", "torque timeout")
+                return 1
 
             # --- Точка 2: X15 Y123 (пп.15–21) ---
             x, y = POINTS[1]
-            move_xy(ser, x, y, MOVE_F)               # 15
-            # Подача и контроль IND_SCRW
-            io.pulse("R01_PIT", ms=FEED_PULSE_MS)    # 16
-            if not wait_close_pulse(io, "IND_SCRW", IND_PULSE_WINDOW_MS):  # 17
+            shot = FeedShot(io)
+            move_xy(ser, x, y, MOVE_F, before_arrival=shot.fire)   # 15
+            if not shot.wait(IND_PULSE_WINDOW_MS):   # 16 + 17
                 # если нет импульса — повторяем подачу (логика п.10 говорит «делаем ещё раз пункт 9»)
                 feed_until_detect(io)
             if not torque_sequence(io):              # 18–21
                 move_xy(ser, 35, 20, MOVE_F)
-                return
+                report_phase("failed", "torque timeout")
+                return 1
 
             # --- Точка 3: X54 Y123 (пп.22–28) ---
             x, y = POINTS[2]
-            move_xy(ser, x, y, MOVE_F)               # 22
-            # Подача и контроль IND_SCRW
-            io.pulse("R01_PIT", ms=FEED_PULSE_MS)    # 23
-            if not wait_close_pulse(io, "IND_SCRW", IND_PULSE_WINDOW_MS):  # 24
+            shot = FeedShot(io)
+            move_xy(ser, x, y, MOVE_F, before_arrival=shot.fire)   # 22
+            if not shot.wait(IND_PULSE_WINDOW_MS):   # 23 + 24
                 feed_until_detect(io)                # повторяем п.9 до успеха
             if not torque_sequence(io):              # 25–28
                 move_xy(ser, 35, 20, MOVE_F)
-                return
+                report_phase("failed", "torque timeout")
+                return 1
 
 
             move_xy(ser, 35, 20, MOVE_F)
 
             set_cycle_busy(False)
+            trg.cycles += 1
+            trg.last_cycle_s = round(time.monotonic() - t_cycle, 3)
+            CYCLES.inc()
+            CYCLE_SECONDS.observe(trg.last_cycle_s)
+            trg.emit("CYCLE", f"{trg.cycles} {trg.last_cycle_s}")
 
             # 29. Повторяем с пункта 7 — просто продолжаем while True
 
     except KeyboardInterrupt:
         pass
     finally:
+        report_phase("stopping")
         trg.stop()
         io.cleanup()
+        try:
+            # прошивка остаётся на той скорости, что мы ей выставили: следующий запуск открывает порт
+            # на SERIAL_BAUD и без отката не дождётся READY
+            if not getattr(ser, "is_broker", False) and ser.baudrate != SERIAL_BAUD:
+                fallback_baud(ser)
+        except Exception:
+            pass
         try:
             ser.close()
         except Exception:
             pass
         print("=== Остановлено. GPIO освобождены ===")
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Арбитр GPIO станции.
+
+Один процесс держит IOController (настройка пинов, edge-детект датчиков) всё время работы,
+а web_ui и cycle_onefile ходят к нему через локальный Unix-сокет. Писать в реле может только
+держатель аренды (lease); читать датчики и реле — все. Передача аренды между ручным режимом
+и циклом — смена владельца под блокировкой, без GPIO.cleanup() и повторной инициализации:
+реле не сбрасываются в исходное состояние, датчики наблюдаются без пауз.
+
+Протокол (построчный, UTF-8):
+  клиент -> арбитр:
+    #NAME <имя>           имя клиента (без ответа)
+    #SUB / #UNSUB         подписка на события (без ответа)
+    #STATS                JSON со статистикой, затем "ok"
+    LEASE [ожидание_с]    взять аренду; "ok LEASE" или "err BUSY <держатель>" по истечении ожидания
+    RELEASE               отдать аренду (реле остаются как есть), "ok"
+    R <реле> 0|1          реле; "ok", "err NOLEASE <держатель>", "err UNKNOWN"
+    S <датчик>            "ok 0|1" (1 — CLOSE)
+    STATE                 JSON {"relays": {...}, "sensors": {...}, "holder": ...}, затем "ok"
+  арбитр -> клиент:
+    ответ на свою команду; последняя строка — ok... / err...
+    "* R <реле> 0|1", "* S <датчик> 0|1", "* LEASE <держатель|->"   события (подписчикам)
+
+Если держатель аренды отключился, не отдав её (процесс упал или убит), реле выключаются
+(--on-drop keep — оставить как есть) и аренда переходит следующему ожидающему.
+"""
+import os
+import stat
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+from typing import Optional
+
+# =====================[ КОНФИГ ]=====================
+GPIO_SOCK = os.getenv("GPIO_ARBITER_SOCK", "/tmp/screw_gpio.sock")
+LEASE_WAIT_S = 5.0                # сколько клиент по умолчанию ждёт аренду
+REQ_TIMEOUT = 2.0                 # ответ арбитра на одну команду
+
+
+def ts():
+    return time.strftime("%H:%M:%S")
+
+def is_final(line: str) -> bool:
+    return line.startswith("ok") or line.startswith("err")
+
+
+# =====================[ СЕРВЕР ]=====================
+class _Client:
+    _ids = 0
+
+    def __init__(self, conn: socket.socket):
+        _Client._ids += 1
+        self.id = _Client._ids
+        self.name = f"client{self.id}"
+        self.conn = conn
+        self.alive = True
+        self.subscribed = False
+        self.n = 0
+        self._wlock = threading.Lock()
+
+    def send_line(self, s: str):
+        if not self.alive:
+            return
+        try:
+            with self._wlock:
+                self.conn.sendall((s + "\n").encode("utf-8", "ignore"))
+        except OSError:
+            self.alive = False
+
+
+class GpioArbiter:
+    def __init__(self, sock_path: str = GPIO_SOCK, off_on_drop: bool = True):
+        # пины и IOController — из цикла (одна распиновка на всех); импорт здесь, а не наверху,
+        # потому что cycle_onefile сам импортирует RemoteIO из этого модуля
+        from cycle_onefile import IOController, SENSOR_PINS
+        self.sensor_names = list(SENSOR_PINS.keys())
+        self.sock_path = sock_path
+        self.off_on_drop = off_on_drop
+        self.io = IOController()
+        self.io.on_change = self._on_io_change
+        self._io_lock = threading.Lock()
+        self._cv = threading.Condition()
+        self._clients: list[_Client] = []
+        self.holder: Optional[_Client] = None
+        self._released_at: Optional[float] = None   # perf_counter освобождения — для замера передачи
+        self.handovers = 0
+        self.last_handover_us: Optional[float] = None
+        self.max_handover_us = 0.0
+        self._stop = threading.Event()
+
+    # ---- события
+    def _on_io_change(self, kind: str, name: str, value: bool):
+        self._broadcast(f"{'R' if kind == 'relay' else 'S'} {name} {int(value)}")
+
+    def _broadcast(self, s: str):
+        with self._cv:
+            subs = [c for c in self._clients if c.subscribed]
+        for c in subs:
+            c.send_line("* " + s)
+
+    # ---- аренда
+    def _lease(self, client: _Client, wait_s: float) -> bool:
+        with self._cv:
+            waited = self.holder is not None and self.holder is not client
+            ok = self._cv.wait_for(lambda: self.holder is None or self.holder is client, wait_s)
+            if not ok:
+                return False
+            if self.holder is client:
+                return True
+            self.holder = client
+            # передача = от RELEASE до выдачи уже ждущему; свободную аренду берут без замера
+            if waited and self._released_at is not None:
+                self.last_handover_us = (time.perf_counter() - self._released_at) * 1e6
+                self.max_handover_us = max(self.max_handover_us, self.last_handover_us)
+                self._released_at = None
+            self.handovers += 1
+        print(f"[{ts()}] [gpio] аренда -> {client.name}")
+        self._broadcast(f"LEASE {client.name}")
+        return True
+
+    def _release(self, client: _Client, dropped: bool = False):
+        with self._cv:
+            if self.holder is not client:
+                return
+            if dropped and self.off_on_drop:
+                with self._io_lock:
+                    for name, on in list(self.io.relays.items()):
+                        if on:
+                            self.io.set_relay(name, False)
+            self.holder = None
+            self._released_at = time.perf_counter()
+            self._cv.notify_all()
+        print(f"[{ts()}] [gpio] аренда освобождена ({client.name}{', отключился' if dropped else ''})")
+        self._broadcast("LEASE -")
+
+    # ---- клиенты
+    def _client_loop(self, client: _Client):
+        try:
+            rfile = client.conn.makefile("rb")
+            for raw in rfile:
+                s = raw.decode(errors="ignore").strip()
+                if not s:
+                    continue
+                client.n += 1
+                if s.startswith("#"):
+                    self._meta(client, s)
+                else:
+                    self._command(client, s)
+        except OSError:
+            pass
+        finally:
+            client.alive = False
+            self._release(client, dropped=True)
+            with self._cv:
+                if client in self._clients:
+                    self._clients.remove(client)
+            try:
+                client.conn.close()
+            except Exception:
+                pass
+            print(f"[{ts()}] [gpio] {client.name} отключился ({client.n} команд)")
+
+    def _command(self, client: _Client, s: str):
+        parts = s.split()
+        cmd = parts[0].upper()
+        if cmd == "S" and len(parts) == 2:
+            try:
+                client.send_line(f"ok {int(self.io.sensor_state(parts[1]))}")
+            except KeyError:
+                client.send_line("err UNKNOWN")
+        elif cmd == "R" and len(parts) == 3 and parts[2] in ("0", "1"):
+            with self._cv:
+                holder = self.holder
+                if holder is not client:
+                    client.send_line(f"err NOLEASE {holder.name if holder else '-'}")
+                    return
+                # под _cv: аренду не отберут посреди записи
+                try:
+                    with self._io_lock:
+                        self.io.set_relay(parts[1], parts[2] == "1")
+                except ValueError:
+                    client.send_line("err UNKNOWN")
+                    return
+            client.send_line("ok")
+        elif cmd == "STATE":
+            with self._io_lock:
+                data = {"relays": dict(self.io.relays),
+                        "sensors": {n: self.io.sensor_state(n) for n in self.sensor_names}}
+            data["holder"] = self.holder.name if self.holder else None
+            client.send_line(json.dumps(data))
+            client.send_line("ok")
+        elif cmd == "LEASE":
+            try:
+                wait_s = float(parts[1]) if len(parts) > 1 else 0.0
+            except ValueError:
+                client.send_line("err ARG")
+                return
+            if self._lease(client, wait_s):
+                client.send_line("ok LEASE")
+            else:
+                holder = self.holder
+                client.send_line(f"err BUSY {holder.name if holder else '-'}")
+        elif cmd == "RELEASE":
+            self._release(client)
+            client.send_line("ok")
+        else:
+            client.send_line("err UNKNOWN_CMD")
+
+    def _meta(self, client: _Client, s: str):
+        cmd, _, arg = s[1:].partition(" ")
+        cmd = cmd.upper()
+        if cmd == "NAME" and arg:
+            client.name = arg.strip()
+        elif cmd == "SUB":
+            client.subscribed = True
+        elif cmd == "UNSUB":
+            client.subscribed = False
+        elif cmd == "STATS":
+            with self._cv:
+                data = {"holder": self.holder.name if self.holder else None,
+                        "handovers": self.handovers,
+                        "last_handover_us": None if self.last_handover_us is None else round(self.last_handover_us, 1),
+                        "max_handover_us": round(self.max_handover_us, 1),
+                        "clients": [{"id": c.id, "name": c.name, "n": c.n, "sub": c.subscribed}
+                                    for c in self._clients]}
+            client.send_line(json.dumps(data))
+            client.send_line("ok")
+        else:
+            client.send_line("err UNKNOWN_META")
+
+    def _accept_loop(self, srv: socket.socket):
+        while not self._stop.is_set():
+            try:
+                conn, _ = srv.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            client = _Client(conn)
+            with self._cv:
+                self._clients.append(client)
+            threading.Thread(target=self._client_loop, args=(client,), daemon=True).start()
+
+    def serve_forever(self):
+        try:
+            os.unlink(self.sock_path)
+        except FileNotFoundError:
+            pass
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(self.sock_path)
+        os.chmod(self.sock_path, 0o666)
+        srv.listen(8)
+        srv.settimeout(0.5)
+        print(f"[{ts()}] [gpio] LISTEN {self.sock_path}")
+        try:
+            self._accept_loop(srv)
+        finally:
+            self._stop.set()
+            srv.close()
+            try:
+                os.unlink(self.sock_path)
+            except FileNotFoundError:
+                pass
+            self.io.cleanup()
+
+
+# =====================[ КЛИЕНТ ]=====================
+class RemoteIO:
+    """
+    Замена IOController поверх сокета арбитра: relays / set_relay / pulse / sensor_state / on_change / cleanup.
+    relays и on_change обновляются событиями арбитра (в том числе от чужих записей), sensor_state —
+    запрос к арбитру (актуальное состояние пина, а не последнее событие).
+    shared=True: GPIO при этом не освобождаются — читать можно и без аренды.
+    """
+    shared = True
+
+    def __init__(self, path: str = GPIO_SOCK, name: str = "client", lease: bool = True,
+                 lease_wait: float = LEASE_WAIT_S):
+        self.path = path
+        self.name = name
+        self.relays: dict = {}
+        self.on_change = None
+        self.actuations = None             # необязательный Counter (prometheus_client) с меткой relay: включения этого клиента
+        self.holds_lease = False
+        self._sock: Optional[socket.socket] = None
+        self._replies: queue.Queue = queue.Queue()
+        self._req_lock = threading.Lock()
+        self._connect()
+        if lease and not self.acquire(lease_wait):
+            self.close()
+            raise RuntimeError(f"GPIO lease not granted within {lease_wait:g} s (arbiter {path})")
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self._sock = sock
+        self._replies = queue.Queue()
+        threading.Thread(target=self._reader, args=(sock, self._replies), daemon=True).start()
+        sock.sendall(f"#NAME {self.name}\n#SUB\n".encode())
+
+    def _connect(self):
+        self._open()
+        st = json.loads(self._request("STATE")[0])
+        self.relays = dict(st["relays"])
+
+    def _reader(self, sock: socket.socket, replies: queue.Queue):
+        try:
+            for raw in sock.makefile("rb"):
+                s = raw.decode(errors="ignore").strip()
+                if s.startswith("* "):
+                    self._event(s[2:].split())
+                elif s:
+                    replies.put(s)
+        except (OSError, ValueError):
+            pass
+        replies.put(None)                  # соединение закрыто: разбудить ждущий _request
+
+    def _event(self, parts: list):
+        if len(parts) == 3 and parts[0] in ("R", "S"):
+            kind, name, value = "relay" if parts[0] == "R" else "sensor", parts[1], parts[2] == "1"
+            if kind == "relay":
+                self.relays[name] = value
+            cb = self.on_change
+            if cb is not None:
+                try:
+                    cb(kind, name, value)
+                except Exception as e:
+                    print(f"[{ts()}] WARN: on_change: {e}")
+        elif len(parts) == 2 and parts[0] == "LEASE":
+            self.holds_lease = parts[1] == self.name and self.holds_lease
+
+    def _request(self, line: str, timeout: float = REQ_TIMEOUT) -> list:
+        """Строки ответа (последняя — ok/err). Арбитр перезапускался — одно переподключение с повтором аренды."""
+        with self._req_lock:
+            try:
+                return self._exchange(line, timeout)
+            except OSError:
+                self._reconnect()
+                return self._exchange(line, timeout)
+
+    def _exchange(self, line: str, timeout: float) -> list:
+        if self._sock is None:
+            raise OSError("arbiter connection closed")
+        self._sock.sendall((line + "\n").encode())
+        out = []
+        while True:
+            try:
+                s = self._replies.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"no reply from GPIO arbiter to {line!r}") from None
+            if s is None:
+                raise OSError("arbiter connection closed")
+            out.append(s)
+            if is_final(s):
+                return out
+
+    def _reconnect(self):
+        held = self.holds_lease
+        self.holds_lease = False
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        except OSError:
+            pass
+        self._sock = None
+        print(f"[{ts()}] [gpio] переподключение к арбитру {self.path}")
+        # _req_lock уже взят: служебные запросы — через _exchange
+        self._open()
+        self.relays.update(json.loads(self._exchange("STATE", REQ_TIMEOUT)[0])["relays"])
+        if held:
+            self.holds_lease = self._exchange(f"LEASE {LEASE_WAIT_S}", LEASE_WAIT_S + REQ_TIMEOUT)[-1] == "ok LEASE"
+
+    # ---- аренда
+    def acquire(self, wait: float = LEASE_WAIT_S) -> bool:
+        out = self._request(f"LEASE {wait}", timeout=wait + REQ_TIMEOUT)
+        self.holds_lease = out[-1] == "ok LEASE"
+        return self.holds_lease
+
+    def release(self):
+        if self._sock is not None:
+            self._request("RELEASE")
+        self.holds_lease = False
+
+    # ---- интерфейс IOController
+    def set_relay(self, relay_name: str, on: bool):
+        if relay_name not in self.relays:
+            raise ValueError(f"Unknown relay '{relay_name}'")
+        was = self.relays.get(relay_name)
+        out = self._request(f"R {relay_name} {int(on)}")
+        if out[-1] != "ok":
+            raise RuntimeError(f"GPIO arbiter: {out[-1]}")
+        if on and not was and self.actuations is not None:
+            self.actuations.labels(relay_name).inc()
+        self.relays[relay_name] = on
+
+    def pulse(self, relay_name: str, ms: int):
+        self.set_relay(relay_name, True)
+        time.sleep(ms / 1000.0)
+        self.set_relay(relay_name, False)
+
+    def sensor_state(self, sensor_name: str) -> bool:
+        out = self._request(f"S {sensor_name}")
+        if not out[-1].startswith("ok "):
+            raise KeyError(sensor_name)
+        return out[-1] == "ok 1"
+
+    def cleanup(self):
+        """Как IOController.cleanup для цикла: реле OFF (если аренда наша), аренду отдать, отключиться."""
+        try:
+            if self.holds_lease:
+                for name, on in list(self.relays.items()):
+                    if on:
+                        self.set_relay(name, False)
+                self.release()
+        except (OSError, RuntimeError, TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+
+def arbiter_available(path: str = GPIO_SOCK) -> bool:
+    """
+    Есть ли сокет арбитра. Только stat, как ser_broker.broker_available: пробное подключение регистрировало бы
+    у арбитра клиента-фантома (строка "отключился" и _release на каждый вызов). Сокет упавшего арбитра — ошибка connect.
+    """
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+# =====================[ CLI ]=====================
+def main():
+    p = argparse.ArgumentParser(description="GPIO arbiter: one process owns the pins, clients take a write lease")
+    p.add_argument("--sock", "-s", default=GPIO_SOCK, help="Unix socket path")
+    p.add_argument("--on-drop", choices=("off", "keep"), default="off",
+                   help="Relays when the lease holder disconnects without RELEASE (default: off)")
+    p.add_argument("--stats", action="store_true", help="Print stats of a running arbiter and exit")
+    args = p.parse_args()
+
+    if args.stats:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(2.0)
+            s.connect(args.sock)
+            s.sendall(b"#STATS\n")
+            line = s.makefile("rb").readline().decode()
+        print(json.dumps(json.loads(line), indent=2, ensure_ascii=False))
+        return
+
+    try:
+        GpioArbiter(args.sock, off_on_drop=args.on_drop == "off").serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
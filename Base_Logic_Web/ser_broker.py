@@ -0,0 +1,655 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Брокер serial-порта XY-стола (Arduino/RAMPS).
+
+Один процесс держит /dev/ttyACM0 открытым постоянно (без ресетов и ожидания баннера
+при каждом подключении), а клиенты — цикл, TouchDesk SERVICE, cnc_cli.py, testSP.py —
+ходят к нему через локальный Unix-сокет.
+
+Протокол (построчный, UTF-8):
+  клиент -> брокер:
+    <команда прошивки>   "G X10 Y5 F3000", "M114", "PING", ...
+    #NAME <имя>          имя клиента для статистики (без ответа)
+    #SUB / #UNSUB        подписка на «непрошенные» строки прошивки (без ответа)
+    #STATS               JSON со статистикой задержек по клиентам, затем "ok"
+  брокер -> клиент:
+    строки ответа на СВОЮ команду; последняя — ok... / err... / PONG
+    "* <строка>"         непрошенная строка прошивки (только подписчикам);
+                         кадры позиции "* @P x y bits" идут подписчикам всегда, даже во время чужой команды
+
+Команды разных клиентов выполняются строго по одной; очередь обходится по кругу
+(round-robin), так что болтливый клиент не задерживает остальных больше чем на одну команду.
+"""
+import os
+import sys
+import json
+import math
+import stat
+import time
+import socket
+import argparse
+import threading
+from collections import deque
+from typing import Optional
+
+try:
+    import serial
+except Exception:
+    serial = None
+
+# =====================[ КОНФИГ ]=====================
+BROKER_SOCK = os.getenv("SER_BROKER_SOCK", "/tmp/screw_xy.sock")
+SERIAL_PORT = "/dev/ttyACM0"
+SERIAL_BAUD = 115200              # стартовая скорость прошивки
+SERIAL_BAUD_FAST = 250000         # до какой скорости договариваемся (0 — не повышать)
+BAUD_CONFIRM_S = 2.0              # прошивка откатывается, если новая скорость не подтверждена PING
+LINK_ERR_MAX = 2                  # столько 'err NOISE' подряд — откат на SERIAL_BAUD
+SERIAL_TIMEOUT = 0.5
+CMD_TIMEOUT = 120.0               # самая долгая команда — G28/CAL
+POS_REPORT_HZ = 10                # автоотчёт позиции прошивки (M154), 0 — не включать
+
+
+# =====================[ ПОЗИЦИЯ ]=====================
+POS_BITS = {"x_min": 1, "y_min": 2, "moving": 4, "estop": 8, "homed": 16}
+
+def parse_pos_frame(s: str) -> Optional[tuple]:
+    """'@P 12.34 56.78 5' (или '* @P ...' от брокера) -> (x, y, bits); не кадр — None."""
+    if s.startswith("* "):
+        s = s[2:]
+    if not s.startswith("@P "):
+        return None
+    try:
+        _, x, y, bits = s.split()
+        return float(x), float(y), int(bits)
+    except ValueError:
+        return None
+
+
+class PositionCache:
+    """
+    Последняя известная позиция стола (прошивка шлёт кадры только в движении и один по остановке,
+    так что в покое age_ms растёт, а позиция остаётся верной). Без блокировок: запись — подмена кортежа
+    (x, y, bits, t_monotonic) одной ссылкой, чтение — взять ссылку; читатель никогда не видит
+    «половину» обновления и не ждёт писателя.
+    """
+    def __init__(self):
+        self._snap: Optional[tuple] = None
+
+    def update_from_line(self, s: str) -> bool:
+        frame = parse_pos_frame(s)
+        if frame is None:
+            return False
+        self._snap = frame + (time.monotonic(),)
+        return True
+
+    def get(self) -> Optional[tuple]:
+        return self._snap
+
+    def as_dict(self) -> Optional[dict]:
+        snap = self._snap
+        if snap is None:
+            return None
+        x, y, bits, t = snap
+        d = {"x": x, "y": y, "age_ms": int((time.monotonic() - t) * 1000)}
+        for k, b in POS_BITS.items():
+            d[k] = bool(bits & b)
+        return d
+
+
+def ts():
+    return time.strftime("%H:%M:%S")
+
+def is_final(line: str) -> bool:
+    """Строка, завершающая транзакцию команды."""
+    return line.startswith("ok") or line.startswith("err") or line == "PONG"
+
+def pct(sorted_vals: list, p: float) -> float:
+    """Перцентиль по уже отсортированному списку (nearest-rank: k = ceil(p/100 * n)); общий для бенчей."""
+    if not sorted_vals:
+        return 0.0
+    k = math.ceil(p * len(sorted_vals) / 100.0) - 1      # p*n/100, а не p/100*n: 7/100*100 = 7.000000000000001
+    return sorted_vals[max(0, min(len(sorted_vals) - 1, k))]
+
+
+# =====================[ СЕРВЕР ]=====================
+class _Client:
+    _ids = 0
+
+    def __init__(self, conn: socket.socket):
+        _Client._ids += 1
+        self.id = _Client._ids
+        self.name = f"client{self.id}"
+        self.conn = conn
+        self.alive = True
+        self.subscribed = False
+        self.queue: deque = deque()          # (cmd, t_enqueue)
+        self._wlock = threading.Lock()
+        # статистика: полная задержка (очередь + прошивка) и ожидание в очереди
+        self.n = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.wait_total_ms = 0.0
+
+    def send_line(self, s: str):
+        if not self.alive:
+            return
+        try:
+            with self._wlock:
+                self.conn.sendall((s + "\n").encode("utf-8", "ignore"))
+        except OSError:
+            self.alive = False
+
+    def account(self, wait_ms: float, total_ms: float):
+        self.n += 1
+        self.total_ms += total_ms
+        self.wait_total_ms += wait_ms
+        self.last_ms = total_ms
+        if total_ms > self.max_ms:
+            self.max_ms = total_ms
+
+    def stats(self) -> dict:
+        n = max(1, self.n)
+        return {
+            "id": self.id, "name": self.name, "n": self.n,
+            "avg_ms": round(self.total_ms / n, 2), "max_ms": round(self.max_ms, 2),
+            "last_ms": round(self.last_ms, 2), "wait_avg_ms": round(self.wait_total_ms / n, 2),
+            "queued": len(self.queue),
+        }
+
+
+class _Collector:
+    """Псевдо-клиент для служебных команд брокера (BAUD/PING): просто собирает строки."""
+    alive = True
+
+    def __init__(self):
+        self.lines: list[str] = []
+
+    def send_line(self, s: str):
+        self.lines.append(s)
+
+
+class _Txn:
+    """Команда «в полёте»: кому отдавать строки ответа и когда она завершится."""
+    def __init__(self, client: _Client, cmd: str):
+        self.client = client
+        self.cmd = cmd
+        self.done = threading.Event()
+
+
+class SerialBroker:
+    def __init__(self, port: str = SERIAL_PORT, baud: int = SERIAL_BAUD, sock_path: str = BROKER_SOCK,
+                 fast_baud: int = SERIAL_BAUD_FAST):
+        self.port = port
+        self.baud = baud
+        self.fast_baud = fast_baud if fast_baud != baud else 0
+        self.sock_path = sock_path
+        self.ser = None
+        self._fast_failed = False         # после отката повышенную скорость не пробуем до переоткрытия
+        self._noise = 0
+        self.pos_hz = POS_REPORT_HZ
+        self._pos_pending = True          # включить M154 после открытия порта / ресета платы
+        self.pos = PositionCache()
+        self._clients: list[_Client] = []
+        self._rr = 0
+        self._cv = threading.Condition()
+        self._cur: Optional[_Txn] = None
+        self._stop = threading.Event()
+        self._closing = threading.Event()  # планировщик возвращает скорость и выходит
+
+    # ---- serial
+    def _open_serial(self):
+        ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=SERIAL_TIMEOUT,
+                            write_timeout=SERIAL_TIMEOUT, rtscts=False, dsrdtr=False)
+        try:
+            ser.dtr = False
+            ser.rts = False
+        except Exception:
+            pass
+        self.ser = ser
+        self._fast_failed = False
+        self._noise = 0
+        self._pos_pending = True
+        print(f"[{ts()}] [broker] serial {self.port} @ {self.baud} открыт")
+
+    def _serial_loop(self):
+        while not self._stop.is_set():
+            if self.ser is None:
+                try:
+                    self._open_serial()
+                except Exception as e:
+                    print(f"[{ts()}] [broker] не удалось открыть {self.port}: {e}")
+                    time.sleep(1.0)
+                    continue
+            try:
+                raw = self.ser.readline()
+            except Exception as e:
+                print(f"[{ts()}] [broker] serial read error: {e} — переоткрываю порт")
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+                self.ser = None
+                self._fail_current("err SERIAL")
+                continue
+            s = raw.decode(errors="ignore").strip()
+            if s:
+                self._on_line(s)
+
+    def _on_line(self, s: str):
+        txn = self._cur
+        if self.pos.update_from_line(s):
+            # кадры автоотчёта не относятся ни к одной команде
+            self._broadcast(s)
+            return
+        if s.lower() == "ok ready":
+            # плата перезагрузилась: команда в полёте потеряна, автоотчёт выключен
+            self._pos_pending = True
+            self._broadcast(s)
+            self._fail_current("err RESET")
+            return
+        if txn is None:
+            self._broadcast(s)
+            return
+        if s == "err NOISE":
+            self._noise += 1
+        elif is_final(s):
+            self._noise = 0
+        txn.client.send_line(s)
+        if is_final(s):
+            txn.done.set()
+
+    def _fail_current(self, reason: str):
+        txn = self._cur
+        if txn is not None and not txn.done.is_set():
+            txn.client.send_line(reason)
+            txn.done.set()
+
+    def _broadcast(self, s: str):
+        with self._cv:
+            subs = [c for c in self._clients if c.subscribed]
+        for c in subs:
+            c.send_line("* " + s)
+
+    # ---- планировщик: одна команда за раз, клиенты по кругу
+    def _next_cmd(self):
+        with self._cv:
+            while not self._stop.is_set():
+                n = len(self._clients)
+                for i in range(n):
+                    c = self._clients[(self._rr + i) % n]
+                    if c.queue:
+                        self._rr = (self._rr + i + 1) % n
+                        cmd, t_enq = c.queue.popleft()
+                        return c, cmd, t_enq
+                # пустая очередь: раз в 0.5 с отдаём управление планировщику (обслуживание линии)
+                self._cv.wait(0.5)
+                if not any(c.queue for c in self._clients):
+                    return None
+        return None
+
+    # ---- служебные обмены (выполняются планировщиком между командами клиентов)
+    def _internal(self, cmd: str, timeout: float) -> list[str]:
+        col = _Collector()
+        txn = _Txn(col, cmd)
+        self._cur = txn
+        try:
+            self.ser.write((cmd + "\n").encode())
+            txn.done.wait(timeout)
+        except Exception:
+            pass
+        finally:
+            self._cur = None
+        return col.lines
+
+    def _set_baud(self, target: int) -> bool:
+        if self.ser.baudrate == target:
+            return True
+        if self._internal(f"BAUD {target}", 1.0)[-1:] != [f"ok BAUD {target}"]:
+            return False
+        time.sleep(0.01)
+        self.ser.baudrate = target
+        self.ser.reset_input_buffer()
+        for _ in range(3):
+            if self._internal("PING", 0.3)[-1:] == ["PONG"]:
+                return True
+        self.ser.baudrate = self.baud
+        time.sleep(BAUD_CONFIRM_S + 0.2)
+        self.ser.reset_input_buffer()
+        self._internal("PING", 0.5)
+        return False
+
+    def _fallback_baud(self):
+        """Вернуть линию на self.baud, даже если прошивка нас не слышит (мусор она сама считает помехой)."""
+        if self.ser is None or self.ser.baudrate == self.baud or self._set_baud(self.baud):
+            return
+        self.ser.baudrate = self.baud
+        self.ser.reset_input_buffer()
+        for _ in range(10):
+            if self._internal("PING", 0.3)[-1:] == ["PONG"]:
+                break
+
+    def _link_maintenance(self):
+        """Повышение скорости после открытия порта и откат, если на ней сыпятся помехи; включение M154."""
+        if self.ser is None:
+            return
+        if self._pos_pending and self.pos_hz:
+            out = self._internal(f"M154 S{self.pos_hz}", 1.0)
+            self._pos_pending = False
+            if out[-1:] != ["ok"]:
+                print(f"[{ts()}] [broker] прошивка не поддерживает M154 — позиция только по M114")
+        if not self.fast_baud:
+            return
+        if self._noise >= LINK_ERR_MAX and self.ser.baudrate != self.baud:
+            print(f"[{ts()}] [broker] помехи на {self.ser.baudrate} — откат на {self.baud}")
+            self._fast_failed = True
+            self._fallback_baud()
+            self._noise = 0
+        elif not self._fast_failed and self.ser.baudrate != self.fast_baud:
+            ok = self._set_baud(self.fast_baud)
+            self._fast_failed = not ok
+            print(f"[{ts()}] [broker] скорость {self.fast_baud}: {'подтверждена' if ok else 'не удалась, остаёмся на ' + str(self.baud)}")
+
+    def _scheduler_loop(self):
+        while not self._stop.is_set():
+            if self._closing.is_set():
+                # следующий, кто откроет порт напрямую (cycle, cnc_cli), ждёт прошивку на self.baud
+                self._fallback_baud()
+                return
+            self._link_maintenance()
+            item = self._next_cmd()
+            if item is None:
+                continue
+            client, cmd, t_enq = item
+            if self.ser is None:
+                client.send_line("err SERIAL")
+                continue
+            txn = _Txn(client, cmd)
+            t_start = time.monotonic()
+            self._cur = txn
+            try:
+                self.ser.write((cmd + "\n").encode())
+                if not txn.done.wait(CMD_TIMEOUT):
+                    client.send_line("err TIMEOUT")
+            except Exception as e:
+                client.send_line(f"err SERIAL {e}")
+            finally:
+                self._cur = None
+            t_end = time.monotonic()
+            client.account((t_start - t_enq) * 1000.0, (t_end - t_enq) * 1000.0)
+
+    # ---- клиенты
+    def _client_loop(self, client: _Client):
+        try:
+            rfile = client.conn.makefile("rb")
+            for raw in rfile:
+                s = raw.decode(errors="ignore").strip()
+                if not s:
+                    continue
+                if s.startswith("#"):
+                    self._meta(client, s)
+                    continue
+                with self._cv:
+                    client.queue.append((s, time.monotonic()))
+                    self._cv.notify()
+        except OSError:
+            pass
+        finally:
+            client.alive = False
+            with self._cv:
+                if client in self._clients:
+                    self._clients.remove(client)
+            try:
+                client.conn.close()
+            except Exception:
+                pass
+            print(f"[{ts()}] [broker] {client.name} отключился ({client.n} команд)")
+
+    def _meta(self, client: _Client, s: str):
+        cmd, _, arg = s[1:].partition(" ")
+        cmd = cmd.upper()
+        if cmd == "NAME" and arg:
+            client.name = arg.strip()
+        elif cmd == "SUB":
+            client.subscribed = True
+        elif cmd == "UNSUB":
+            client.subscribed = False
+        elif cmd == "STATS":
+            with self._cv:
+                data = {"port": self.port, "baud": getattr(self.ser, "baudrate", self.baud),
+                        "pos": self.pos.as_dict(),
+                        "clients": [c.stats() for c in self._clients]}
+            client.send_line(json.dumps(data))
+            client.send_line("ok")
+        else:
+            client.send_line("err UNKNOWN_META")
+
+    def _accept_loop(self, srv: socket.socket):
+        while not self._stop.is_set():
+            try:
+                conn, _ = srv.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            client = _Client(conn)
+            with self._cv:
+                self._clients.append(client)
+            threading.Thread(target=self._client_loop, args=(client,), daemon=True).start()
+
+    def serve_forever(self):
+        try:
+            os.unlink(self.sock_path)
+        except FileNotFoundError:
+            pass
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(self.sock_path)
+        os.chmod(self.sock_path, 0o666)
+        srv.listen(8)
+        srv.settimeout(0.5)
+        print(f"[{ts()}] [broker] LISTEN {self.sock_path}")
+
+        threading.Thread(target=self._serial_loop, daemon=True).start()
+        sched = threading.Thread(target=self._scheduler_loop, daemon=True)
+        sched.start()
+        try:
+            self._accept_loop(srv)
+        finally:
+            self._closing.set()
+            with self._cv:
+                self._cv.notify_all()
+            sched.join(BAUD_CONFIRM_S + 10.0)     # откат — это BAUD, PING и пауза подтверждения
+            self._stop.set()
+            srv.close()
+            try:
+                os.unlink(self.sock_path)
+            except FileNotFoundError:
+                pass
+            if self.ser:
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+
+
+# =====================[ КЛИЕНТ ]=====================
+class BrokerSerial:
+    """
+    Минимальная замена serial.Serial поверх сокета брокера:
+    write / read / readline / reset_input_buffer / reset_output_buffer / close.
+    Позволяет существующему коду (send_cmd, SerialReader, GLink в cnc_cli, ...) работать через брокер без изменений.
+    """
+    is_broker = True
+
+    def __init__(self, path: str = BROKER_SOCK, timeout: Optional[float] = SERIAL_TIMEOUT,
+                 name: Optional[str] = None, subscribe: bool = False):
+        self.timeout = timeout
+        self.port = path
+        self.dtr = False
+        self.rts = False
+        self._buf = bytearray()
+        self._sock: Optional[socket.socket] = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        if name:
+            self.write(f"#NAME {name}\n".encode())
+        if subscribe:
+            self.write(b"#SUB\n")
+
+    @property
+    def is_open(self) -> bool:
+        return self._sock is not None
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._buf)
+
+    def write(self, data: bytes) -> int:
+        if self._sock is None:
+            raise OSError("broker connection closed")
+        self._sock.sendall(data)
+        return len(data)
+
+    def read(self, n: int = 1) -> bytes:
+        """До n байт: из буфера, а если он пуст — один recv (не дольше timeout)."""
+        if not self._buf:
+            if self._sock is None:
+                raise OSError("broker connection closed")
+            self._sock.settimeout(self.timeout)
+            try:
+                chunk = self._sock.recv(4096)
+            except socket.timeout:
+                return b""
+            if not chunk:
+                raise OSError("broker connection closed")
+            self._buf += chunk
+        out = bytes(self._buf[:n])
+        del self._buf[:n]
+        return out
+
+    def readline(self) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            i = self._buf.find(b"\n")
+            if i >= 0:
+                line = bytes(self._buf[:i + 1])
+                del self._buf[:i + 1]
+                return line
+            if self._sock is None:
+                raise OSError("broker connection closed")
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return b""
+                self._sock.settimeout(left)
+            else:
+                self._sock.settimeout(None)
+            try:
+                chunk = self._sock.recv(4096)
+            except socket.timeout:
+                return b""
+            if not chunk:
+                raise OSError("broker connection closed")
+            self._buf += chunk
+
+    def reset_input_buffer(self):
+        self._buf.clear()
+        if self._sock is None:
+            return
+        self._sock.setblocking(False)
+        try:
+            while self._sock.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        finally:
+            self._sock.setblocking(True)
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+
+class PositionFollower(threading.Thread):
+    """
+    Фоновый подписчик брокера: держит PositionCache свежим по кадрам '* @P ...'
+    без единого запроса в порт. Если брокера нет — тихо переподключается раз в retry_s.
+    """
+    def __init__(self, path: str = BROKER_SOCK, name: str = "pos", retry_s: float = 2.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.name_ = name
+        self.retry_s = retry_s
+        self.cache = PositionCache()
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                bs = BrokerSerial(self.path, timeout=1.0, name=self.name_, subscribe=True)
+            except OSError:
+                self._stop.wait(self.retry_s)
+                continue
+            try:
+                while not self._stop.is_set():
+                    raw = bs.readline()
+                    if raw:
+                        self.cache.update_from_line(raw.decode(errors="ignore").strip())
+            except OSError:
+                pass
+            finally:
+                bs.close()
+
+    def stop(self):
+        self._stop.set()
+
+
+def broker_available(path: str = BROKER_SOCK) -> bool:
+    """
+    Есть ли сокет брокера. Только stat: пробное подключение регистрировало бы у брокера клиента-фантома
+    (и строку в логе) на каждый вызов. Сокет, оставшийся от упавшего брокера, проявится ошибкой connect.
+    """
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+# =====================[ CLI ]=====================
+def main():
+    p = argparse.ArgumentParser(description="Serial broker for the XY table (Unix-socket multiplexer)")
+    p.add_argument("--port", "-p", default=SERIAL_PORT, help="Serial port (e.g. /dev/ttyACM0)")
+    p.add_argument("--baud", "-b", type=int, default=SERIAL_BAUD, help="Initial baudrate (firmware default)")
+    p.add_argument("--fast-baud", type=int, default=SERIAL_BAUD_FAST,
+                   help=f"Negotiate this baudrate after open, 0 = keep --baud (default {SERIAL_BAUD_FAST})")
+    p.add_argument("--pos-hz", type=int, default=POS_REPORT_HZ,
+                   help=f"Firmware position auto-report rate (M154), 0 = off (default {POS_REPORT_HZ})")
+    p.add_argument("--sock", "-s", default=BROKER_SOCK, help="Unix socket path")
+    p.add_argument("--stats", action="store_true", help="Print latency stats of a running broker and exit")
+    args = p.parse_args()
+
+    if args.stats:
+        bs = BrokerSerial(args.sock, timeout=2.0)
+        bs.write(b"#STATS\n")
+        print(json.dumps(json.loads(bs.readline().decode()), indent=2, ensure_ascii=False))
+        bs.close()
+        return
+
+    if serial is None:
+        print("pyserial is not installed", file=sys.stderr)
+        sys.exit(2)
+    try:
+        broker = SerialBroker(args.port, args.baud, args.sock, args.fast_baud)
+        broker.pos_hz = args.pos_hz
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
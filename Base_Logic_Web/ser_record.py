@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Запись обмена с прошивкой XY-стола в компактный бинарный лог.
+
+Формат файла:
+  заголовок  MAGIC (8 байт) + время начала записи, unix-время в мкс ("<Q")
+  записи     "<BQH": направление (0 — TX, 1 — RX), мкс от начала записи (monotonic), длина строки;
+             затем сама строка (UTF-8, без '\\n')
+
+Включается переменной окружения SER_RECORD=/путь/к/файлу.sdxy (см. cycle_onefile.open_serial),
+читается и проигрывается ser_replay.py.
+"""
+import os
+import time
+import struct
+import threading
+from typing import Iterator, Optional
+
+MAGIC = b"SDXYREC1"
+HEADER = struct.Struct("<Q")
+RECORD = struct.Struct("<BQH")
+TX, RX = 0, 1
+
+SER_RECORD = os.getenv("SER_RECORD", "")
+
+
+class SerialRecorder:
+    """Пишет строки TX/RX с monotonic-метками; потокобезопасен, буферизован (flush — по close/каждые 64 КБ)."""
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, "wb", buffering=64 * 1024)
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic_ns()
+        self.n = 0
+        self._f.write(MAGIC + HEADER.pack(time.time_ns() // 1000))
+
+    def record(self, direction: int, line: str):
+        data = line.encode("utf-8", "replace")[:0xFFFF]
+        t_us = (time.monotonic_ns() - self._t0) // 1000
+        with self._lock:
+            if self._f is None:
+                return
+            self._f.write(RECORD.pack(direction, t_us, len(data)))
+            self._f.write(data)
+            self.n += 1
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+class RecordingSerial:
+    """
+    Обёртка над serial.Serial / BrokerSerial: всё, что ушло через write и пришло через readline,
+    попадает в SerialRecorder. Остальные атрибуты (baudrate, is_broker, reset_*...) — как у порта.
+    """
+    def __init__(self, ser, recorder: SerialRecorder):
+        self.__dict__["_ser"] = ser
+        self.__dict__["_rec"] = recorder
+
+    def write(self, data: bytes) -> int:
+        for line in data.decode("utf-8", "replace").splitlines():
+            if line:
+                self._rec.record(TX, line)
+        return self._ser.write(data)
+
+    def readline(self) -> bytes:
+        raw = self._ser.readline()
+        if raw:
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if line:
+                self._rec.record(RX, line)
+        return raw
+
+    def close(self):
+        try:
+            self._ser.close()
+        finally:
+            self._rec.close()
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._ser, name, value)
+
+
+def read_records(path: str) -> Iterator[tuple]:
+    """(направление, t_мкс, строка) по порядку записи. Обрезанный хвост (запись прервана) — молча конец."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: not a serial record (bad magic)")
+        f.read(HEADER.size)
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            direction, t_us, n = RECORD.unpack(head)
+            data = f.read(n)
+            if len(data) < n:
+                return
+            yield direction, t_us, data.decode("utf-8", "replace")
+
+
+def record_started_at(path: str) -> Optional[float]:
+    """Unix-время начала записи, с."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        (us,) = HEADER.unpack(f.read(HEADER.size))
+        return us / 1e6
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Просмотр и воспроизведение записей обмена с XY-столом (ser_record.py, SER_RECORD=...).
+
+  python3 ser_replay.py dump   session.sdxy              # текстом: время, направление, строка
+  python3 ser_replay.py replay session.sdxy --speed 1   # прогнать TX записи через FakeSerial
+  python3 ser_replay.py replay session.sdxy --speed 0   # без пауз: стоимость разбора на хосте
+
+FakeSerial ведёт себя как serial.Serial с прошивкой на том конце: после каждой TX-строки,
+совпавшей с записью, выдаёт записанные за ней RX-строки с теми же интервалами (делёнными на speed).
+Поэтому его можно подставить в send_cmd/_xfer/GLink и сравнить изменения парсера или протокола
+на реальном производственном трафике.
+"""
+import sys
+import time
+import argparse
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from ser_record import TX, RX, read_records, record_started_at
+from ser_broker import is_final, parse_pos_frame, pct
+
+
+class FakeSerial:
+    """
+    Serial-подобный порт, отвечающий по записи. speed: 1 — как в записи, 10 — в 10 раз быстрее,
+    0 — без пауз. TX, не совпавший с ожидаемой строкой, считается в mismatches, но ответы
+    всё равно выдаются (иначе одна правка протокола обрывает весь прогон).
+    """
+    def __init__(self, records: list, speed: float = 1.0, timeout: Optional[float] = 0.5):
+        self.timeout = timeout
+        self.speed = speed
+        self.baudrate = 115200
+        self.is_open = True
+        self.dtr = False
+        self.rts = False
+        self._recs = deque(records)
+        self._due: deque = deque()        # (monotonic когда выдать, строка)
+        self.tx_count = 0
+        self.mismatches: list = []
+        self._release_rx(time.monotonic(), 0)   # баннер и всё, что пришло до первой команды
+
+    @property
+    def in_waiting(self) -> int:
+        now = time.monotonic()
+        return sum(len(s) + 1 for t, s in self._due if t <= now)
+
+    @property
+    def exhausted(self) -> bool:
+        return not self._recs and not self._due
+
+    def _release_rx(self, t_now: float, t_ref_us: int):
+        """RX-записи до следующей TX становятся доступны со сдвигом от момента t_now."""
+        while self._recs and self._recs[0][0] == RX:
+            _, t_us, line = self._recs.popleft()
+            delay = 0.0 if self.speed <= 0 else max(0, t_us - t_ref_us) / 1e6 / self.speed
+            self._due.append((t_now + delay, line))
+
+    def write(self, data: bytes) -> int:
+        now = time.monotonic()
+        for line in data.decode("utf-8", "replace").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            self.tx_count += 1
+            # RX, которые ещё не забрали, остаются в очереди; ждём следующую TX из записи
+            if not self._recs:
+                self.mismatches.append((line, None))
+                continue
+            _, t_us, want = self._recs.popleft()
+            if line != want:
+                self.mismatches.append((line, want))
+            self._release_rx(now, t_us)
+        return len(data)
+
+    def readline(self) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            if self._due:
+                t, line = self._due[0]
+                if t <= now:
+                    self._due.popleft()
+                    return (line + "\n").encode()
+                wait = t - now
+            else:
+                wait = None
+            if deadline is not None:
+                left = deadline - now
+                if left <= 0:
+                    return b""
+                wait = left if wait is None else min(wait, left)
+            if wait is None:
+                return b""                # ответов больше не будет, а timeout=None — не виснем
+            time.sleep(wait)
+
+    def read(self, n: int = 1) -> bytes:
+        return self.readline()[:n] if n else b""
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def cmd_dump(path: str):
+    started = record_started_at(path)
+    if started:
+        print(f"# {path}: начало записи {datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S')}")
+    prev = None
+    for direction, t_us, line in read_records(path):
+        dt = "" if prev is None else f"+{(t_us - prev) / 1000:.1f}"
+        prev = t_us
+        print(f"{t_us / 1e6:12.6f} {dt:>10} {'>>' if direction == TX else '<<'} {line}")
+
+
+def cmd_replay(path: str, speed: float, timeout: float, verbose: bool):
+    """Клиент как в cycle_onefile._xfer: TX, затем строки до ok/err/PONG; кадры '@P' — мимо ответа."""
+    records = list(read_records(path))
+    commands = [line for d, _, line in records if d == TX]
+    fake = FakeSerial(records, speed=speed, timeout=timeout)
+    lat = []
+    frames = 0
+    lost = 0
+    t0 = time.perf_counter()
+    for cmd in commands:
+        t_cmd = time.perf_counter()
+        fake.write((cmd + "\n").encode())
+        while True:
+            s = fake.readline().decode(errors="ignore").strip()
+            if not s:
+                lost += 1                 # в записи ответа нет (обрыв/таймаут в проде)
+                break
+            if parse_pos_frame(s) is not None:
+                frames += 1
+                continue
+            if verbose:
+                print(f"<< {s}")
+            if is_final(s):
+                break
+        lat.append((time.perf_counter() - t_cmd) * 1000.0)
+    total = time.perf_counter() - t0
+    lat.sort()
+    print(f"{len(commands)} commands, {sum(1 for d, _, _ in records if d == RX)} rx lines "
+          f"({frames} position frames) in {total:.3f} s at speed {speed:g}")
+    if lat:
+        print(f"per-command ms: p50={pct(lat, 50):.2f} p95={pct(lat, 95):.2f} max={lat[-1]:.2f}")
+    if lost:
+        print(f"no final reply for {lost} commands")
+    if fake.mismatches:
+        print(f"{len(fake.mismatches)} TX mismatches, first: sent {fake.mismatches[0][0]!r}, "
+              f"recorded {fake.mismatches[0][1]!r}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Dump or replay an XY serial session recorded with SER_RECORD")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    d = sub.add_parser("dump", help="Print the record as text")
+    d.add_argument("file")
+    r = sub.add_parser("replay", help="Replay recorded traffic through FakeSerial")
+    r.add_argument("file")
+    r.add_argument("--speed", type=float, default=1.0, help="1 = original timing, 10 = 10x faster, 0 = no delays")
+    r.add_argument("--timeout", type=float, default=5.0, help="Per-line read timeout, s")
+    r.add_argument("--verbose", "-v", action="store_true", help="Print replies")
+    args = p.parse_args()
+    try:
+        if args.cmd == "dump":
+            cmd_dump(args.file)
+        else:
+            cmd_replay(args.file, args.speed, args.timeout, args.verbose)
+    except BrokenPipeError:
+        pass                              # dump | head
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
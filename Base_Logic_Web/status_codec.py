@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Компактный статус web_ui: /api/schema (имена, пины, порядок битов — меняется только с кодом) и
+/api/state (заголовок 45 байт + detail фазы вместо JSON со списками имён на каждом опросе).
+
+Раскладка state (little-endian, FORMAT 1):
+  B формат | B флаги (EXTERNAL, BUSY, IO, XY) | B индекс фазы (PHASE_UNKNOWN — нет в схеме) | B длина detail
+  I id схемы | I версия статуса | d момент изменения (unix) | d phase.since
+  I маска реле | I маска датчиков (бит i — i-й элемент списка схемы)
+  f x | f y | B биты кадра XY (как в ser_broker.POS_BITS)
+  затем detail фазы, utf-8.
+
+decode() возвращает тот же dict, что JSON /api/status (без phase.last_s и xy.age_ms), поэтому клиент
+подставляет его вместо req_get("status") без других правок. Не тот id схемы — SchemaMismatch: перечитать /api/schema.
+"""
+import json
+import time
+import zlib
+import struct
+
+FORMAT = 1
+PHASE_UNKNOWN = 0xFF
+F_EXTERNAL, F_BUSY, F_IO, F_XY = 1, 2, 4, 8
+
+_HEAD = struct.Struct("<BBBBIIddIIffB")
+CONTENT_TYPE = "application/x-screw-state"
+
+
+class SchemaMismatch(ValueError):
+    """Состояние закодировано другой схемой (web_ui обновился) — нужна свежая /api/schema."""
+
+
+def make_schema(relays: dict, sensors: dict, phases: list, xy_bits: dict) -> dict:
+    """relays/sensors: имя -> пин (порядок — порядок битов), xy_bits: имя флага -> бит кадра XY."""
+    if len(relays) > 32 or len(sensors) > 32:
+        raise ValueError("status_codec: at most 32 relays and 32 sensors")
+    body = {
+        "format": FORMAT,
+        "relays": [{"name": n, "pin": p} for n, p in relays.items()],
+        "sensors": [{"name": n, "pin": p} for n, p in sensors.items()],
+        "phases": list(phases),
+        "xy_bits": dict(xy_bits),
+    }
+    sid = zlib.crc32(json.dumps(body, sort_keys=True).encode())
+    return dict(body, id=sid)
+
+
+class StatusCodec:
+    def __init__(self, schema: dict):
+        if schema.get("format") != FORMAT:
+            raise ValueError(f"status_codec: unsupported format {schema.get('format')}")
+        self.schema = schema
+        self.id = schema["id"]
+        self.relay_names = [r["name"] for r in schema["relays"]]
+        self.sensor_names = [s["name"] for s in schema["sensors"]]
+        self.phases = schema["phases"]
+        self._phase_idx = {p: i for i, p in enumerate(self.phases)}
+        self.xy_bits = schema["xy_bits"]
+
+    def encode(self, state: dict, version: int, t: float) -> bytes:
+        relays = state.get("relays") or {}
+        sensors = state.get("sensors") or {}
+        ph = state.get("phase") or {}
+        xy = state.get("xy")
+        flags = ((F_EXTERNAL if state.get("external_running") else 0) | (F_BUSY if state.get("cycle_busy") else 0)
+                 | (F_IO if relays or sensors else 0) | (F_XY if xy else 0))
+        rmask = 0
+        for i, n in enumerate(self.relay_names):
+            if relays.get(n):
+                rmask |= 1 << i
+        smask = 0
+        for i, n in enumerate(self.sensor_names):
+            if sensors.get(n):
+                smask |= 1 << i
+        x = y = 0.0
+        xbits = 0
+        if xy:
+            x, y = xy["x"], xy["y"]
+            for k, b in self.xy_bits.items():
+                if xy.get(k):
+                    xbits |= b
+        detail = (ph.get("detail") or "").encode("utf-8")[:255]
+        return _HEAD.pack(FORMAT, flags, self._phase_idx.get(ph.get("name"), PHASE_UNKNOWN), len(detail),
+                          self.id, version, t, ph.get("since") or 0.0, rmask, smask, x, y, xbits) + detail
+
+    def decode(self, data: bytes) -> dict:
+        (fmt, flags, pidx, dlen, sid, version, t, since,
+         rmask, smask, x, y, xbits) = _HEAD.unpack_from(data)
+        if fmt != FORMAT:
+            raise ValueError(f"status_codec: unsupported format {fmt}")
+        if sid != self.id:
+            raise SchemaMismatch(f"state schema {sid:08x}, have {self.id:08x}")
+        io = bool(flags & F_IO)
+        xy = None
+        if flags & F_XY:
+            xy = {"x": round(x, 3), "y": round(y, 3)}
+            for k, b in self.xy_bits.items():
+                xy[k] = bool(xbits & b)
+        return {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)),
+            "version": version,
+            "relays": {n: bool(rmask >> i & 1) for i, n in enumerate(self.relay_names)} if io else {},
+            "sensors": {n: bool(smask >> i & 1) for i, n in enumerate(self.sensor_names)} if io else {},
+            "relay_names": self.relay_names,
+            "sensor_names": self.sensor_names,
+            "external_running": bool(flags & F_EXTERNAL),
+            "cycle_busy": bool(flags & F_BUSY),
+            "phase": {"name": self.phases[pidx] if pidx < len(self.phases) else None,
+                      "detail": data[_HEAD.size:_HEAD.size + dlen].decode("utf-8", "replace"),
+                      "since": round(since, 3)},
+            "xy": xy,
+        }
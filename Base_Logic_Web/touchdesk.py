@@ -6,7 +6,13 @@ if not os.environ.get("DISPLAY") and not os.environ.get("WAYLAND_DISPLAY"):
     os.environ.setdefault("QT_QPA_PLATFORM", "eglfs")
 import socket
 import os, sys, socket, re, time
+import json
+import queue
+import threading
+import http.client
 import requests
+from collections import deque
+from urllib.parse import urlsplit
 
 from functools import partial
 
@@ -16,7 +22,7 @@ from PyQt5.QtGui import QPixmap # type: ignore
 from PyQt5.QtWidgets import ( # type: ignore
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout,
     QTabWidget, QLabel, QPushButton, QFrame, QComboBox, QLineEdit,
-    QTextEdit, QSpinBox, QSizePolicy, QInputDialog
+    QPlainTextEdit, QSpinBox, QSizePolicy, QInputDialog
 )
 
 # --- GPIO (Raspberry Pi) ---
@@ -34,38 +40,27 @@ PEDAL_PULSE_MS = 120       # длительность импульса
 API_BASE = os.getenv("API_BASE", "http://127.0.0.1:8000/api")
 POLL_MS   = 1000
 BORDER_W  = 10
-
-def send_start_trigger(host="127.0.0.1", port=8765, payload=b"START\n", timeout=0.5) -> bool:
-    try:
-        with socket.create_connection((host, port), timeout=timeout) as s:
-            s.sendall(payload)
-            s.settimeout(timeout)
-            resp = s.recv(64)
-            return b"OK" in resp.upper()
-    except Exception:
-        return False
-
-def is_port_open(host="127.0.0.1", port=8765, timeout=0.3) -> bool:
-    try:
-        with socket.create_connection((host, port), timeout=timeout):
-            return True
-    except Exception:
-        return False
-
-def send_start_trigger_with_retry(host="127.0.0.1", port=8765, payload=b"START\n",
-                                  timeout=0.5, retries=15, delay=0.2) -> bool:
-    for _ in range(retries):
-        try:
-            with socket.create_connection((host, port), timeout=timeout) as s:
-                s.sendall(payload)
-                s.settimeout(timeout)
-                resp = s.recv(64)
-                if b"OK" in resp.upper():
-                    return True
-        except Exception:
-            pass
-        time.sleep(delay)
-    return False
+PERF_KEEP = 200            # столько последних замеров (опрос, отрисовка) в строке производительности SERVICE
+STREAM_RETRY_S = 10.0      # поток /api/stream недоступен — опрашиваем, поток пробуем снова через столько
+STREAM_READ_TIMEOUT_S = 15.0   # > STREAM_HEARTBEAT_S web_ui: тишина дольше — соединение мёртвое
+
+# Скорость Arduino: прошивка стартует на SERIAL_BAUD, быстрее — только после BAUD + PING
+SERIAL_BAUD    = 115200
+SERIAL_BAUDS   = (115200, 250000, 500000, 1000000)
+BAUD_CONFIRM_S = 2.0       # прошивка сама откатывается, если PING на новой скорости не пришёл
+LINK_ERR_MAX   = 2         # столько 'err NOISE' подряд — откат на SERIAL_BAUD
+SERIAL_BATCH_MS    = 50   # строки порта уходят в GUI пачкой не чаще, чем раз в столько мс,
+SERIAL_BATCH_LINES = 200  # ... или раньше, если набралось столько
+SERIAL_LOG_LINES   = 2000 # консоль SERVICE хранит и показывает не больше стольких последних строк
+
+# Компактный статус web_ui (/api/schema + /api/state) — тот же кодек, что на сервере
+import status_codec
+
+# Канал управления циклом (StartTrigger): одно постоянное соединение на всё приложение, с переподключением
+from trigger_link import TriggerLink
+PEDAL_ACK_TIMEOUT_S = 3.0  # столько ждём подтверждения START (включая подъём слушателя после запуска цикла)
+PEDAL_DEBOUNCE_MS = 300    # повторное нажатие раньше этого после ответа — дребезг/двойной тап, игнорируется
+trigger = TriggerLink()
 
 # ================== HTTP ==================
 def get_local_ip() -> str:
@@ -78,15 +73,22 @@ def get_local_ip() -> str:
     except Exception:
         return "Unknown"
 
-def req_get(path: str):
+# http — requests.Session (keep-alive); сессия на поток: GUI и StatusWorker держат каждый свою
+def req_get(path: str, http=None):
     url = f"{API_BASE}/{path.lstrip('/')}"
-    r = requests.get(url, timeout=3)
+    r = (http or requests).get(url, timeout=3)
     r.raise_for_status()
     return r.json()
 
-def req_post(path: str, payload=None):
+def req_get_bytes(path: str, http=None) -> bytes:
     url = f"{API_BASE}/{path.lstrip('/')}"
-    r = requests.post(url, json=payload or {}, timeout=5)
+    r = (http or requests).get(url, timeout=3)
+    r.raise_for_status()
+    return r.content
+
+def req_post(path: str, payload=None, http=None):
+    url = f"{API_BASE}/{path.lstrip('/')}"
+    r = (http or requests).post(url, json=payload or {}, timeout=5)
     r.raise_for_status()
     return r.json()
 
@@ -121,20 +123,48 @@ def gpio_cleanup():
 
 
 class ApiClient:
-    def status(self):           return req_get("status")
-    def ext_start(self):        return req_post("ext/start")
-    def ext_stop(self):         return req_post("ext/stop")
+    def __init__(self, http=None):
+        self.http = http if http is not None else requests.Session()
+        self._codec = None         # StatusCodec по /api/schema; None — ещё не загружена
+        self._compact = True       # False — web_ui без /api/state, читаем JSON
+
+    def status(self):
+        """Статус как JSON /api/status, но по компактному /api/state; старый web_ui (404) — JSON."""
+        if self._compact:
+            try:
+                return self.state()
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                self._compact = False
+        return req_get("status", self.http)
+
+    def state(self):
+        data = req_get_bytes("state", self.http)
+        if self._codec is None:
+            self._codec = status_codec.StatusCodec(req_get("schema", self.http))
+        try:
+            return self._codec.decode(data)
+        except status_codec.SchemaMismatch:
+            self._codec = status_codec.StatusCodec(req_get("schema", self.http))   # web_ui перезапущен с другой схемой
+            return self._codec.decode(data)
+
+    def ext_start(self):        return req_post("ext/start", http=self.http)
+    def ext_stop(self):         return req_post("ext/stop", http=self.http)
     def relay(self, name, action, ms=None):
         data = {"name": name, "action": action}
         if action == "pulse" and ms:
             data["ms"] = int(ms)
-        return req_post("relay", data)
+        return req_post("relay", data, self.http)
+    def sequence(self, steps, cleanup=True):
+        """Программа реле/датчиков выполняется на сервере одним запросом (/api/sequence), ответ — трасса шагов."""
+        return req_post("sequence", {"steps": steps, "cleanup": cleanup}, self.http)
 
     # --- NEW: pedal emulation (safe fallbacks) ---
     def pedal(self, relay_name="PEDAL", pulse_ms=120):
         try:
             # если сервер поддерживает прямой эндпоинт
-            return req_post("pedal", {"ms": pulse_ms})
+            return req_post("pedal", {"ms": pulse_ms}, self.http)
         except Exception:
             # Fallback: реле PEDAL импульсом
             return self.relay(relay_name, "pulse", pulse_ms)
@@ -142,11 +172,179 @@ class ApiClient:
     # --- NEW: stop script (optional endpoint; fallback to ext_stop) ---
     def script_stop(self):
         try:
-            return req_post("script/stop", {})
+            return req_post("script/stop", {}, self.http)
         except Exception:
             return self.ext_stop()
 
 
+def apply_delta(state: dict, delta: dict) -> dict:
+    """Новый статус = state + дельта /api/stream (как applyDelta на странице web_ui); state не меняется."""
+    out = dict(state)
+    replace = delta.get("_replace", ())
+    for k, v in delta.items():
+        if k == "_replace":
+            continue
+        out[k] = dict(out.get(k) or {}, **v) if isinstance(v, dict) and k not in replace else v
+    return out
+
+
+class StatusWorker(QThread):
+    """
+    Статус вне GUI-потока. Основной режим — подписка на /api/stream (SSE): снимок, затем дельты по
+    событию на сервере, поэтому рамка и подсветка меняются сразу, а без изменений ничего не приходит и
+    не перерисовывается. Нет потока (старый web_ui, 503 — нет мест) — опрос раз в POLL_MS по своей
+    keep-alive сессии, сигнал только при новой версии (и на первом успехе после ошибки опроса — чтобы
+    снять «alarm»); поток пробуется снова через STREAM_RETRY_S.
+    Пока GUI не забрал прошлый результат (take()), новый только подменяет его: медленная отрисовка
+    не копит очередь сигналов. kick() — внеочередной опрос в режиме опроса.
+    """
+    ready  = Signal()
+    failed = Signal(str)
+
+    def __init__(self, interval_ms: int = POLL_MS):
+        super().__init__()
+        self.api = ApiClient(requests.Session())
+        self.interval = interval_ms / 1000.0
+        self.mode = "poll"         # "stream" | "poll"
+        self._kick = threading.Event()
+        self._lock = threading.Lock()
+        self._latest = None
+        self._stop = False
+        self._sock = None          # сокет потока /api/stream (stop() его рвёт)
+        self._version = None
+        self.fetch_ms = deque(maxlen=PERF_KEEP)
+        self.coalesced = 0         # результатов, подменённых до того, как GUI их забрал
+
+    def kick(self):
+        self._kick.set()
+
+    def take(self):
+        with self._lock:
+            st, self._latest = self._latest, None
+        return st
+
+    def _deliver(self, st: dict):
+        with self._lock:
+            fresh = self._latest is None
+            if not fresh:
+                self.coalesced += 1
+            self._latest = st
+        if fresh:
+            self.ready.emit()
+
+    def run(self):
+        t_stream = 0.0
+        while not self._stop:
+            if time.monotonic() >= t_stream:
+                try:
+                    self._stream()                 # вернулся — сервер закрыл поток (STREAM_MAX_S): сразу снова
+                    continue
+                except Exception:
+                    self.mode = "poll"
+                    t_stream = time.monotonic() + STREAM_RETRY_S
+                if self._stop:
+                    break
+            self._kick.clear()
+            t0 = time.perf_counter()
+            try:
+                st = self.api.status()
+            except Exception as e:
+                self._version = None           # первый успех после ошибки доставить, даже с той же версией
+                if not self._stop:
+                    self.failed.emit(str(e))
+            else:
+                self.fetch_ms.append((time.perf_counter() - t0) * 1000.0)
+                if st.get("version") is None or st.get("version") != self._version:
+                    self._version = st.get("version")
+                    self._deliver(st)
+            self._kick.wait(self.interval)
+
+    def _stream(self):
+        """Читать /api/stream, пока сервер не закроет; ошибка соединения — исключение (переход на опрос)."""
+        u = urlsplit(API_BASE)
+        conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=STREAM_READ_TIMEOUT_S)
+        try:
+            conn.connect()
+            self._sock = conn.sock     # после ответа с Connection: close http.client отдаёт сокет ответу
+            headers = {"Accept": "text/event-stream"}
+            if self._version:
+                headers["Last-Event-ID"] = str(self._version)
+            conn.request("GET", u.path.rstrip("/") + "/stream", headers=headers)
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise RuntimeError(f"/api/stream: HTTP {resp.status}")
+            self.mode = "stream"
+            state, event, data, eid = None, None, [], None
+            while not self._stop:
+                raw = resp.readline()
+                if not raw:
+                    return
+                line = raw.decode("utf-8", "replace").rstrip("\r\n")
+                if line:
+                    field, _, value = line.partition(":")
+                    value = value[1:] if value.startswith(" ") else value
+                    if field == "event":
+                        event = value
+                    elif field == "data":
+                        data.append(value)
+                    elif field == "id":
+                        eid = value
+                    continue
+                if event == "busy":                            # мест нет (гонка с 503) — на опрос
+                    raise RuntimeError("/api/stream: busy")
+                if data and event in ("snapshot", "delta"):    # пустая строка — конец события
+                    doc = json.loads("\n".join(data))
+                    if event == "snapshot":
+                        state = doc
+                    elif state is not None:
+                        state = apply_delta(state, doc)
+                    if state is not None:
+                        self._version = int(eid) if eid else self._version
+                        self._deliver(dict(state, version=self._version))
+                event, data, eid = None, [], None
+        finally:
+            self._sock = None
+            conn.close()
+
+    def stop(self):
+        self._stop = True
+        self._kick.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)        # разбудить readline потока
+            except OSError:
+                pass
+        self.wait(4000)
+
+
+class PedalWorker(QThread):
+    """START в цикл вне GUI-потока (TriggerLink ждёт подтверждения до PEDAL_ACK_TIMEOUT_S)."""
+    acked = Signal(bool, str, float)     # ok, данные/причина, нажатие -> ответ, мс
+
+    def __init__(self):
+        super().__init__()
+        self._q = queue.Queue()
+
+    def submit(self, t_tap: float):
+        self._q.put(t_tap)
+
+    def run(self):
+        while True:
+            t_tap = self._q.get()
+            if t_tap is None:
+                return
+            try:
+                ok, data, _ = trigger.start(PEDAL_ACK_TIMEOUT_S)
+            except Exception as e:
+                ok, data = False, str(e)
+            self.acked.emit(ok, data, (time.perf_counter() - t_tap) * 1000.0)
+
+    def stop(self):
+        self._q.put(None)
+        self.wait(int(PEDAL_ACK_TIMEOUT_S * 1000) + 500)
+
+
 # ================== Serial ==================
 try:
     import serial, serial.tools.list_ports as list_ports
@@ -154,34 +352,85 @@ except Exception:
     serial = None
     list_ports = None
 
+# Брокер serial-порта: если запущен, консоль подключается через него и не отбирает порт у цикла
+try:
+    from ser_broker import BrokerSerial, BROKER_SOCK, broker_available, parse_pos_frame, POS_BITS
+except Exception:
+    BrokerSerial = None
+    parse_pos_frame = lambda s: None
+    POS_BITS = {}
+
 class SerialReader(QThread):
+    """
+    Строки порта копятся в потоке чтения и уходят в GUI одним сигналом lines (пачка раз в
+    SERIAL_BATCH_MS или по SERIAL_BATCH_LINES): болтливая прошивка не забивает очередь событий.
+    line — разовые сообщения (open/close/write). Открытие и закрытие порта тоже делает поток чтения:
+    откат скорости при закрытии — секунды, GUI на это время не замирает.
+    """
     line   = Signal(str)
+    lines  = Signal(list)
     opened = Signal(bool)
+    pos    = Signal(dict)      # кадр автоотчёта "@P x y bits" — в метку, а не в лог
 
     def __init__(self):
         super().__init__()
         self._ser  = None
         self._stop = False
+        self._want_baud = 0        # на какую скорость перейти (делает run(), чтобы не делить readline)
+        self._noise = 0
+        self._buf: list = []       # пачка для lines; трогает только run()
+        self._flush_at = 0.0
+        self._cmds: list = []      # ("open", port, baud) / ("close",) из GUI; выполняет run() по порядку
 
     def open(self, port: str, baud: int):
+        self._post(("open", port, baud))
+
+    def close(self):
+        self._post(("close",))
+
+    def _post(self, cmd: tuple):
+        self._cmds.append(cmd)
+        self._stop = False
+        if not self.isRunning():
+            self.start()
+
+    def _command(self, cmd: tuple):
+        # прежний порт закрыть до открытия нового: это может быть тот же порт
+        self._release()
+        if cmd[0] == "open":
+            self._open(cmd[1], cmd[2])
+        else:
+            self.opened.emit(False)
+
+    def _open(self, port: str, baud: int):
+        if BrokerSerial is not None and port == BROKER_SOCK:
+            try:
+                self._ser = BrokerSerial(port, timeout=0.1, name="touchdesk", subscribe=True)
+                self.opened.emit(True)
+                self.line.emit(f"[OPEN] broker {port}")
+                return True
+            except Exception as e:
+                self._ser = None
+                self.opened.emit(False)
+                self.line.emit(f"[ERROR] broker {port}: {e}")
+                return False
         if serial is None:
             self.line.emit("pyserial is not installed")
             self.opened.emit(False)
             return False
-        self.close()
         try:
-            self._ser = serial.Serial(port=port, baudrate=baud, timeout=0.1, rtscts=False, dsrdtr=False)
+            # прошивка после старта всегда на SERIAL_BAUD; выбранную скорость согласуем в run()
+            self._ser = serial.Serial(port=port, baudrate=SERIAL_BAUD, timeout=0.1, rtscts=False, dsrdtr=False)
             # Явно опускаем линии, как ты просил раньше
             try:
                 self._ser.dtr = False
                 self._ser.rts = False
             except Exception:
                 pass
-            self._stop = False
-            if not self.isRunning():
-                self.start()
+            self._noise = 0
+            self._want_baud = baud if baud != SERIAL_BAUD else 0
             self.opened.emit(True)
-            self.line.emit(f"[OPEN] {port} @ {baud}")
+            self.line.emit(f"[OPEN] {port} @ {SERIAL_BAUD}")
             return True
         except Exception as e:
             self._ser = None
@@ -189,12 +438,16 @@ class SerialReader(QThread):
             self.line.emit(f"[ERROR] open {port}: {e}")
             return False
 
-    def close(self):
-        if self._ser:
-            try: self._ser.close()
+    def _release(self):
+        ser, self._ser = self._ser, None
+        if ser:
+            # прошивка остаётся на выбранной скорости: вернуть SERIAL_BAUD, иначе следующий, кто
+            # откроет порт (цикл, консоль), не дождётся от неё READY/PONG
+            if not getattr(ser, "is_broker", False) and getattr(ser, "baudrate", SERIAL_BAUD) != SERIAL_BAUD:
+                try: self._fallback_baud(ser)
+                except Exception: pass
+            try: ser.close()
             except Exception: pass
-        self._ser = None
-        self.opened.emit(False)
 
     def write(self, text: str):
         if self._ser:
@@ -204,27 +457,186 @@ class SerialReader(QThread):
             except Exception as e:
                 self.line.emit(f"[ERROR] write: {e}")
 
+    def _wait_for(self, ser, want: str, timeout: float) -> bool:
+        """Читать строки до want (остальные — в лог), не дольше timeout."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = ser.readline()
+            if not data:
+                continue
+            s = data.decode("utf-8", "ignore").strip()
+            if s == want:
+                return True
+            if s:
+                self._push(s)
+        return False
+
+    def _push(self, s: str):
+        if not self._buf:
+            self._flush_at = time.monotonic() + SERIAL_BATCH_MS / 1000.0
+        self._buf.append(s)
+
+    def _flush(self):
+        if self._buf and (len(self._buf) >= SERIAL_BATCH_LINES or time.monotonic() >= self._flush_at):
+            batch, self._buf = self._buf, []
+            self.lines.emit(batch)
+
+    def _set_baud(self, ser, target: int) -> bool:
+        """BAUD target -> 'ok BAUD target' -> переключить порт -> PING/PONG; без PONG — назад."""
+        if ser.baudrate == target:
+            return True
+        ser.write(f"BAUD {target}\n".encode())
+        if not self._wait_for(ser, f"ok BAUD {target}", 1.0):
+            return False
+        time.sleep(0.01)
+        ser.baudrate = target
+        ser.reset_input_buffer()
+        for _ in range(3):
+            ser.write(b"PING\n")
+            if self._wait_for(ser, "PONG", 0.3):
+                return True
+        ser.baudrate = SERIAL_BAUD
+        time.sleep(BAUD_CONFIRM_S + 0.2)
+        ser.reset_input_buffer()
+        return False
+
+    def _fallback_baud(self, ser):
+        """Вернуться на SERIAL_BAUD, даже если прошивка нас не слышит (мусор она сама считает помехой)."""
+        if self._set_baud(ser, SERIAL_BAUD):
+            return
+        ser.baudrate = SERIAL_BAUD
+        ser.reset_input_buffer()
+        for _ in range(10):
+            ser.write(b"PING\n")
+            if self._wait_for(ser, "PONG", 0.3):
+                return
+
+    def _link_step(self, ser):
+        want, self._want_baud = self._want_baud, 0
+        if want:
+            t0 = time.perf_counter()
+            if self._set_baud(ser, want):
+                self._push(f"[BAUD] {want} подтверждена за {(time.perf_counter() - t0) * 1000:.0f} ms")
+            else:
+                self._push(f"[BAUD] {want} не подтверждена — остаёмся на {ser.baudrate}")
+        elif self._noise >= LINK_ERR_MAX and getattr(ser, "baudrate", SERIAL_BAUD) != SERIAL_BAUD:
+            self._push(f"[BAUD] помехи на {ser.baudrate} — откат на {SERIAL_BAUD}")
+            self._noise = 0
+            self._fallback_baud(ser)
+
+    def _read_one(self, ser):
+        if self._want_baud or self._noise >= LINK_ERR_MAX:
+            self._link_step(ser)
+        data = ser.readline()
+        if not data:
+            return
+        try:  s = data.decode("utf-8", "ignore").rstrip()
+        except Exception: s = repr(data)
+        frame = parse_pos_frame(s)
+        if frame is not None:
+            x, y, bits = frame
+            self.pos.emit({"x": x, "y": y, **{k: bool(bits & b) for k, b in POS_BITS.items()}})
+            return
+        if s == "err NOISE":
+            self._noise += 1
+        elif s.startswith("ok"):
+            self._noise = 0
+        self._push(s)
+
     def run(self):
         while not self._stop:
-            if self._ser:
-                try:
-                    data = self._ser.readline()
-                    if data:
-                        try:  s = data.decode("utf-8", "ignore").rstrip()
-                        except Exception: s = repr(data)
-                        self.line.emit(s)
-                except Exception as e:
-                    self.line.emit(f"[ERROR] read: {e}")
-                    time.sleep(0.2)
-            else:
+            while self._cmds:
+                self._command(self._cmds.pop(0))
+            self._flush()          # readline ждёт не дольше timeout=0.1, так что одиночная строка не залёживается
+            ser = self._ser
+            if ser is None:
                 time.sleep(0.1)
+                continue
+            try:
+                self._read_one(ser)
+            except Exception as e:
+                self._push(f"[ERROR] read: {e}")
+                time.sleep(0.2)
+        self._release()
+        if self._buf:
+            batch, self._buf = self._buf, []
+            self.lines.emit(batch)
 
     def stop(self):
+        """Остановить поток; порт (с откатом скорости) он закроет сам — ждём его."""
         self._stop = True
-        self.wait(1000)
-        self.close()
+        self.wait()
 
 # ================== UI helpers ==================
+class ViewCache:
+    """
+    Последнее отрисованное значение каждого виджета: render() вызывает text/prop/enabled на каждом тике,
+    а Qt трогается только при изменении. Особенно prop — смена свойства требует unpolish/polish (пересчёт QSS),
+    на eglfs это самое дорогое в отрисовке. touched/skipped — для строки производительности SERVICE.
+    """
+    def __init__(self):
+        self._last: dict = {}      # (виджет, что) -> значение
+        self.touched = 0
+        self.skipped = 0
+
+    def _changed(self, w, what: str, value) -> bool:
+        key = (w, what)
+        if key in self._last and self._last[key] == value:
+            self.skipped += 1
+            return False
+        self._last[key] = value
+        self.touched += 1
+        return True
+
+    def text(self, w, s: str):
+        if self._changed(w, "text", s):
+            w.setText(s)
+
+    def enabled(self, w, on: bool):
+        if self._changed(w, "enabled", on):
+            w.setEnabled(on)
+
+    def prop(self, w, name: str, value):
+        if self._changed(w, "prop:" + name, value):
+            w.setProperty(name, value)
+            w.style().unpolish(w); w.style().polish(w)
+
+    def object_name(self, w, name: str):
+        if self._changed(w, "objectName", name):
+            w.setObjectName(name)
+            w.style().unpolish(w); w.style().polish(w)
+
+    def forget(self, widgets):
+        """Виджеты удалены (перестройка сетки) — забыть их значения."""
+        gone = set(widgets)
+        self._last = {k: v for k, v in self._last.items() if k[0] not in gone}
+
+view = ViewCache()
+
+def format_xy(xy) -> str:
+    """Строка позиции стола из status['xy'] (кадры автоотчёта прошивки)."""
+    if not xy:
+        return "XY: —"
+    flags = [k.upper() for k in ("moving", "x_min", "y_min", "estop") if xy.get(k)]
+    if not xy.get("homed"):
+        flags.append("NOT HOMED")
+    return f"XY: {xy['x']:.2f} / {xy['y']:.2f} mm" + (f"  [{' '.join(flags)}]" if flags else "")
+
+def format_perf(title: str, vals) -> str:
+    """'fetch 12.3/48.0 ms' — p50/max последних замеров."""
+    v = sorted(vals)
+    if not v:
+        return f"{title} —"
+    return f"{title} {v[len(v) // 2]:.1f}/{v[-1]:.1f} ms"
+
+def format_phase(st: dict) -> str:
+    """Фаза внешнего процесса (status['phase']): ' (homing)', ' (ready)'...; пусто, если процесса нет (кроме остановки по отказу)."""
+    ph = st.get("phase") or {}
+    name = ph.get("name")
+    if not name or (name == "stopped" and not (ph.get("detail") or "").startswith("failed")):
+        return ""
+    return f" ({name}: {ph['detail']})" if ph.get("detail") else f" ({name})"
+
 def make_card(title: str) -> QFrame:
     box = QFrame(); box.setObjectName("card")
     lay = QVBoxLayout(box); lay.setContentsMargins(16, 16, 16, 16); lay.setSpacing(10)
@@ -261,49 +673,54 @@ class WorkTab(QWidget):
         self.stateLabel = QLabel("Status: unknown"); self.stateLabel.setObjectName("state")
         root.addWidget(self.stateLabel, 0, Qt.AlignLeft)
 
+        self.xyLabel = QLabel("XY: —"); self.xyLabel.setObjectName("muted")
+        root.addWidget(self.xyLabel, 0, Qt.AlignLeft)
+
         self.btnPedal.clicked.connect(self.on_pedal)
         self.btnKill.clicked.connect(self.on_kill)
+        self.t_press = None        # perf_counter нажатия: MainWindow меряет нажатие -> cycle_busy на экране
+        self.ack_ms = deque(maxlen=PERF_KEEP)    # нажатие -> подтверждение START циклом
+        self.taps_ignored = 0
+        self._running = False      # из последнего статуса: без программы START не шлём
+        self._pending = False
+        self._t_ack = 0.0
+        self.pedal = PedalWorker()
+        self.pedal.acked.connect(self.on_ack)
+        self.pedal.start()
 
     def on_pedal(self):
-        try:
-            # Проверим, запущен ли внешний процесс — чтобы не жать в пустоту
-            running = False
-            try:
-                st0 = self.api.status()
-                running = bool(st0.get("external_running"))
-            except Exception:
-                pass
-
-            if not running:
-                self.stateLabel.setText(
-                'The script is not running. First, click "Start program" on the "Start" tab.'
-                )
-                return
-
-            # Убедимся, что listener поднят (порт 8765). Если нет — пару секунд подождём.
-            t0 = time.time()
-            while not is_port_open() and time.time() - t0 < 3.0:
-                QApplication.processEvents()
-                time.sleep(0.1)
-
-            ok = send_start_trigger_with_retry()
-            if ok:
-                self.stateLabel.setText("START command sent (pedal emulation).")
-            else:
-                self.stateLabel.setText("Failed to send START (no response from loop).")
-
-            # Обновим статус для подсветки кнопок
-            try:
-                st = self.api.status()
-                self.render(st)
-            except Exception:
-                pass
-
-        except Exception as e:
-            self.stateLabel.setText(f"Error sending START: {e}")
-
-
+        """
+        START уходит в PedalWorker, кнопка сразу показывает «отправлено»; подтверждение — on_ack.
+        Пока START в пути и PEDAL_DEBOUNCE_MS после ответа повторные нажатия игнорируются.
+        """
+        now = time.perf_counter()
+        if self._pending or (now - self._t_ack) * 1000.0 < PEDAL_DEBOUNCE_MS:
+            self.taps_ignored += 1
+            return
+        if not self._running:
+            view.text(self.stateLabel, 'The script is not running. First, click "Start program" on the "Start" tab.')
+            return
+        self.t_press = now
+        self._set_pending(True)
+        view.text(self.stateLabel, "START sent (pedal emulation)…")
+        self.pedal.submit(now)
+
+    def on_ack(self, ok: bool, data: str, tap_ms: float):
+        self._t_ack = time.perf_counter()
+        self._set_pending(False)
+        if ok:
+            self.ack_ms.append(tap_ms)
+            view.text(self.stateLabel, f"START accepted (pedal emulation), ack {tap_ms:.1f} ms.")
+            return
+        self.t_press = None
+        if data in ("NO_LINK", "TIMEOUT"):
+            view.text(self.stateLabel, "Failed to send START (no response from loop).")
+        else:
+            view.text(self.stateLabel, f"START rejected by the loop: {data}")
 
+    def _set_pending(self, on: bool):
+        self._pending = on
+        view.prop(self.btnPedal, "pending", on)
 
     def on_kill(self):
         try:
@@ -311,22 +728,23 @@ class WorkTab(QWidget):
             st = self.api.ext_stop()
             self.render(st)
         except Exception as e:
-            self.stateLabel.setText(f"Stop error: {e}")
+            view.text(self.stateLabel, f"Stop error: {e}")
 
     def render(self, st: dict):
         running = bool(st.get("external_running"))
-        self.stateLabel.setText("Status: " + ("PROGRAM RUNNING" if running else "PROGRAM STOPPED"))
+        self._running = running
+        if not self._pending:      # «START sent…» не перетираем до ответа
+            view.text(self.stateLabel,
+                      "Status: " + ("PROGRAM RUNNING" if running else "PROGRAM STOPPED") + format_phase(st))
+        view.text(self.xyLabel, format_xy(st.get("xy")))
 
         # === НОВОЕ: подсветка «Эмуляции педали», пока цикл ЗАНЯТ между нажатиями ===
         busy = bool(st.get("cycle_busy"))
         # когда busy=True — делаем кнопку зелёной
-        self.btnPedal.setProperty("ok", busy)
+        view.prop(self.btnPedal, "ok", busy)
 
         # актуальность «Стоп скрипта» как раньше
-        self.btnKill.setProperty("ok", running)
-
-        for w in (self.btnPedal, self.btnKill):
-            w.style().unpolish(w); w.style().polish(w)
+        view.prop(self.btnKill, "ok", running)
 
 
 
@@ -507,6 +925,7 @@ class ServiceTab(QWidget):
         super().__init__(parent)
         self.api = api
         self._relay_widgets = {}  # name -> (lblState, spin, btnOn, btnOff, btnPulse)
+        self._sensor_widgets = {}  # name -> QLabel значения
 
         root = QHBoxLayout(self); root.setContentsMargins(24,24,24,24); root.setSpacing(18)
 
@@ -523,6 +942,9 @@ class ServiceTab(QWidget):
         self.relaysCard.layout().addLayout(self.relaysGrid)
         left.addWidget(self.relaysCard, 1)
 
+        self.perfLabel = QLabel("UI: —"); self.perfLabel.setObjectName("muted")
+        left.addWidget(self.perfLabel)
+
         # Правая колонка — Serial
         right = QVBoxLayout(); right.setSpacing(18)
         self.serialCard = make_card("Arduino Serial")
@@ -530,7 +952,7 @@ class ServiceTab(QWidget):
 
         top = QHBoxLayout()
         self.cbPort = QComboBox(); self.cbBaud = QComboBox()
-        for b in (9600, 115200, 230400): self.cbBaud.addItem(str(b))
+        for b in SERIAL_BAUDS: self.cbBaud.addItem(str(b))
         self.btnRefresh = QPushButton("Refresh")
         self.btnOpen = QPushButton("Open")
         self.btnClose = QPushButton("Close")
@@ -539,8 +961,27 @@ class ServiceTab(QWidget):
         top.addWidget(self.btnRefresh); top.addWidget(self.btnOpen); top.addWidget(self.btnClose)
         sc.addLayout(top)
 
-        self.txtLog = QTextEdit(); self.txtLog.setReadOnly(True); self.txtLog.setMinimumHeight(240)
+        self.xyLabel = QLabel("XY: —"); self.xyLabel.setObjectName("muted")
+        sc.addWidget(self.xyLabel)
+
+        logbar = QHBoxLayout()
+        self.edFilter = QLineEdit(); self.edFilter.setPlaceholderText("Filter")
+        self.btnPause = QPushButton("Pause"); self.btnPause.setCheckable(True)
+        self.btnClearLog = QPushButton("Clear")
+        self.rateLabel = QLabel("0 lines/s"); self.rateLabel.setObjectName("muted")
+        logbar.addWidget(self.edFilter, 1); logbar.addWidget(self.btnPause); logbar.addWidget(self.btnClearLog)
+        logbar.addWidget(self.rateLabel)
+        sc.addLayout(logbar)
+
+        # QPlainTextEdit с пределом блоков: старые строки уходят сами, память не растёт
+        self.txtLog = QPlainTextEdit(); self.txtLog.setReadOnly(True); self.txtLog.setMinimumHeight(240)
+        self.txtLog.setMaximumBlockCount(SERIAL_LOG_LINES)
+        self.txtLog.setUndoRedoEnabled(False)
         sc.addWidget(self.txtLog, 1)
+        self._log = deque(maxlen=SERIAL_LOG_LINES)   # хвост без фильтра — для смены фильтра и снятия паузы
+        self._rx = 0            # строк принято всего
+        self._rx_tick = 0       # ... на прошлом тике rateTimer
+        self._held = 0          # новых строк за паузу
 
         send = QHBoxLayout()
         self.edSend = QLineEdit(); self.edSend.setPlaceholderText("Enter the command and press Send (\\n will be added)")
@@ -551,6 +992,7 @@ class ServiceTab(QWidget):
         self.vkeyboard = VirtualKeyboard(self)
         self.vkeyboard.on_enter = self.send_serial
         self.edSend.installEventFilter(self)
+        self.edFilter.installEventFilter(self)
         right.addWidget(self.serialCard, 1)
 
         root.addLayout(left, 2)
@@ -559,11 +1001,20 @@ class ServiceTab(QWidget):
         # Serial backend
         self.reader = SerialReader()
         self.reader.line.connect(self.log_line)
+        self.reader.lines.connect(self.log_lines)
         self.reader.opened.connect(self.serial_opened)
+        self.reader.pos.connect(lambda xy: self.xyLabel.setText(format_xy(xy)))
         self.btnRefresh.clicked.connect(self.fill_ports)
         self.btnOpen.clicked.connect(self.open_serial)
         self.btnClose.clicked.connect(self.reader.close)
         self.btnSend.clicked.connect(self.send_serial)
+        self.edFilter.textChanged.connect(self._relog)
+        self.btnPause.toggled.connect(self._on_pause)
+        self.btnClearLog.clicked.connect(self.clear_log)
+
+        self.rateTimer = QTimer(self)
+        self.rateTimer.timeout.connect(self._tick_rate)
+        self.rateTimer.start(1000)
 
         self.fill_ports()
 
@@ -604,6 +1055,9 @@ class ServiceTab(QWidget):
                 ports = []
         for p in ["/dev/ttyACM0", "/dev/ttyUSB0"]:
             if p not in ports: ports.append(p)
+        # брокер — первым, чтобы по умолчанию не отбирать порт у цикла
+        if BrokerSerial is not None and broker_available(BROKER_SOCK):
+            ports.insert(0, BROKER_SOCK)
         for p in ports: self.cbPort.addItem(p)
 
     def open_serial(self):
@@ -626,33 +1080,92 @@ class ServiceTab(QWidget):
         self.cbPort.setEnabled(not ok); self.cbBaud.setEnabled(not ok)
 
     def log_line(self, s: str):
-        self.txtLog.append(s)
+        self.log_lines([s])
+
+    def log_lines(self, batch: list):
+        """Пачка строк от SerialReader — одна вставка в документ вместо вставки на строку."""
+        self._log.extend(batch)
+        self._rx += len(batch)
+        if self.btnPause.isChecked():
+            self._held += len(batch)
+            return
+        shown = self._filtered(batch)
+        if shown:
+            self.txtLog.appendPlainText("\n".join(shown))
+
+    def _filtered(self, lines) -> list:
+        f = self.edFilter.text().strip().lower()
+        return [s for s in lines if f in s.lower()] if f else list(lines)
+
+    def _relog(self):
+        """Фильтр сменился или пауза снята — показать хвост заново из _log."""
+        if self.btnPause.isChecked():
+            return
+        self._held = 0
+        self.txtLog.setPlainText("\n".join(self._filtered(self._log)))
+        sb = self.txtLog.verticalScrollBar()
+        sb.setValue(sb.maximum())
+
+    def _on_pause(self, paused: bool):
+        self.btnPause.setText("Resume" if paused else "Pause")
+        if not paused:
+            self._relog()
+        self._tick_rate()
+
+    def clear_log(self):
+        self._log.clear()
+        self._held = 0
+        self.txtLog.clear()
+
+    def _tick_rate(self):
+        rate, self._rx_tick = self._rx - self._rx_tick, self._rx
+        text = f"{rate} lines/s"
+        if self.btnPause.isChecked():
+            text += f", paused +{self._held}"
+        view.text(self.rateLabel, text)
+
+    def show_perf(self, worker: "StatusWorker", render_ms, feedback_ms, ack_ms, taps_ignored: int):
+        """
+        Статус (поток или опрос, задержка опроса), отрисовка тика в GUI-потоке, нажатие педали ->
+        подтверждение START и -> подсветка busy на экране, p50/max.
+        """
+        fetch = "stream" if worker.mode == "stream" else format_perf("poll", worker.fetch_ms)
+        self.perfLabel.setText(f"{fetch}   {format_perf('render', render_ms)}   "
+                               f"{format_perf('tap->ack', ack_ms)}   {format_perf('press->busy', feedback_ms)}   "
+                               f"coalesced {worker.coalesced}, taps ignored {taps_ignored}   "
+                               f"widgets {view.touched} set / {view.skipped} unchanged")
 
     # --- render ---
     def render(self, st: dict):
-        # sensors
+        # sensors: сетка перестраивается только при смене набора имён, дальше — только значения
         names = st.get("sensor_names", [])
         states = st.get("sensors", {})
 
-        # rebuild sensors grid
-        while self.sensorsGrid.count():
-            item = self.sensorsGrid.takeAt(0)
-            w = item.widget()
-            if w: w.deleteLater()
-
-        for i, name in enumerate(names):
-            lab = QLabel(name); lab.setObjectName("badge")
+        if list(names) != list(self._sensor_widgets.keys()):
+            view.forget(self._sensor_widgets.values())
+            while self.sensorsGrid.count():
+                item = self.sensorsGrid.takeAt(0)
+                w = item.widget()
+                if w: w.deleteLater()
+            self._sensor_widgets.clear()
+            for i, name in enumerate(names):
+                lab = QLabel(name); lab.setObjectName("badge")
+                val = QLabel("—"); val.setObjectName("off")
+                self.sensorsGrid.addWidget(lab, i, 0)
+                self.sensorsGrid.addWidget(val, i, 1)
+                self._sensor_widgets[name] = val
+
+        for name, val in self._sensor_widgets.items():
             v = bool(states.get(name))
-            val = QLabel("CLOSE" if v else "OPEN")
-            val.setObjectName("ok" if v else "off")
-            self.sensorsGrid.addWidget(lab, i, 0)
-            self.sensorsGrid.addWidget(val, i, 1)
+            view.text(val, "CLOSE" if v else "OPEN")
+            view.object_name(val, "ok" if v else "off")
 
         # relays
         relay_names = st.get("relay_names", [])
         relays = st.get("relays", {})
 
         if set(relay_names) != set(self._relay_widgets.keys()):
+            view.forget(w for ws in self._relay_widgets.values() for w in ws)
             while self.relaysGrid.count():
                 item = self.relaysGrid.takeAt(0)
                 w = item.widget()
@@ -665,18 +1178,18 @@ class ServiceTab(QWidget):
         for name, widgets in self._relay_widgets.items():
             lblState, spin, btnOn, btnOff, btnPulse = widgets
             is_on = bool(relays.get(name))
-            lblState.setText("ON" if is_on else "OFF")
-            lblState.setProperty("on", is_on)
+            view.text(lblState, "ON" if is_on else "OFF")
+            view.prop(lblState, "on", is_on)
             for w in (spin, btnOn, btnOff, btnPulse):
-                w.setEnabled(not external)
-            lblState.style().unpolish(lblState); lblState.style().polish(lblState)
+                view.enabled(w, not external)
     
     def eventFilter(self, obj, event):
-        if obj is self.edSend:
+        if obj is self.edSend or obj is self.edFilter:
             if event.type() == QEvent.FocusIn:
-                self.vkbd.show_for(self.edit, self)
+                self.vkeyboard.on_enter = self.send_serial if obj is self.edSend else None
+                self.vkeyboard.show_for(obj, self)
             elif event.type() == QEvent.FocusOut:
-                self.vkbd.hide()
+                self.vkeyboard.hide()
         return super().eventFilter(obj, event)
 
 
@@ -703,16 +1216,16 @@ class StartTab(QWidget):
 
     def on_start(self):
         try:
-            self.stateLabel.setText("Launching the program…")
+            view.text(self.stateLabel, "Launching the program…")
             self.api.ext_start()  # только стартуем процесс (как в веб UI /api/ext/start)
             # покажем подсказку оператору
-            self.stateLabel.setText(
+            view.text(self.stateLabel,
                 'The program is running. To begin working, click "START" on the Work tab.'
             )
             # дальше переключать вкладку НЕ будем — авто-переброс на Work произойдёт,
             # когда external_running станет True (логика уже есть в refresh()).
         except Exception as e:
-            self.stateLabel.setText(f"Failed to start the program: {e}")
+            view.text(self.stateLabel, f"Failed to start the program: {e}")
 
 
 
@@ -721,15 +1234,13 @@ class StartTab(QWidget):
             data = self.api.ext_stop()
             self.render(data)
         except Exception as e:
-            self.stateLabel.setText(f"Stop error: {e}")
+            view.text(self.stateLabel, f"Stop error: {e}")
 
     def render(self, st: dict):
         running = bool(st.get("external_running"))
-        self.stateLabel.setText("Статус: " + ("PROGRAM RUNNING" if running else "PROGRAM STOPPED"))
-        self.btnStart.setProperty("ok", running)
-        self.btnStop.setProperty("ok", not running)
-        for w in (self.btnStart, self.btnStop):
-            w.style().unpolish(w); w.style().polish(w)
+        view.text(self.stateLabel, "Статус: " + ("PROGRAM RUNNING" if running else "PROGRAM STOPPED") + format_phase(st))
+        view.prop(self.btnStart, "ok", running)
+        view.prop(self.btnStop, "ok", not running)
 
 
 
@@ -786,48 +1297,54 @@ class MainWindow(QMainWindow):
         self._position_logo()  # первичное позиционирование
 
 
-        # Таймер опроса API
-        self.timer = QTimer(self); self.timer.setInterval(POLL_MS)
-        self.timer.timeout.connect(self.refresh)
-        self.timer.start()
+        # Опрос API — в отдельном потоке; GUI только рисует готовый статус
+        self.render_ms = deque(maxlen=PERF_KEEP)
+        self.feedback_ms = deque(maxlen=PERF_KEEP)
+        self._last_st = None
+        self.worker = StatusWorker(POLL_MS)
+        self.worker.ready.connect(self.on_status)
+        self.worker.failed.connect(self.on_status_failed)
+        self.worker.start()
 
         # Полноэкранный режим под тач
         self.showFullScreen()
 
     # Позиционирование рамки/бордера
     def set_border(self, state: str):
-        self.frame.setProperty("state", state)
-        self.frame.style().unpolish(self.frame); self.frame.style().polish(self.frame)
+        view.prop(self.frame, "state", state)
 
-    # Перерисовка/логика статуса
-    def refresh(self):
-        try:
-            st = self.api.status()
-        except Exception:
-            self.set_border("alarm")
+    def on_status_failed(self, _err: str):
+        self.set_border("alarm")
+        self._last_st = None       # следующий успешный статус перерисует рамку, даже если он прежний
+
+    def on_status(self):
+        st = self.worker.take()
+        if st is None or st == self._last_st:
             return
+        self._last_st = st
+        t0 = time.perf_counter()
+        self.refresh(st)
+        t1 = time.perf_counter()
+        self.render_ms.append((t1 - t0) * 1000.0)
+        if self.tabWork.t_press is not None and st.get("cycle_busy"):
+            self.feedback_ms.append((t1 - self.tabWork.t_press) * 1000.0)
+            self.tabWork.t_press = None
+        self.show_perf()
+
+    def show_perf(self):
+        self.tabService.show_perf(self.worker, self.render_ms, self.feedback_ms,
+                                  self.tabWork.ack_ms, self.tabWork.taps_ignored)
 
+    # Перерисовка/логика статуса
+    def refresh(self, st: dict):
         # обновление вкладок
         self.tabWork.render(st)
         self.tabStart.render(st)
         self.tabService.render(st)
 
         running = bool(st.get("external_running"))
-        sensors = st.get("sensors", {})
-        any_alarm = any(re.search(r"(alarm|emerg|fault|error|e_stop)", k, re.I) and v for k, v in sensors.items())
 
         if running:
-            try:
-                st = self.api.status()
-            except Exception:
-                self.set_border("alarm")
-                return
-
-            # обновление вкладок
-            self.tabWork.render(st)
-            self.tabStart.render(st)
-            self.tabService.render(st)
-
             # ----------------------------
             # логика рамки
             # ----------------------------
@@ -863,15 +1380,19 @@ class MainWindow(QMainWindow):
                 self.tabs.blockSignals(False)
 
             # теперь блокируем Старт и Service
-            self.tabs.setTabEnabled(1, False)
-            self.tabs.setTabEnabled(2, False)
+            self._tab_enabled(1, False)
+            self._tab_enabled(2, False)
 
         else:
-            self.tabs.setTabEnabled(1, True)
-            self.tabs.setTabEnabled(2, True)
+            self._tab_enabled(1, True)
+            self._tab_enabled(2, True)
 
         self._was_running = running
 
+    def _tab_enabled(self, idx: int, on: bool):
+        if self.tabs.isTabEnabled(idx) != on:
+            self.tabs.setTabEnabled(idx, on)
+
     # Пароль на вкладку Service
     def check_service_tab(self, idx: int):
         if idx == 2:
@@ -900,6 +1421,11 @@ class MainWindow(QMainWindow):
         y = r.top() + self._logo_margin_top
         self.logo.move(x, y)
 
+    def closeEvent(self, event):
+        self.worker.stop()
+        self.tabWork.pedal.stop()
+        return super().closeEvent(event)
+
     # Держим логотип в углу при ресайзе
     def resizeEvent(self, event):
         self._position_logo()
@@ -949,6 +1475,7 @@ QTabBar::tab:selected {{ background: #242a36; color: white; }}
     background: #2b3342; color: #e8edf8; border: 2px solid #3a4356; border-radius: 18px;
 }}
 #bigButton[ok="true"]  {{ background: #153f2c; border-color: #1ac06b; color: #e9ffee; }}
+#bigButton[pending="true"] {{ background: #3d3411; border-color: #f0b400; color: #fff6dc; }}
 #stopButton[ok="true"] {{ font-size: 32px; font-weight: 700; background: #3a1c1c; border-color: #e5484d; color: #ffe9e9; }}
 #stopButton[ok="false"] {{ font-size: 32px; font-weight: 700; }}
 #bigButton:pressed     {{ background: #354159; }}
@@ -991,7 +1518,7 @@ QPushButton:disabled {{ opacity: .5; }}
 QSpinBox, QLineEdit, QComboBox {{
     background: #1f2531; color: #dbe3f5; border: 1px solid #334157; border-radius: 8px; padding: 6px 8px;
 }}
-QTextEdit {{ background: #0f141c; color: #d3ddf0; border: 1px solid #334157; border-radius: 10px; }}
+QPlainTextEdit {{ background: #0f141c; color: #d3ddf0; border: 1px solid #334157; border-radius: 10px; }}
 """
 
 def main():
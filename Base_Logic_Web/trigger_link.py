@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Постоянное соединение с каналом управления цикла (StartTrigger в cycle_onefile.py, 127.0.0.1:8765).
+
+Запросы идут с номером ("#7 START"), ответы сопоставляются по номеру, события цикла ("! PHASE ready",
+"! STARTED command 3.2", "! CYCLE 12 9.81"...) отдаются в on_event. Соединение открывается при первом
+запросе и держится; после перезапуска цикла переподключается само. Задержка нажатие -> подтверждение
+меряется на каждом запросе (stats()).
+
+  python3 trigger_link.py start              # эмуляция педали
+  python3 trigger_link.py status
+  python3 trigger_link.py set FEED_PULSE_MS 250
+  python3 trigger_link.py watch              # события цикла
+  python3 trigger_link.py bench -n 200       # задержка PING/OK по постоянному соединению
+"""
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+TRIGGER_HOST = "127.0.0.1"
+TRIGGER_PORT = 8765
+CONNECT_RETRY_S = 0.1             # пока цикл стартует, порт ещё закрыт — пробуем снова
+LAT_KEEP = 200                    # столько последних задержек хранится для stats()
+
+
+class TriggerLink:
+    def __init__(self, host: str = TRIGGER_HOST, port: int = TRIGGER_PORT, subscribe: bool = False,
+                 on_event: Optional[Callable[[str, str], None]] = None):
+        self.host = host
+        self.port = port
+        self.subscribe = subscribe
+        self.on_event = on_event
+        self._sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()            # соединение и таблица ожидающих
+        self._wlock = threading.Lock()
+        self._next_id = 0
+        self._pending: dict = {}                 # id -> [Event, ответ]
+        self.lat_ms: deque = deque(maxlen=LAT_KEEP)
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def _connect(self, deadline: float):
+        while True:
+            try:
+                sock = socket.create_connection((self.host, self.port),
+                                                timeout=max(0.05, min(0.5, deadline - time.monotonic())))
+                break
+            except OSError:
+                if time.monotonic() + CONNECT_RETRY_S >= deadline:
+                    raise
+                time.sleep(CONNECT_RETRY_S)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        self._sock = sock
+        threading.Thread(target=self._reader, args=(sock,), daemon=True).start()
+        if self.subscribe:
+            self._send(sock, "SUB")
+
+    def _send(self, sock: socket.socket, line: str):
+        with self._wlock:
+            sock.sendall((line + "\n").encode())
+
+    def _reader(self, sock: socket.socket):
+        try:
+            for raw in sock.makefile("rb"):
+                line = raw.decode(errors="ignore").strip()
+                if line.startswith("! "):
+                    event, _, data = line[2:].partition(" ")
+                    cb = self.on_event
+                    if cb is not None:
+                        try:
+                            cb(event, data)
+                        except Exception as e:
+                            print(f"[trigger_link] on_event: {e}", file=sys.stderr)
+                elif line.startswith("#"):
+                    rid, _, reply = line.partition(" ")
+                    with self._lock:
+                        slot = self._pending.pop(rid, None)
+                    if slot is not None:
+                        slot[1] = reply
+                        slot[0].set()
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
+        for slot in pending.values():
+            slot[0].set()                        # ответ None: соединение оборвалось
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def request(self, cmd: str, timeout: float = 1.0) -> tuple:
+        """
+        (ok, данные, задержка_мс). Если цикл ещё не слушает — переподключается до timeout.
+        ok=False с данными "NO_LINK"/"TIMEOUT", если соединения или ответа нет.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self._sock is None:
+                try:
+                    self._connect(deadline)
+                except OSError:
+                    return False, "NO_LINK", None
+            self._next_id += 1
+            rid = f"#{self._next_id}"
+            slot = [threading.Event(), None]
+            self._pending[rid] = slot
+            sock = self._sock
+        t0 = time.perf_counter()
+        try:
+            self._send(sock, f"{rid} {cmd}")
+        except OSError:
+            with self._lock:
+                self._pending.pop(rid, None)
+            return False, "NO_LINK", None
+        if not slot[0].wait(max(0.0, deadline - time.monotonic())):
+            with self._lock:
+                self._pending.pop(rid, None)
+            return False, "TIMEOUT", None
+        lat = (time.perf_counter() - t0) * 1000.0
+        if slot[1] is None:
+            return False, "NO_LINK", None
+        self.lat_ms.append(lat)
+        status, _, data = slot[1].partition(" ")
+        return status == "OK", data, lat
+
+    def start(self, timeout: float = 1.0) -> tuple:
+        return self.request("START", timeout)
+
+    def status(self, timeout: float = 1.0) -> Optional[dict]:
+        ok, data, _ = self.request("STATUS", timeout)
+        return json.loads(data) if ok else None
+
+    def stats(self) -> dict:
+        lat = sorted(self.lat_ms)
+        if not lat:
+            return {"n": 0}
+        return {"n": len(lat), "p50_ms": round(lat[len(lat) // 2], 3),
+                "p99_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.99))], 3), "max_ms": round(lat[-1], 3)}
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+
+
+# =====================[ CLI ]=====================
+def main():
+    p = argparse.ArgumentParser(description="Control channel of cycle_onefile.py (persistent StartTrigger link)")
+    p.add_argument("--host", default=TRIGGER_HOST)
+    p.add_argument("--port", type=int, default=TRIGGER_PORT)
+    p.add_argument("--timeout", type=float, default=2.0, help="Connect + reply timeout, s")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    for name in ("start", "stop", "pause", "resume", "status", "ping"):
+        sub.add_parser(name)
+    s = sub.add_parser("set", help="Change a cycle setting at runtime")
+    s.add_argument("key")
+    s.add_argument("value")
+    sub.add_parser("watch", help="Print cycle events until Ctrl+C")
+    b = sub.add_parser("bench", help="PING round-trip latency over the persistent link")
+    b.add_argument("-n", type=int, default=200)
+    args = p.parse_args()
+
+    if args.cmd == "watch":
+        link = TriggerLink(args.host, args.port, subscribe=True,
+                           on_event=lambda e, d: print(f"{time.strftime('%H:%M:%S')} {e} {d}", flush=True))
+        try:
+            while True:
+                if not link.connected:
+                    link.request("PING", args.timeout)
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            return
+
+    link = TriggerLink(args.host, args.port)
+    if args.cmd == "bench":
+        for _ in range(args.n):
+            ok, data, _ = link.request("PING", args.timeout)
+            if not ok:
+                print(f"ERROR: {data}", file=sys.stderr)
+                sys.exit(1)
+        print(json.dumps(link.stats()))
+        return
+
+    cmd = f"SET {args.key} {args.value}" if args.cmd == "set" else args.cmd.upper()
+    ok, data, lat = link.request(cmd, args.timeout)
+    if args.cmd == "status" and ok:
+        data = json.dumps(json.loads(data), indent=2, ensure_ascii=False)
+    print(f"{'OK' if ok else 'ERR'} {data}" + (f"   ({lat:.2f} ms)" if lat is not None else ""))
+    link.close()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
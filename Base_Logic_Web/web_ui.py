@@ -7,22 +7,60 @@ import sys
 import os
 import signal
 import socket
+import json
+import heapq
+import itertools
 try:
     import socket
 except Exception:
     socket = None
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from flask import Flask, request, jsonify, Response
+from typing import NamedTuple
+from flask import Flask, request, jsonify, Response, g
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
-from cycle_onefile import IOController, RELAY_PINS, SENSOR_PINS
+try:
+    import waitress
+    import waitress.adjustments
+except Exception:
+    waitress = None
+
+from cycle_onefile import IOController, RELAY_PINS, SENSOR_PINS, MUTEX_GROUPS, metrics_snapshot
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import Metric
+
+# Арбитр GPIO (gpio_arbiter.py): если запущен — пины держит он, а веб-панель и цикл передают друг другу аренду
+try:
+    from gpio_arbiter import RemoteIO, GPIO_SOCK, LEASE_WAIT_S, arbiter_available
+except Exception:
+    RemoteIO = None
+
+# Канал управления циклом (StartTrigger, 127.0.0.1:8765): постоянное соединение с номерами запросов
+from trigger_link import TriggerLink
+
+# Позиция XY-стола — из автоотчёта прошивки через брокер порта (без запросов M114)
+try:
+    from ser_broker import PositionFollower, BROKER_SOCK, POS_BITS
+except Exception:
+    PositionFollower = None
+    POS_BITS = {}
+
+# Компактный статус (/api/schema + /api/state): битовые маски вместо JSON, общий кодек с клиентами
+import status_codec
 
 BUSY_FLAG = "/tmp/screw_cycle_busy"
 
 # ---------------------- Инициализация ----------------------
 app = Flask(__name__)
 
-io_lock = threading.Lock()
-io: IOController | None = IOController()  # контроллер GPIO (можем временно освободить)
+io_lock = threading.Lock()      # только на время обращения к GPIO, не на время импульса/ожидания
+ext_lock = threading.Lock()     # запуск/остановка внешнего процесса — по одному
+
+# HTTP: ограниченный пул обработчиков; импульсы реле — задания планировщика (PulseScheduler)
+WEB_WORKERS = 8
+io: IOController | None = None  # контроллер GPIO (можем временно освободить) или RemoteIO арбитра, см. _make_io()
 
 # Внутренний «цикл» веб-панели (если ты его использовал раньше) — оставим выключенным.
 # Мы запускаем внешний скрипт как отдельный процесс.
@@ -34,6 +72,181 @@ ext_proc: subprocess.Popen | None = None
 
 TIMEOUT_SEC = 5.0  # базовый таймаут для ожидания датчиков (если понадобится)
 
+# Push-статус (/api/stream, SSE)
+STREAM_SAMPLE_S = 0.25      # опрос того, что не даёт событий: внешний процесс, busy-флаг, XY
+STREAM_HEARTBEAT_S = 5.0    # пинг-комментарий: держит соединение и быстро освобождает место отвалившегося клиента
+STREAM_MAX_S = 300.0        # одно соединение живёт не дольше; EventSource переподключается с Last-Event-ID
+STREAM_MAX_CLIENTS = max(1, WEB_WORKERS // 2)   # остальным обработчикам — обычные запросы
+STREAM_HISTORY = 256        # столько последних дельт хранится для продолжения по Last-Event-ID
+STATUS_WAIT_MAX_S = 25.0    # максимум одного /api/status?wait=VERSION (long-poll)
+BOOT_ID = f"{int(time.time()):x}"   # в ETag: версии после перезапуска web_ui начинаются заново
+
+pos_follower = PositionFollower(BROKER_SOCK, name="web_ui") if PositionFollower is not None else None
+
+TRIGGER_ACK_TIMEOUT_S = 1.0
+trigger = TriggerLink()
+
+# /metrics (Prometheus): свои счётчики + счётчики цикла, запрошенные по каналу управления
+METRICS_CYCLE_TIMEOUT_S = 0.5
+HTTP_SECONDS = Histogram("screw_http_request_seconds", "web_ui request handling time",
+                         ("method", "route", "code"))
+CYCLE_UP = Gauge("screw_cycle_up", "1 if the running cycle answered METRICS on the last scrape")
+RELAY_ACTUATIONS = Counter("screw_relay_actuations_total", "Relay OFF->ON switches", ("relay",))
+
+class _MergedMetrics:
+    """
+    Коллектор одного ответа /metrics: семейства из снимков процессов с меткой proc; одноимённые
+    (screw_relay_actuations_total есть и у цикла, и у нас) — под одним HELP/TYPE, как требует формат.
+    """
+    def __init__(self):
+        self._families: dict = {}
+
+    def add(self, snapshot: list, proc: str):
+        for name, doc, kind, samples in snapshot:
+            fam = self._families.get(name)
+            if fam is None:
+                fam = self._families[name] = Metric(name, doc, kind)
+            for sname, labels, value in samples:
+                fam.add_sample(sname, dict(labels, proc=proc), value)
+
+    def collect(self):
+        return list(self._families.values())
+
+# Лог внешнего процесса: stdout читается постоянно (иначе после ~64 КБ print в цикле блокируется)
+LOG_MAX_LINES = 5000       # кольцевой буфер; вытесненные строки считаются в dropped
+LOG_ECHO = False           # дублировать строки цикла в stdout web_ui (journalctl)
+LOG_STREAM_MAX_S = 10.0    # максимум одного /api/logs?stream=1, дальше клиент переподключается с since
+
+class LogBuffer:
+    """Кольцевой буфер строк с порядковыми номерами (seq растёт всегда, между запусками тоже)."""
+    def __init__(self, maxlen: int = LOG_MAX_LINES):
+        self._lines = deque(maxlen=maxlen)   # (seq, unix-время, строка)
+        self._cv = threading.Condition()
+        self.seq = 0                         # номер последней строки
+        self.dropped = 0                     # вытеснено из буфера за всё время
+
+    def append(self, line: str):
+        with self._cv:
+            if len(self._lines) == self._lines.maxlen:
+                self.dropped += 1
+            self.seq += 1
+            self._lines.append((self.seq, time.time(), line))
+            self._cv.notify_all()
+
+    def tail(self, n: int) -> list:
+        with self._cv:
+            return list(self._lines)[-n:] if n > 0 else []
+
+    def since(self, seq: int, limit: int) -> tuple[list, int]:
+        """Строки с номером > seq (не больше limit) и сколько из них уже вытеснено (missed)."""
+        with self._cv:
+            first = self._lines[0][0] if self._lines else self.seq + 1
+            missed = max(0, first - seq - 1)
+            out = [item for item in self._lines if item[0] > seq][:limit]
+            return out, missed
+
+    def wait(self, seq: int, timeout: float) -> bool:
+        """Ждать строку новее seq; False — таймаут."""
+        with self._cv:
+            return self._cv.wait_for(lambda: self.seq > seq, timeout)
+
+log_buf = LogBuffer()
+
+# Фазы внешнего процесса: spawning/stopped ставит web_ui, остальные сообщает цикл строкой "@@PHASE <фаза> [деталь]"
+PHASE_PREFIX = "@@PHASE "
+PHASES = ("stopped", "spawning", "initializing", "homing", "ready", "busy", "failed", "stopping")   # порядок — индекс в /api/state
+STOP_GRACE_S = 3.0          # после SIGINT столько ждём штатного завершения, затем kill
+
+class CyclePhase:
+    """Текущая фаза цикла и время, проведённое в каждой (last_s — последний раз, с); переходы пишутся в лог."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.name = "stopped"
+        self.detail = ""
+        self.since = time.time()
+        self._mono = time.monotonic()
+        self.last_s: dict = {}
+        self.failure = None      # деталь последнего "failed" с момента запуска (None — не было)
+
+    def set(self, name: str, detail: str = ""):
+        with self._lock:
+            if name == "spawning":
+                self.failure = None
+            elif name == "failed":
+                self.failure = detail
+            if name == self.name:
+                self.detail = detail or self.detail
+                return
+            now = time.monotonic()
+            spent = now - self._mono
+            prev = self.name
+            self.last_s = dict(self.last_s, **{prev: round(spent, 3)})
+            self.name, self.detail = name, detail
+            self.since, self._mono = time.time(), now
+        line = f"[phase] {prev} -> {name}{' (' + detail + ')' if detail else ''}, {prev} took {spent:.2f} s"
+        log_buf.append(line)
+        print(line, flush=True)
+        hub.poke()
+
+    def exited(self, rc: int):
+        """Процесс завершился: "stopped", а после "failed" — с его причиной, чтобы не спутать с остановкой оператором."""
+        with self._lock:
+            failure = self.failure
+        if failure is None:
+            self.set("stopped", f"code {rc}")
+        else:
+            self.set("stopped", f"failed{': ' + failure if failure else ''}, code {rc}")
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"name": self.name, "detail": self.detail, "since": round(self.since, 3), "last_s": self.last_s}
+
+phase = CyclePhase()
+
+def _log_pump(proc: subprocess.Popen):
+    """Читает stdout внешнего процесса до EOF (процесс завершился), затем возвращает GPIO веб-панели."""
+    log_buf.append(f"=== cycle_onefile.py started, pid {proc.pid} ===")
+    try:
+        for line in proc.stdout:
+            line = line.rstrip("\r\n")
+            if line.startswith(PHASE_PREFIX):
+                name, _, detail = line[len(PHASE_PREFIX):].partition(" ")
+                phase.set(name, detail)
+                continue
+            log_buf.append(line)
+            if LOG_ECHO:
+                print(f"[cycle] {line}", flush=True)
+    except (OSError, ValueError):
+        pass
+    rc = proc.wait()
+    log_buf.append(f"=== cycle_onefile.py exited, code {rc} ===")
+    _cycle_exited(proc, rc)
+
+io_changed = threading.Condition()   # будится событиями реле/датчиков (ожидание датчика в /api/sequence)
+
+def _io_event(kind: str, name: str, value: bool):
+    hub.poke()
+    with io_changed:
+        io_changed.notify_all()
+
+def _make_io() -> IOController:
+    ctrl = None
+    if RemoteIO is not None and arbiter_available(GPIO_SOCK):
+        # аренда — только в ручном режиме; при работающем цикле панель лишь читает
+        try:
+            ctrl = RemoteIO(GPIO_SOCK, name="web_ui", lease=not ext_is_running())
+        except OSError as e:
+            print(f"[gpio] WARN: арбитр {GPIO_SOCK} не отвечает ({e}) — GPIO напрямую", flush=True)
+    if ctrl is None:
+        ctrl = IOController()
+    ctrl.actuations = RELAY_ACTUATIONS
+    ctrl.on_change = _io_event
+    return ctrl
+
+def _io_shared() -> bool:
+    """GPIO держит арбитр: при работе цикла панель не освобождает пины и продолжает читать датчики."""
+    return io is not None and getattr(io, "shared", False)
+
 def with_io_lock(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -52,89 +265,449 @@ def _set_relay(name: str, on: bool):
         raise RuntimeError("GPIO not available (external script running)")
     io.set_relay(name, on)
 
-def _pulse(name: str, ms: int):
-    if io is None:
-        raise RuntimeError("GPIO not available (external script running)")
-    io.pulse(name, ms=ms)
+# ---------------------- Pulse jobs ----------------------
+PULSE_MS_MAX = 10000        # длиннее импульс — это уже "on"/"off"
+PULSE_SPIN_S = 0.002        # последние мс до выключения — короткими sleep, а не Condition.wait (точность)
+JOBS_KEEP = 200             # сколько завершённых заданий помнить для /api/jobs/<id>
 
-def send_start_trigger(host="127.0.0.1", port=8765, payload=b"START\n", timeout=0.5) -> bool:
-    try:
-        with socket.create_connection((host, port), timeout=timeout) as s:
-            s.sendall(payload)
-            s.settimeout(timeout)
-            resp = s.recv(64)
-            return b"OK" in resp.upper()
-    except Exception:
-        return False
+def _sleep_until(deadline: float):
+    """Досыпать до monotonic-дедлайна: обычный sleep до последних PULSE_SPIN_S, дальше — шагами 0.2 мс."""
+    left = deadline - time.monotonic()
+    if left > PULSE_SPIN_S:
+        time.sleep(left - PULSE_SPIN_S)
+    while time.monotonic() < deadline:
+        time.sleep(0.0002)
+
+class PulseConflict(Exception):
+    """Импульс нельзя начать: реле уже в импульсе или включена его пара по MUTEX_GROUPS."""
+
+class PulseJob:
+    def __init__(self, job_id: int, relay: str, ms: int):
+        self.id = job_id
+        self.relay = relay
+        self.ms = ms
+        self.state = "running"          # running -> done | cancelled | aborted
+        self.reason = ""
+        self.t_on = 0.0                 # unix-время включения
+        self.mono_on = 0.0
+        self.deadline = 0.0             # monotonic: когда выключить
+        self.actual_ms: float | None = None
+        self.late_ms: float | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.state == "running"
+
+    def as_dict(self) -> dict:
+        d = {"id": self.id, "relay": self.relay, "ms": self.ms, "state": self.state,
+             "t_on": round(self.t_on, 3), "actual_ms": self.actual_ms, "late_ms": self.late_ms}
+        if self.active:
+            d["left_ms"] = round(max(0.0, self.deadline - time.monotonic()) * 1000.0, 1)
+        if self.reason:
+            d["reason"] = self.reason
+        return d
+
+class PulseScheduler:
+    """
+    Импульсы реле как задания: включение — сразу в запросе, выключение — один поток по куче дедлайнов.
+    io_lock берётся только на запись в GPIO, поэтому импульсы разных реле идут одновременно,
+    если это позволяют MUTEX_GROUPS.
+    """
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._heap: list = []           # (deadline, id)
+        self._jobs: dict[int, PulseJob] = {}
+        self._active: dict[str, PulseJob] = {}   # реле -> его текущий импульс
+        self._ids = itertools.count(1)
+        self._thr: threading.Thread | None = None
+
+    def start(self):
+        self._thr = threading.Thread(target=self._run, name="pulses", daemon=True)
+        self._thr.start()
+
+    def get(self, job_id: int) -> PulseJob | None:
+        with self._cv:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list:
+        with self._cv:
+            return list(self._jobs.values())
+
+    def _conflict(self, name: str) -> str:
+        if name in self._active:
+            return f"{name}: импульс уже идёт (задание {self._active[name].id})"
+        for a, b in MUTEX_GROUPS:
+            other = b if name == a else a if name == b else None
+            if other and (other in self._active or io.relays.get(other, False)):
+                return f"{name}: включено взаимоблокированное реле {other}"
+        return ""
+
+    def submit(self, name: str, ms: int) -> PulseJob:
+        """Включить реле и поставить выключение через ms. PulseConflict / RuntimeError (нет GPIO)."""
+        with io_lock:
+            if io is None:
+                raise RuntimeError("GPIO not available (external script running)")
+            with self._cv:
+                why = self._conflict(name)
+                if why:
+                    raise PulseConflict(why)
+                job = PulseJob(next(self._ids), name, ms)
+            io.set_relay(name, True)
+            job.mono_on = time.monotonic()
+            job.t_on = time.time()
+            job.deadline = job.mono_on + ms / 1000.0
+            with self._cv:
+                self._jobs[job.id] = job
+                self._active[name] = job
+                heapq.heappush(self._heap, (job.deadline, job.id))
+                self._trim()
+                self._cv.notify()
+        return job
+
+    def cancel(self, job_id: int, reason: str = "cancelled") -> PulseJob | None:
+        """Выключить реле досрочно. Завершённое задание возвращается как есть."""
+        with io_lock:
+            with self._cv:
+                job = self._jobs.get(job_id)
+                if job is None or not job.active:
+                    return job
+            self._finish(job, "cancelled", reason)
+        return job
+
+    def release(self, name: str, reason: str):
+        """Реле переключено вручную: его импульс больше не выключает реле сам (io_lock уже взят)."""
+        with self._cv:
+            job = self._active.pop(name, None)
+            if job is not None:
+                job.state, job.reason = "cancelled", reason
+
+    def abort_all(self, reason: str) -> list:
+        """GPIO уходит (внешний процесс): задания закрываются; вернуть реле, которые ещё в импульсе."""
+        with self._cv:
+            for job in self._active.values():
+                job.state, job.reason = "aborted", reason
+            names = list(self._active)
+            self._active.clear()
+        return names
+
+    def _finish(self, job: PulseJob, state: str, reason: str = ""):
+        """Выключить реле задания; вызывается под io_lock."""
+        with self._cv:
+            if not job.active:
+                return
+            self._active.pop(job.relay, None)
+            job.state, job.reason = state, reason
+        if io is not None:
+            io.set_relay(job.relay, False)
+        now = time.monotonic()
+        job.actual_ms = round((now - job.mono_on) * 1000.0, 2)
+        if state == "done":
+            job.late_ms = round((now - job.deadline) * 1000.0, 2)
+
+    def _is_active(self, job_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        return job is not None and job.active
+
+    def _trim(self):
+        done = [j.id for j in self._jobs.values() if not j.active]
+        for job_id in done[:max(0, len(done) - JOBS_KEEP)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while True:
+                    # отменённые задания остаются в куче до своего дедлайна и пропускаются
+                    while self._heap and not self._is_active(self._heap[0][1]):
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cv.wait()
+                        continue
+                    left = self._heap[0][0] - time.monotonic()
+                    if left <= PULSE_SPIN_S:
+                        deadline, job_id = heapq.heappop(self._heap)
+                        job = self._jobs[job_id]
+                        break
+                    self._cv.wait(left - PULSE_SPIN_S)
+            _sleep_until(deadline)
+            try:
+                with io_lock:
+                    self._finish(job, "done")
+            except Exception as e:
+                print(f"[pulse] {job.relay}: {e}", flush=True)
+
+pulses = PulseScheduler()
+
+def send_start_trigger(timeout: float = TRIGGER_ACK_TIMEOUT_S) -> tuple:
+    """START по постоянному каналу цикла: (ok, данные/причина); задержка подтверждения — в лог."""
+    ok, data, lat = trigger.start(timeout)
+    print(f"[trigger] START -> {'OK' if ok else data}" + (f", ack {lat:.2f} ms" if lat is not None else ""), flush=True)
+    return ok, data
+
+# ---------------------- Sequences ----------------------
+SEQ_MAX_STEPS = 500         # шагов с учётом повторов loop
+SEQ_MAX_S = 60.0            # вся программа; запрос ждёт её целиком
+SEQ_MAX_DEPTH = 3           # вложенность loop
+SEQ_POLL_S = 0.005          # страховочный опрос датчика между событиями GPIO
+
+seq_lock = threading.Lock() # одна программа за раз
+
+class SequenceError(Exception):
+    """Шаг программы не выполнен (таймаут датчика, нет GPIO, вышло время)."""
+
+def parse_sequence(steps, depth: int = 0) -> int:
+    """
+    Проверить программу до запуска; вернуть число шагов с учётом повторов. ValueError — с путём шага.
+      {"op": "set",   "relay": "R04_C2", "on": true}
+      {"op": "pulse", "relay": "R01_PIT", "ms": 200}
+      {"op": "wait",  "sensor": "GER_C2_DOWN", "close": true, "timeout_ms": 2000}
+      {"op": "delay", "ms": 100}
+      {"op": "loop",  "times": 3, "steps": [...]}
+    """
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("steps must be a non-empty list")
+    total = 0
+    for i, st in enumerate(steps):
+        try:
+            if not isinstance(st, dict):
+                raise ValueError("step must be an object")
+            op = st.get("op")
+            if op in ("set", "pulse") and st.get("relay") not in RELAY_PINS:
+                raise ValueError(f"unknown relay '{st.get('relay')}'")
+            if op == "set":
+                if not isinstance(st.get("on"), bool):
+                    raise ValueError("'on' must be true|false")
+            elif op in ("pulse", "delay"):
+                if not isinstance(st.get("ms"), (int, float)) or not 0 < st["ms"] <= SEQ_MAX_S * 1000:
+                    raise ValueError("'ms' must be a positive number")
+            elif op == "wait":
+                if st.get("sensor") not in SENSOR_PINS:
+                    raise ValueError(f"unknown sensor '{st.get('sensor')}'")
+                if not isinstance(st.get("close", True), bool):
+                    raise ValueError("'close' must be true|false")
+                if not isinstance(st.get("timeout_ms"), (int, float)) or st["timeout_ms"] <= 0:
+                    raise ValueError("'timeout_ms' must be a positive number")
+            elif op == "loop":
+                if depth + 1 >= SEQ_MAX_DEPTH:
+                    raise ValueError(f"loops nested deeper than {SEQ_MAX_DEPTH}")
+                if not isinstance(st.get("times"), int) or st["times"] < 1:
+                    raise ValueError("'times' must be a positive integer")
+                total += st["times"] * parse_sequence(st.get("steps"), depth + 1)
+                continue
+            else:
+                raise ValueError("op must be set | pulse | wait | delay | loop")
+        except ValueError as e:
+            raise ValueError(f"step {i}: {e}") from None
+        total += 1
+    if depth == 0 and total > SEQ_MAX_STEPS:
+        raise ValueError(f"program expands to {total} steps, max {SEQ_MAX_STEPS}")
+    return total
+
+class SequenceRun:
+    """Выполнение проверенной программы на IOController; io_lock — только на каждое обращение к GPIO."""
+    def __init__(self, steps: list):
+        self.steps = steps
+        self.trace: list = []
+        self.turned_on: set = set()     # реле, включённые программой (для cleanup при ошибке)
+        self.t0 = 0.0
+        self.deadline = 0.0
+
+    def _ms(self, t: float) -> float:
+        return round((t - self.t0) * 1000.0, 2)
+
+    def _relay(self, name: str, on: bool):
+        with io_lock:
+            if io is None:
+                raise SequenceError("GPIO not available (external script running)")
+            pulses.release(name, "sequence")
+            io.set_relay(name, on)
+        (self.turned_on.add if on else self.turned_on.discard)(name)
+
+    def _sensor(self, name: str) -> bool:
+        with io_lock:
+            if io is None:
+                raise SequenceError("GPIO not available (external script running)")
+            return io.sensor_state(name)
+
+    def _wait(self, name: str, close: bool, timeout: float) -> bool:
+        t_end = min(time.monotonic() + timeout, self.deadline)
+        while True:
+            if self._sensor(name) == close:
+                return True
+            left = t_end - time.monotonic()
+            if left <= 0:
+                return False
+            with io_changed:
+                io_changed.wait(min(SEQ_POLL_S, left))
+
+    def run(self) -> bool:
+        self.t0 = time.monotonic()
+        self.deadline = self.t0 + SEQ_MAX_S
+        return self._block(self.steps, "")
+
+    def _block(self, steps: list, path: str) -> bool:
+        for i, st in enumerate(steps):
+            op = st["op"]
+            if op == "loop":
+                for n in range(st["times"]):
+                    if not self._block(st["steps"], f"{path}{i}.{n}/"):
+                        return False
+                continue
+            item = {"step": f"{path}{i}", "op": op}
+            t_start = time.monotonic()
+            ok = True
+            try:
+                if t_start >= self.deadline:
+                    raise SequenceError(f"program exceeded {SEQ_MAX_S:g} s")
+                if op == "set":
+                    item.update(relay=st["relay"], on=st["on"])
+                    self._relay(st["relay"], st["on"])
+                elif op == "pulse":
+                    item.update(relay=st["relay"], ms=st["ms"])
+                    self._relay(st["relay"], True)
+                    t_on = time.monotonic()
+                    _sleep_until(t_on + st["ms"] / 1000.0)
+                    self._relay(st["relay"], False)
+                    item["on_ms"] = round((time.monotonic() - t_on) * 1000.0, 2)
+                elif op == "delay":
+                    item["ms"] = st["ms"]
+                    _sleep_until(t_start + st["ms"] / 1000.0)
+                elif op == "wait":
+                    close = st.get("close", True)
+                    item.update(sensor=st["sensor"], close=close)
+                    ok = self._wait(st["sensor"], close, st["timeout_ms"] / 1000.0)
+                    if not ok:
+                        item["error"] = "timeout"
+            except SequenceError as e:
+                ok = False
+                item["error"] = str(e)
+            t_done = time.monotonic()
+            item.update(t_ms=self._ms(t_start), dur_ms=round((t_done - t_start) * 1000.0, 2), ok=ok)
+            self.trace.append(item)
+            if not ok:
+                return False
+        return True
+
+    def cleanup(self) -> list:
+        """Выключить реле, оставленные программой включёнными (после ошибки)."""
+        off = []
+        with io_lock:
+            if io is not None:
+                for name in sorted(self.turned_on):
+                    if io.relays.get(name):
+                        io.set_relay(name, False)
+                        off.append(name)
+        return off
 
 # ---------------------- External script control ----------------------
 def ext_is_running() -> bool:
     return ext_proc is not None and (ext_proc.poll() is None)
 
-@with_io_lock
 def ext_start() -> bool:
-    """Освобождаем GPIO в web_ui и запускаем внешний процесс."""
-    global io, ext_proc
-    if ext_is_running():
-        return True
+    """Освобождаем GPIO в web_ui и запускаем внешний процесс (не ждём его готовности — см. phase). False — ещё останавливается."""
+    global io
+    with ext_lock:
+        if ext_is_running():
+            return phase.name != "stopping"
 
-    # Освободить GPIO у веб-панели (если инициализированы)
-    if io is not None:
-        try:
-            io.cleanup()
-        except Exception:
-            pass
-        io = None
+        # Освободить GPIO у веб-панели (если инициализированы)
+        with io_lock:
+            pulsing = pulses.abort_all("external started")
+            if _io_shared():
+                # арбитр: отдать аренду (реле не сбрасываются, датчики читаем дальше), кроме начатых импульсов
+                try:
+                    for name in pulsing:
+                        io.set_relay(name, False)
+                    io.release()
+                except Exception as e:
+                    print(f"[gpio] release: {e}", flush=True)
+            elif io is not None:
+                try:
+                    io.cleanup()
+                except Exception:
+                    pass
+                io = None
+        _spawn_cycle()
+    hub.poke()
+    return True
 
+def _spawn_cycle():
+    global ext_proc
+    phase.set("spawning")
     # Запускаем cycle_onefile.py тем же Python
     script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cycle_onefile.py")
-    ext_proc = subprocess.Popen([sys.executable, script_path],
+    # -u / PYTHONUNBUFFERED: строки уходят в pipe сразу, а не блоками по 8 КБ
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    ext_proc = subprocess.Popen([sys.executable, "-u", script_path],
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT,
                                 text=True,
-                                bufsize=1)
-    return True
+                                errors="replace",
+                                bufsize=1,
+                                env=env)
+    threading.Thread(target=_log_pump, args=(ext_proc,), daemon=True).start()
 
-@with_io_lock
 def ext_stop() -> bool:
-    """Останавливаем внешний процесс и восстанавливаем GPIO в web_ui."""
-    global io, ext_proc
-    if not ext_is_running():
-        # уже остановлен — просто убедиться, что GPIO восстановлены
-        if io is None:
-            io = IOController()
-        return True
+    """
+    Послать внешнему процессу SIGINT и вернуться сразу (фаза "stopping"). GPIO веб-панели вернёт _cycle_exited,
+    когда процесс завершится; не успеет за STOP_GRACE_S — kill.
+    """
+    with ext_lock:
+        if ext_is_running():
+            if phase.name != "stopping":
+                try:
+                    # Послать SIGINT (как Ctrl+C), дать шанс корректно завершиться
+                    ext_proc.send_signal(signal.SIGINT)
+                except Exception:
+                    pass
+                phase.set("stopping", "SIGINT")
+                threading.Thread(target=_stop_watchdog, args=(ext_proc,), daemon=True).start()
+        else:
+            # Восстановить GPIO в веб-панели
+            with io_lock:
+                _reclaim_io()
+    hub.poke()
+    return True
+
+def _reclaim_io():
+    """Вернуть веб-панели запись в GPIO: аренда у арбитра или новый IOController. Под io_lock."""
+    global io
+    if _io_shared():
+        if not io.holds_lease and not io.acquire(LEASE_WAIT_S):
+            print("[gpio] аренда не получена — ручное управление недоступно", flush=True)
+    elif io is None:
+        io = _make_io()
 
+def _stop_watchdog(proc: subprocess.Popen):
     try:
-        # Послать SIGINT (как Ctrl+C), дать шанс корректно завершиться
-        ext_proc.send_signal(signal.SIGINT)
-        try:
-            ext_proc.wait(timeout=3.0)
-        except subprocess.TimeoutExpired:
-            # Жестко завершим
-            ext_proc.kill()
-            ext_proc.wait(timeout=2.0)
-    except Exception:
-        pass
-    finally:
-        ext_proc = None
+        proc.wait(timeout=STOP_GRACE_S)
+    except subprocess.TimeoutExpired:
+        # Жестко завершим
+        log_buf.append(f"=== no exit {STOP_GRACE_S:g} s after SIGINT, killing ===")
+        proc.kill()
 
-    # Восстановить GPIO в веб-панели
-    if io is None:
-        io = IOController()
-    return True
+def _cycle_exited(proc: subprocess.Popen, rc: int):
+    """Процесс завершился (остановлен или сам): вернуть GPIO веб-панели."""
+    global ext_proc
+    with ext_lock:
+        if ext_proc is proc:
+            ext_proc = None
+        with io_lock:
+            if not ext_is_running():
+                _reclaim_io()
+    phase.exited(rc)
 
 # ---------------------- Status builder ----------------------
 def build_status():
     external = ext_is_running()
-    if external or io is None:
-        # Если внешний процесс работает, не трогаем GPIO вовсе
-        relays = {}
-        sensors = {}
-    else:
+    relays = {}
+    sensors = {}
+    # Если внешний процесс работает, не трогаем GPIO вовсе (с арбитром — только читаем)
+    if io is not None and (not external or _io_shared()):
         with io_lock:
-            relays = dict(io.relays)
-            sensors = {name: io.sensor_state(name) for name in SENSOR_PINS.keys()}
+            if io is not None:
+                relays = dict(io.relays)
+                sensors = {name: io.sensor_state(name) for name in SENSOR_PINS.keys()}
 
     return {
         "time": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -144,12 +717,259 @@ def build_status():
         "sensor_names": list(SENSOR_PINS.keys()),
         "external_running": external,
         "cycle_busy": os.path.exists(BUSY_FLAG),
+        "phase": phase.as_dict(),
+        "xy": pos_follower.cache.as_dict() if pos_follower is not None else None,
     }
 
+# ---------------------- Push status ----------------------
+def _stream_state() -> dict:
+    """Статус без полей, меняющихся сами по себе (время, возраст кадра XY)."""
+    st = build_status()
+    st.pop("time", None)
+    if st.get("xy"):
+        st["xy"] = {k: v for k, v in st["xy"].items() if k != "age_ms"}
+    return st
+
+def diff_state(old: dict, new: dict) -> dict:
+    """
+    Дельта new относительно old. Словари с тем же набором ключей (relays, sensors) — только изменившиеся
+    ключи; если набор ключей другой — значение целиком, а имя поля — в "_replace".
+    """
+    delta, replace = {}, []
+    for k, v in new.items():
+        ov = old.get(k)
+        if ov == v:
+            continue
+        if isinstance(v, dict) and isinstance(ov, dict) and v.keys() == ov.keys():
+            delta[k] = {kk: vv for kk, vv in v.items() if ov.get(kk) != vv}
+        else:
+            delta[k] = v
+            if isinstance(v, dict):
+                replace.append(k)
+    if replace:
+        delta["_replace"] = replace
+    return delta
+
+SCHEMA = status_codec.make_schema(RELAY_PINS, SENSOR_PINS, PHASES, POS_BITS)
+SCHEMA_BODY = json.dumps(SCHEMA, ensure_ascii=False).encode("utf-8")
+SCHEMA_ETAG = f'"schema-{SCHEMA["id"]:08x}"'
+codec = status_codec.StatusCodec(SCHEMA)
+
+class Snapshot(NamedTuple):
+    """Неизменяемый снимок статуса: JSON для /api/status и структура для /api/state — один раз, при публикации."""
+    version: int
+    state: dict       # без time; не менять — тот же объект у всех читателей
+    body: bytes       # state + time (момент изменения) + version
+    etag: str
+    packed: bytes     # то же для /api/state (status_codec)
+
+def _make_snapshot(version: int, state: dict) -> Snapshot:
+    now = time.time()
+    doc = dict(state, time=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)), version=version)
+    return Snapshot(version, state, json.dumps(doc, ensure_ascii=False).encode("utf-8"),
+                    f'"{BOOT_ID}-{version}"', codec.encode(state, version, now))
+
+class StatusHub:
+    """
+    Версионированный статус для /api/status и /api/stream. Реле и датчики будят его сразу
+    (IOController.on_change), остальное сэмплируется раз в STREAM_SAMPLE_S. Читатели получают
+    готовый Snapshot без обращения к GPIO; хранит последние дельты для продолжения потока.
+    """
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._dirty = threading.Event()
+        self._sample_lock = threading.Lock()           # сэмплер и refresh() публикуют по очереди
+        self._history = deque(maxlen=STREAM_HISTORY)   # (version, delta)
+        self.version = 0
+        self.state: dict | None = None
+        self.current: Snapshot | None = None
+        self.clients = 0
+
+    def poke(self):
+        self._dirty.set()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait(STREAM_SAMPLE_S)
+            self._dirty.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"[stream] {e}", flush=True)
+
+    def refresh(self) -> Snapshot:
+        """Снять статус сейчас (после команды — чтобы ответ уже её отражал) и вернуть текущий снимок."""
+        with self._sample_lock:
+            self.publish(_stream_state())
+        return self.current
+
+    def publish(self, new: dict):
+        with self._cv:
+            if self.state is not None:
+                delta = diff_state(self.state, new)
+                if not delta:
+                    return
+                self._history.append((self.version + 1, delta))
+            self.version += 1
+            self.state = new
+            self.current = _make_snapshot(self.version, new)
+            self._cv.notify_all()
+
+    def snapshot(self) -> tuple[int, dict]:
+        with self._cv:
+            return self.version, self.state
+
+    def since(self, version: int) -> list | None:
+        """Дельты после version; None — столько истории нет (или версия из прошлого запуска): нужен снимок."""
+        with self._cv:
+            if version == self.version:
+                return []
+            if not self._history or version > self.version or version < self._history[0][0] - 1:
+                return None
+            return [item for item in self._history if item[0] > version]
+
+    def wait(self, version: int, timeout: float) -> bool:
+        with self._cv:
+            return self._cv.wait_for(lambda: self.version > version, timeout)
+
+    def enter(self) -> bool:
+        """Занять место подписчика потока; False — мест нет."""
+        with self._cv:
+            if self.clients >= STREAM_MAX_CLIENTS:
+                return False
+            self.clients += 1
+            return True
+
+    def leave(self):
+        with self._cv:
+            self.clients -= 1
+
+    def full(self) -> bool:
+        """Мест нет (без блокировки — для быстрого 503 до того, как место займёт генератор ответа)."""
+        return self.clients >= STREAM_MAX_CLIENTS
+
+hub = StatusHub()
+
+def _sse(event: str, version: int, data: dict) -> str:
+    return f"id: {version}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/api/stream", methods=["GET"])
+def api_stream():
+    """
+    Server-Sent Events: "snapshot" (полный статус) и затем "delta" (только изменившееся), id — версия.
+    Продолжение: заголовок Last-Event-ID (EventSource шлёт сам) или ?since=VERSION.
+    """
+    try:
+        last = int(request.headers.get("Last-Event-ID") or request.args.get("since") or 0)
+    except ValueError:
+        last = 0
+    if hub.full():
+        return jsonify({"error": "busy", "message": "Слишком много подписчиков /api/stream"}), 503
+
+    def gen(version=last):
+        # место занимается здесь, а не в обработчике: ответ, который так и не начали читать (клиент ушёл
+        # до первого байта, ошибка после view), не дойдёт ни до enter, ни до finally — и не унесёт место
+        if not hub.enter():
+            # место успели занять между full() и первым чтением: EventSource придёт снова через retry
+            yield "retry: 10000\nevent: busy\ndata: {}\n\n"
+            return
+        try:
+            yield "retry: 2000\n\n"
+            deltas = hub.since(version) if version else None
+            t_end = time.time() + STREAM_MAX_S
+            t_hb = time.time() + STREAM_HEARTBEAT_S
+            while True:
+                if deltas is None:
+                    version, st = hub.snapshot()
+                    yield _sse("snapshot", version, st)
+                else:
+                    for version, delta in deltas:
+                        yield _sse("delta", version, delta)
+                now = time.time()
+                if now >= t_end:
+                    return
+                if now >= t_hb:
+                    yield ": hb\n\n"
+                    t_hb = now + STREAM_HEARTBEAT_S
+                if hub.wait(version, min(t_hb, t_end) - now):
+                    deltas = hub.since(version)
+                else:
+                    deltas = []
+        finally:
+            hub.leave()
+
+    return Response(gen(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # ---------------------- API ----------------------
+def _status_response(snap: Snapshot) -> Response:
+    return Response(snap.body, mimetype="application/json",
+                    headers={"ETag": snap.etag, "Cache-Control": "no-cache"})
+
+def _etag_matches(snap: Snapshot) -> bool:
+    inm = request.headers.get("If-None-Match", "")
+    return inm.strip() == "*" or snap.etag in (t.strip() for t in inm.split(","))
+
+def _requested_snapshot():
+    """Снимок для /api/status и /api/state с учётом ?wait=VERSION; (None, ответ с ошибкой) — если ждать нельзя."""
+    snap = hub.current or hub.refresh()
+    wait = request.args.get("wait")
+    if wait is not None:
+        try:
+            wait = int(wait)
+            timeout = max(0.0, min(STATUS_WAIT_MAX_S, float(request.args.get("timeout", STATUS_WAIT_MAX_S))))
+        except ValueError:
+            return None, (jsonify({"error": "wait/timeout must be numbers"}), 400)
+        # версия больше текущей — от прошлого запуска web_ui: отвечаем сразу
+        if wait == snap.version:
+            if not hub.enter():
+                return None, (jsonify({"error": "busy", "message": "Слишком много ожидающих /api/status"}), 503)
+            try:
+                hub.wait(wait, timeout)
+            finally:
+                hub.leave()
+            snap = hub.current
+    return snap, None
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
-    return jsonify(build_status())
+    """
+    Текущий снимок статуса (готовый JSON, GPIO не трогается). ETag — версия снимка:
+    If-None-Match с той же версией -> 304 без тела.
+    ?wait=VERSION[&timeout=S] — long-poll: ответ, как только версия станет больше VERSION
+    (по таймауту — тот же снимок или 304). Версия — поле version ответа.
+    """
+    snap, err = _requested_snapshot()
+    if err is not None:
+        return err
+    if _etag_matches(snap):
+        return Response(status=304, headers={"ETag": snap.etag, "Cache-Control": "no-cache"})
+    return _status_response(snap)
+
+@app.route("/api/state", methods=["GET"])
+def api_state():
+    """
+    Тот же снимок, что /api/status (ETag, ?wait=), но упакованный status_codec: маски реле/датчиков,
+    фаза индексом, без списков имён — они в /api/schema. id схемы — в каждом ответе и в X-Schema-Id.
+    """
+    snap, err = _requested_snapshot()
+    if err is not None:
+        return err
+    headers = {"ETag": snap.etag, "Cache-Control": "no-cache", "X-Schema-Id": f"{SCHEMA['id']:08x}"}
+    if _etag_matches(snap):
+        return Response(status=304, headers=headers)
+    return Response(snap.packed, content_type=status_codec.CONTENT_TYPE, headers=headers)
+
+@app.route("/api/schema", methods=["GET"])
+def api_schema():
+    """Имена и пины реле/датчиков, фазы, биты XY — порядок битов /api/state. Меняется только с кодом web_ui."""
+    headers = {"ETag": SCHEMA_ETAG, "Cache-Control": "max-age=86400"}
+    if request.headers.get("If-None-Match", "").strip() == SCHEMA_ETAG:
+        return Response(status=304, headers=headers)
+    return Response(SCHEMA_BODY, mimetype="application/json", headers=headers)
 
 @app.route("/api/relay", methods=["POST"])
 def api_relay():
@@ -164,47 +984,204 @@ def api_relay():
 
     name = data.get("name")
     action = data.get("action")
-    ms = int(data.get("ms", 150))
+    try:
+        ms = int(data.get("ms", 150))
+    except (TypeError, ValueError):
+        return jsonify({"error": "ms must be a number"}), 400
 
     if name not in RELAY_PINS:
         return jsonify({"error": f"unknown relay '{name}'"}), 400
 
+    if action == "pulse":
+        # задание: ответ сразу (202), реле в статусе уже ON; выключит планировщик
+        if not 1 <= ms <= PULSE_MS_MAX:
+            return jsonify({"error": f"ms must be 1..{PULSE_MS_MAX}"}), 400
+        try:
+            job = pulses.submit(name, ms)
+        except PulseConflict as e:
+            return jsonify({"error": "conflict", "message": str(e)}), 409
+        except RuntimeError as e:
+            return jsonify({"error": "external_running", "message": str(e)}), 409
+        doc = json.loads(hub.refresh().body)
+        doc["job"] = job.as_dict()
+        return jsonify(doc), 202, {"Location": f"/api/jobs/{job.id}"}
+
     with io_lock:
-        if action == "on":
-            _set_relay(name, True)
-        elif action == "off":
-            _set_relay(name, False)
-        elif action == "pulse":
-            _pulse(name, ms=ms)
-        else:
-            return jsonify({"error": "action must be 'on' | 'off' | 'pulse'"}), 400
+        try:
+            if action == "on":
+                pulses.release(name, "manual on")
+                _set_relay(name, True)
+            elif action == "off":
+                pulses.release(name, "manual off")
+                _set_relay(name, False)
+            else:
+                return jsonify({"error": "action must be 'on' | 'off' | 'pulse'"}), 400
+        except RuntimeError as e:
+            # арбитр без аренды (_reclaim_io её не получил): NOLEASE — как у pulse, 409
+            return jsonify({"error": "external_running", "message": str(e)}), 409
+
+    return _status_response(hub.refresh())
 
-    return jsonify(build_status())
+@app.route("/api/sequence", methods=["POST"])
+def api_sequence():
+    """
+    Выполнить программу на стороне сервера (см. parse_sequence) и вернуть трассу шагов:
+    t_ms — начало шага от старта программы, dur_ms — длительность. Тело: {"steps": [...], "cleanup": true};
+    cleanup — при ошибке выключить реле, которые программа включила. Ответ приходит по завершении
+    (не дольше SEQ_MAX_S); одновременно — одна программа, иначе 409.
+    """
+    try:
+        data = request.get_json(force=True)
+    except Exception:
+        return jsonify({"error": "invalid json"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "body must be an object with 'steps'"}), 400
+    try:
+        n = parse_sequence(data.get("steps"))
+    except ValueError as e:
+        return jsonify({"error": "invalid program", "message": str(e)}), 400
+    if ext_is_running() or io is None:
+        return jsonify({"error": "external_running", "message": "Запущен внешний скрипт — ручное управление временно недоступно."}), 409
+    if not seq_lock.acquire(blocking=False):
+        return jsonify({"error": "busy", "message": "Уже выполняется другая программа"}), 409
+    try:
+        run = SequenceRun(data["steps"])
+        ok = run.run()
+        total_ms = run._ms(time.monotonic())
+        cleaned = run.cleanup() if not ok and data.get("cleanup", True) else []
+    finally:
+        seq_lock.release()
+    print(f"[sequence] {'ok' if ok else 'FAILED'}: {len(run.trace)}/{n} steps, {total_ms} ms", flush=True)
+    return jsonify({"ok": ok, "steps": n, "total_ms": total_ms, "trace": run.trace, "cleanup": cleaned})
+
+@app.route("/api/jobs", methods=["GET"])
+def api_jobs():
+    """Импульсы: текущие и последние JOBS_KEEP завершённых (?active=1 — только текущие)."""
+    jobs = pulses.jobs()
+    if request.args.get("active") in ("1", "true"):
+        jobs = [j for j in jobs if j.active]
+    return jsonify({"jobs": [j.as_dict() for j in jobs]})
+
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+def api_job(job_id: int):
+    job = pulses.get(job_id)
+    if job is None:
+        return jsonify({"error": "not_found", "message": f"Нет задания {job_id}"}), 404
+    return jsonify(job.as_dict())
+
+@app.route("/api/jobs/<int:job_id>/cancel", methods=["POST"])
+def api_job_cancel(job_id: int):
+    """Досрочно выключить реле импульса; завершённое задание не меняется (state в ответе)."""
+    job = pulses.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "not_found", "message": f"Нет задания {job_id}"}), 404
+    return jsonify(job.as_dict())
 
 @app.route("/api/ext/start", methods=["POST"])
 def api_ext_start():
-    ok = ext_start()
-    # даём процессу стартануть
-    time.sleep(0.1)
-    return jsonify(build_status())
+    """Ответ сразу, с фазой "spawning"; дальше фазы приходят в статусе (initializing, homing, ready...)."""
+    if not ext_start():
+        return jsonify({"error": "stopping", "message": "Внешний скрипт ещё останавливается"}), 409
+    return _status_response(hub.refresh())
 
 @app.route("/api/ext/stop", methods=["POST"])
 def api_ext_stop():
-    ok = ext_stop()
-    # дать GPIO переинициализироваться
-    time.sleep(0.1)
-    return jsonify(build_status())
+    """Ответ сразу, с фазой "stopping"; "stopped" и GPIO веб-панели — когда процесс завершится."""
+    ext_stop()
+    return _status_response(hub.refresh())
 
 @app.route("/api/trigger/start", methods=["POST"])
 def api_trigger_start():
     if not ext_is_running():
         return jsonify({"error":"not_running","message":"Внешний скрипт не запущен"}), 409
-    ok = send_start_trigger()
+    ok, why = send_start_trigger()
     if not ok:
-        return jsonify({"error":"connect","message":"Не удалось отправить команду START в цикл"}), 502
-    # вернём свежий статус
-    time.sleep(0.1)
-    return jsonify(build_status())
+        if why in ("NO_LINK", "TIMEOUT"):
+            return jsonify({"error":"connect","message":"Не удалось отправить команду START в цикл"}), 502
+        return jsonify({"error":"rejected","message":f"Цикл отклонил START: {why}"}), 409
+    return _status_response(hub.refresh())
+
+@app.before_request
+def _req_started():
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def _req_finished(resp: Response):
+    t0 = getattr(g, "t0", None)
+    if t0 is not None:
+        rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        HTTP_SECONDS.labels(request.method, rule, str(resp.status_code)).observe(time.perf_counter() - t0)
+    return resp
+
+@app.route("/metrics", methods=["GET"])
+def api_metrics():
+    """Prometheus: web_ui — proc="web_ui", работающий цикл — proc="cycle" (его счётчики живут в его процессе)."""
+    cycle = None
+    if ext_is_running():
+        ok, data, _ = trigger.request("METRICS", METRICS_CYCLE_TIMEOUT_S)
+        CYCLE_UP.set(1 if ok else 0)
+        if ok:
+            cycle = json.loads(data)
+    else:
+        CYCLE_UP.set(0)
+    merged = _MergedMetrics()
+    merged.add(metrics_snapshot(REGISTRY), "web_ui")
+    if cycle is not None:
+        merged.add(cycle, "cycle")
+    return Response(generate_latest(merged), content_type=CONTENT_TYPE_LATEST)
+
+def _log_item(item) -> dict:
+    seq, t, line = item
+    return {"seq": seq, "t": round(t, 3), "line": line}
+
+@app.route("/api/logs", methods=["GET"])
+def api_logs():
+    """
+    Лог внешнего процесса:
+      ?tail=N                 последние N строк (по умолчанию 200)
+      ?since=SEQ[&limit=N]    строки после SEQ (курсор — поле next из прошлого ответа)
+      ?since=SEQ&stream=1     NDJSON-поток новых строк до LOG_STREAM_MAX_S (или &timeout=), затем {"next": SEQ}
+    missed — сколько строк после курсора уже вытеснено из буфера, dropped — всего вытеснено.
+    """
+    try:
+        limit = max(1, min(LOG_MAX_LINES, int(request.args.get("limit", LOG_MAX_LINES))))
+        tail = int(request.args.get("tail", 200))
+        since = request.args.get("since")
+        since = None if since is None else int(since)
+        timeout = min(LOG_STREAM_MAX_S, float(request.args.get("timeout", LOG_STREAM_MAX_S)))
+    except ValueError:
+        return jsonify({"error": "tail/since/limit/timeout must be numbers"}), 400
+    if since is not None and since > log_buf.seq:
+        since = 0                           # web_ui перезапускался — нумерация началась заново
+
+    if request.args.get("stream") in ("1", "true"):
+        def gen(cursor=log_buf.seq if since is None else since):
+            t_end = time.time() + timeout
+            while True:
+                items, missed = log_buf.since(cursor, limit)
+                if missed:
+                    yield json.dumps({"missed": missed}) + "\n"
+                for item in items:
+                    yield json.dumps(_log_item(item), ensure_ascii=False) + "\n"
+                    cursor = item[0]
+                left = t_end - time.time()
+                if left <= 0:
+                    break
+                log_buf.wait(cursor, left)
+            yield json.dumps({"next": cursor}) + "\n"
+        return Response(gen(), mimetype="application/x-ndjson")
+
+    if since is None:
+        items, missed = log_buf.tail(tail), 0
+    else:
+        items, missed = log_buf.since(since, limit)
+    return jsonify({
+        "lines": [_log_item(i) for i in items],
+        "next": items[-1][0] if items else log_buf.seq,
+        "missed": missed,
+        "dropped": log_buf.dropped,
+        "running": ext_is_running(),
+    })
 
 
 # ---------------------- UI ----------------------
@@ -245,6 +1222,7 @@ INDEX_HTML = """<!doctype html>
     <div class="card" style="flex:1">
       <h3>Внешний скрипт: cycle_onefile.py</h3>
       <div id="extState" class="muted">Статус: неизвестно</div>
+      <div id="xyState" class="muted">XY: —</div>
       <div class="controls" style="margin-top:8px">
         <button id="btnExtStart" class="btn">Start external</button>
         <button id="btnExtStop"  class="btn">Stop external</button>
@@ -300,17 +1278,48 @@ async function postExt(action){
   return await res.json();
 }
 
-function renderExternal(isRunning){
+function renderExternal(isRunning, phase){
   const state = document.getElementById('extState');
-  state.innerHTML = 'Статус: ' + (isRunning ? '<span class="pill blue">EXTERNAL RUNNING</span>' : '<span class="pill gray">STOPPED</span>');
+  const ph = phase && phase.name !== 'stopped'
+    ? ` <span class="badge">${phase.name}${phase.detail ? ': ' + phase.detail : ''}</span>` : '';
+  state.innerHTML = 'Статус: ' + (isRunning ? '<span class="pill blue">EXTERNAL RUNNING</span>' : '<span class="pill gray">STOPPED</span>') + ph;
   // блокировать таблицу реле и сенсоров при внешнем процессе
   document.getElementById('relaysTbl').classList.toggle('disabled', isRunning);
   document.getElementById('btnCmdStart').disabled = !isRunning;
 }
 
+function renderXY(xy){
+  const el = document.getElementById('xyState');
+  if(!xy){ el.textContent = 'XY: нет данных (брокер порта не запущен или M154 выключен)'; return; }
+  const flags = [];
+  if(xy.moving) flags.push('<span class="pill blue">MOVING</span>');
+  if(xy.x_min) flags.push('<span class="badge">X_MIN</span>');
+  if(xy.y_min) flags.push('<span class="badge">Y_MIN</span>');
+  if(xy.estop) flags.push('<span class="pill gray">ESTOP</span>');
+  if(!xy.homed) flags.push('<span class="pill gray">NOT HOMED</span>');
+  el.innerHTML = `XY: <b>${xy.x.toFixed(2)}</b> / <b>${xy.y.toFixed(2)}</b> мм ${flags.join(' ')}`;
+}
+
+const sensorHtml = v => v ? '<span class="ok">CLOSE</span>' : '<span class="off">OPEN</span>';
+const relayHtml  = v => v ? '<span class="ok">ON</span>' : '<span class="off">OFF</span>';
+
+// Текущий статус страницы: полный снимок + применённые дельты из /api/stream
+let state = null;
+
+function stamp(t){
+  document.getElementById('statusTime').textContent = 'Обновлено: ' + (t || new Date().toLocaleTimeString());
+}
+
+function setCell(id, html){
+  const el = document.getElementById(id);
+  if(el && el.innerHTML !== html) el.innerHTML = html;
+}
+
 function render(data){
-  document.getElementById('statusTime').textContent = 'Обновлено: ' + data.time;
-  renderExternal(!!data.external_running);
+  state = data;
+  stamp(data.time);
+  renderExternal(!!data.external_running, data.phase);
+  renderXY(data.xy);
 
   // sensors
   const sbody = document.querySelector('#sensorsTbl tbody');
@@ -320,7 +1329,7 @@ function render(data){
     const tr = document.createElement('tr');
     tr.innerHTML = `
       <td><span class="badge">${name}</span></td>
-      <td>${val ? '<span class="ok">CLOSE</span>' : '<span class="off">OPEN</span>'}</td>
+      <td id="s_${name}">${sensorHtml(val)}</td>
     `;
     sbody.appendChild(tr);
   }
@@ -334,7 +1343,7 @@ function render(data){
     const pulseId = 'pulse_'+name;
     tr.innerHTML = `
       <td><span class="badge">${name}</span></td>
-      <td>${val ? '<span class="ok">ON</span>' : '<span class="off">OFF</span>'}</td>
+      <td id="r_${name}">${relayHtml(val)}</td>
       <td>
         <div class="controls">
           <button class="btn" onclick="cmd('${name}','on')">ON</button>
@@ -354,6 +1363,32 @@ function render(data){
   });
 }
 
+// Дельта из потока: меняем только затронутые ячейки; новый набор реле/датчиков — полная перерисовка
+function applyDelta(d){
+  if(!state) return;
+  const replace = d._replace || [];
+  for(const k of Object.keys(d)){
+    if(k === '_replace') continue;
+    const v = d[k];
+    state[k] = (v && typeof v === 'object' && !Array.isArray(v) && !replace.includes(k))
+      ? Object.assign({}, state[k], v) : v;
+  }
+  stamp();
+  if(d.relay_names || d.sensor_names || replace.includes('relays') || replace.includes('sensors')){
+    render(state);
+    return;
+  }
+  for(const name of Object.keys(d.sensors || {})) setCell('s_'+name, sensorHtml(state.sensors[name]));
+  for(const name of Object.keys(d.relays || {})) setCell('r_'+name, relayHtml(state.relays[name]));
+  if('external_running' in d || 'phase' in d){
+    renderExternal(!!state.external_running, state.phase);
+    document.querySelectorAll('#relaysTbl button, #relaysTbl input').forEach(el=>{
+      el.disabled = !!state.external_running;
+    });
+  }
+  if('xy' in d) renderXY(state.xy);
+}
+
 async function refresh(){
   try{
     const data = await getStatus();
@@ -362,6 +1397,26 @@ async function refresh(){
     console.error(e);
   }
 }
+
+// Push-статус; без EventSource (или если сервер отказал) — опрос раз в секунду, как раньше
+let pollTimer = null;
+function startPolling(){
+  if(pollTimer) return;
+  refresh();
+  pollTimer = setInterval(refresh, 1000);
+}
+function startStream(){
+  if(!window.EventSource){ startPolling(); return; }
+  const es = new EventSource('/api/stream');
+  es.addEventListener('snapshot', e => render(JSON.parse(e.data)));
+  es.addEventListener('delta', e => applyDelta(JSON.parse(e.data)));
+  es.onopen = () => { if(pollTimer){ clearInterval(pollTimer); pollTimer = null; } };
+  es.onerror = () => {
+    // EventSource переподключается сам; пока его нет — опрашиваем
+    if(es.readyState === EventSource.CLOSED){ startPolling(); setTimeout(startStream, 5000); }
+    else startPolling();
+  };
+}
 async function cmd(name, action, ms){
   const data = await postRelay(name, action, ms?parseInt(ms,10):undefined);
   if(data) render(data);
@@ -390,8 +1445,7 @@ document.getElementById('btnCmdStart').addEventListener('click', async ()=>{
     if(data) render(data);
   }catch(e){ alert('Ошибка команды START: '+e.message); }
 });
-refresh();
-setInterval(refresh, 1000);
+startStream();
 </script>
 </body>
 </html>
@@ -402,11 +1456,59 @@ def index():
     return Response(INDEX_HTML, mimetype="text/html")
 
 # ---------------------- Запуск ----------------------
+class _PoolRequestHandler(WSGIRequestHandler):
+    # соединение на запрос: простаивающий keep-alive клиент не занимает обработчик из пула
+    protocol_version = "HTTP/1.0"
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI-сервер werkzeug с ограниченным пулом обработчиков: не больше workers запросов одновременно,
+    ещё столько же ждут в очереди, дальше accept ждёт (backpressure вместо бесконечного числа потоков).
+    """
+    multithread = True
+
+    def __init__(self, host: str, port: int, app, workers: int = WEB_WORKERS):
+        super().__init__(host, port, app, handler=_PoolRequestHandler)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        self._slots = threading.BoundedSemaphore(workers * 2)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self._pool.submit(self._work, request, client_address)
+
+    def _work(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+def serve(host: str = "0.0.0.0", port: int = 8000, workers: int = WEB_WORKERS):
+    if waitress is not None:
+        kw = {}
+        # старые waitress (< 2.0) копят send_bytes=18000 байт перед отправкой: события /api/stream и
+        # /api/logs?stream=1 застревали бы в буфере; в новых по умолчанию 1, а сам параметр устарел
+        if getattr(waitress.adjustments.Adjustments, "send_bytes", 1) != 1:
+            kw["send_bytes"] = 1
+        print(f"[web_ui] waitress on {host}:{port}, {workers} threads", flush=True)
+        waitress.serve(app, host=host, port=port, threads=workers, **kw)
+        return
+    print(f"[web_ui] werkzeug pool on {host}:{port}, {workers} workers", flush=True)
+    PooledWSGIServer(host, port, app, workers).serve_forever()
+
 def main():
     # При желании — отключить болтливость dev-сервера:
     # import logging
     # logging.getLogger('werkzeug').disabled = True
-    app.run(host="0.0.0.0", port=8000, debug=False, threaded=False, use_reloader=False)
+    global io
+    io = _make_io()
+    if pos_follower is not None:
+        pos_follower.start()
+    hub.start()
+    pulses.start()
+    serve()
 
 if __name__ == "__main__":
     try:
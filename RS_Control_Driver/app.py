@@ -1,10 +1,11 @@
 import os, json, time, threading, asyncio
 from typing import Dict, Any, Optional
 from fastapi import FastAPI, HTTPException, Request # type: ignore
-from fastapi.responses import FileResponse, StreamingResponse # type: ignore
+from fastapi.responses import FileResponse, StreamingResponse, Response # type: ignore
 from fastapi.staticfiles import StaticFiles # type: ignore
 from pydantic import BaseModel # pyright: ignore[reportMissingImports]
 from pymodbus.client import ModbusSerialClient # type: ignore
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST # type: ignore
 from collections import deque
 from datetime import datetime
 
@@ -58,6 +59,15 @@ TASK_OFF = {
     "speed": 0x0032,    # скорость RPM
 }
 
+# ========================= Метрики (/metrics) =========================
+MODBUS_SECONDS = Histogram("e350_modbus_seconds", "One Modbus RTU transaction (without waiting for the bus lock)",
+                           ["op", "result"],   # op: read|write, result: ok|error|exception
+                           buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5, 1.0, 1.5))
+MODBUS_LOCK_WAIT = Histogram("e350_modbus_lock_wait_seconds", "Waiting for the RS485 bus lock before a transaction",
+                             buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+HTTP_SECONDS = Histogram("e350_http_request_seconds", "HTTP request handling time", ["method", "route", "code"])
+EVENTS_TOTAL = Counter("e350_events_total", "Events from the monitor loop", ["kind"])
+
 # ========================= Вспомогательное =========================
 def s16_from_u16(v: int) -> int:
     v &= 0xFFFF
@@ -82,26 +92,36 @@ class E350:
         if not self.client or not self.client.connected:
             self.client.connect()
 
-    def r1(self, a: int) -> int:
+    def _txn(self, op: str, call):
+        """Одна транзакция под замком шины; время ожидания замка и самой транзакции — в метрики."""
+        t0 = time.perf_counter()
         with self.lock:
-            self._ensure()
-            rr = self.client.read_holding_registers(address=a, count=1, slave=self.cfg["unit"])
+            t1 = time.perf_counter()
+            MODBUS_LOCK_WAIT.observe(t1 - t0)
+            try:
+                self._ensure()
+                rr = call()
+            except Exception:
+                MODBUS_SECONDS.labels(op, "exception").observe(time.perf_counter() - t1)
+                raise
+            MODBUS_SECONDS.labels(op, "error" if rr.isError() else "ok").observe(time.perf_counter() - t1)
+        return rr
+
+    def r1(self, a: int) -> int:
+        rr = self._txn("read", lambda: self.client.read_holding_registers(address=a, count=1, slave=self.cfg["unit"]))
         if rr.isError():
             raise RuntimeError(str(rr))
         return rr.registers[0]
 
     def rN(self, a: int, n: int) -> list:
-        with self.lock:
-            self._ensure()
-            rr = self.client.read_holding_registers(address=a, count=n, slave=self.cfg["unit"])
+        rr = self._txn("read", lambda: self.client.read_holding_registers(address=a, count=n, slave=self.cfg["unit"]))
         if rr.isError():
             raise RuntimeError(str(rr))
         return rr.registers
 
     def w1(self, a: int, v: int):
-        with self.lock:
-            self._ensure()
-            wr = self.client.write_register(address=a, value=int(v) & 0xFFFF, slave=self.cfg["unit"])
+        wr = self._txn("write", lambda: self.client.write_register(address=a, value=int(v) & 0xFFFF,
+                                                                   slave=self.cfg["unit"]))
         if wr.isError():
             raise RuntimeError(str(wr))
 
@@ -293,6 +313,7 @@ _state = {
 }
 
 def _add_event(kind: str, msg: str, extra: dict | None = None):
+    EVENTS_TOTAL.labels(kind).inc()
     EVENTS.appendleft({
         "ts": datetime.now().strftime("%H:%M:%S.%f")[:-3],
         "kind": kind,
@@ -371,6 +392,20 @@ def api_fault_reset():
 def index():
     return FileResponse("static/index.html")
 
+# --------- Метрики ---------
+@app.middleware("http")
+async def _timing(request: Request, call_next):
+    t0 = time.perf_counter()
+    resp = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_SECONDS.labels(request.method, route.path if route is not None else "unmatched",
+                        str(resp.status_code)).observe(time.perf_counter() - t0)
+    return resp
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # --------- Модели запросов ---------
 class ModeBody(BaseModel):
     rs: bool
@@ -1,9 +1,41 @@
 #!/usr/bin/env python3
-import argparse, sys, time, threading
-from typing import Optional
+import argparse, sys, os, time, threading
+from collections import deque
+from typing import Callable, Optional
 import serial
 
+# Общее с Base_Logic_Web (клиент брокера, перцентиль): ser_broker.py рядом на стенде или в соседнем каталоге репозитория
+_BASE_LOGIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "Base_Logic_Web")
+if os.path.isdir(_BASE_LOGIC):
+    sys.path.append(_BASE_LOGIC)
+from ser_broker import BrokerSerial, broker_available, pct
+
 DEFAULT_BAUD = 115200
+# Скорости, на которые прошивка умеет переключаться командой BAUD (см. main.ino)
+FAST_BAUDS = (250000, 500000, 1000000)
+BAUD_CONFIRM_S = 2.0        # без PING на новой скорости прошивка сама вернётся на DEFAULT_BAUD
+LINK_ERR_MAX = 2            # столько ошибок линии подряд ('err NOISE'/таймаут) — откат на DEFAULT_BAUD
+# Приёмный буфер HardwareSerial у Mega2560 — 64 байта; пока прошивка выполняет движение,
+# следующие команды ждут в нём. В полёте держим не больше RX_BUFFER байт (character counting).
+RX_BUFFER = 63
+# Сокет брокера порта (Base_Logic_Web/ser_broker.py); --port /tmp/screw_xy.sock — работать через него
+BROKER_SOCK = os.getenv("SER_BROKER_SOCK", "/tmp/screw_xy.sock")
+
+def open_port(port: str, baud: int = DEFAULT_BAUD, timeout: float = 2.0):
+    """Открыть порт без автосброса; если port — сокет брокера, подключиться к нему."""
+    if broker_available(port):
+        return BrokerSerial(port, timeout=timeout, name="cnc_cli")
+    ser = serial.Serial(port, baud, timeout=timeout)
+    try:
+        ser.dtr = False
+        ser.rts = False
+    except Exception:
+        pass
+    return ser
+
+def is_final(line: str) -> bool:
+    """Строка, завершающая ответ на команду (PING отвечает только PONG, без ok)."""
+    return line == "ok" or line.startswith("ok ") or line.startswith("err") or line == "PONG"
 
 class GLink:
     def __init__(self, port:str, baud:int=DEFAULT_BAUD, timeout:float=2.0, eol:str="\n"):
@@ -14,17 +46,18 @@ class GLink:
         self.ser: Optional[serial.Serial] = None
         self._rx_thread = None
         self._rx_running = False
-        self._rx_buffer = []
-        self._rx_lock = threading.Lock()
+        # строки ответов на отправленные команды; send() ждёт их на условной переменной
+        self._rx = deque()
+        self._rx_cv = threading.Condition()
+        self._pending = 0                 # сколько отправленных команд ещё не получили ok/err
+        # «непрошенные» строки (статусы, баннеры) — в колбэки
+        self._callbacks: list[Callable[[str], None]] = []
+        self._link_errors = 0
+        self._negotiating = False         # во время смены скорости ошибки линии не считаем
 
     def open(self):
-        # Отключаем автосброс по DTR/RTS и открываем порт без лишних пауз
-        self.ser = serial.Serial(self.port, self.baud, timeout=self.timeout)
-        try:
-            self.ser.dtr = False
-            self.ser.rts = False
-        except Exception:
-            pass
+        # Отключаем автосброс по DTR/RTS и открываем порт без лишних пауз (или идём через брокер)
+        self.ser = open_port(self.port, self.baud, self.timeout)
         # НЕ спим 2 секунды
         self.ser.reset_input_buffer()
         self.ser.reset_output_buffer()
@@ -36,16 +69,48 @@ class GLink:
         finally:
             self.ser = None
 
+    def on_line(self, cb: Callable[[str], None]):
+        """Подписаться на строки, пришедшие не в ответ на команду (в т.ч. кадры позиции '@P ...')."""
+        self._callbacks.append(cb)
+
+    def _dispatch(self, line: str):
+        # кадры автоотчёта позиции ("@P x y bits", M154) приходят и посреди ответа на команду
+        is_frame = line.startswith("@")
+        with self._rx_cv:
+            if self._pending > 0 and not is_frame:
+                self._rx.append(line)
+                if is_final(line):
+                    self._pending -= 1
+                self._rx_cv.notify_all()
+                return
+        for cb in self._callbacks:
+            try:
+                cb(line)
+            except Exception as e:
+                print(f"[callback] {e}", file=sys.stderr)
+
     def _rx_worker(self):
         assert self.ser
+        buf = bytearray()
         while self._rx_running:
             try:
-                line = self.ser.readline().decode(errors="ignore").strip()
+                # блокируемся до первого байта, дальше забираем всё, что уже есть в буфере
+                chunk = self.ser.read(self.ser.in_waiting or 1)
             except Exception:
-                line = ""
-            if line:
-                with self._rx_lock:
-                    self._rx_buffer.append(line)
+                if self._rx_running:
+                    time.sleep(0.1)
+                continue
+            if not chunk:
+                continue
+            buf += chunk
+            while True:
+                i = buf.find(b"\n")
+                if i < 0:
+                    break
+                line = buf[:i].decode(errors="ignore").strip()
+                del buf[:i + 1]
+                if line:
+                    self._dispatch(line)
 
     def start_reader(self):
         self._rx_running = True
@@ -54,49 +119,234 @@ class GLink:
 
     def stop_reader(self):
         self._rx_running = False
+        cancel = getattr(self.ser, "cancel_read", None)
+        if cancel:
+            try:
+                cancel()
+            except Exception:
+                pass
         if self._rx_thread:
             self._rx_thread.join(timeout=1.0)
             self._rx_thread = None
 
-    def send(self, cmd:str, wait_ok:bool=True, print_io:bool=True, timeout_s:float=5.0):
-        """Отправить команду и подождать 'ok' (или 'err ...'). Возвращает список строк ответа."""
+    def write_cmd(self, cmd:str, expect_reply:bool=True):
+        """Отправить команду, не дожидаясь ответа (ответ потом забирает read_reply)."""
         if not self.ser: raise RuntimeError("Port is not open")
-        full = cmd.strip() + self.eol
-        if print_io:
-            print(f">> {cmd}")
-        self.ser.write(full.encode())
+        if expect_reply:
+            with self._rx_cv:
+                self._pending += 1
+        self.ser.write((cmd.strip() + self.eol).encode())
+
+    def read_reply(self, timeout_s:float=5.0, poll_s:float=0.0) -> list:
+        """
+        Забрать строки ответа на самую старую неотвеченную команду (до ok/err/PONG включительно).
+        poll_s > 0 — старый режим ожидания (опрос буфера со sleep), только для сравнения в bench.
+        """
         out = []
-        if not wait_ok:
-            return out
-        # ждём ok/err
-        t0 = time.time()
-        while True:
-            # собираем всё, что уже пришло
-            with self._rx_lock:
-                while self._rx_buffer:
-                    ln = self._rx_buffer.pop(0)
+        deadline = time.monotonic() + timeout_s
+        with self._rx_cv:
+            while True:
+                while self._rx:
+                    ln = self._rx.popleft()
                     out.append(ln)
-                    if print_io:
-                        print(ln)
-                    # наши окончания транзакции
-                    if ln == "ok" or ln.startswith("ok "):
+                    if is_final(ln):
                         return out
-                    if ln.startswith("err"):
-                        # всё равно вернём, но бросим исключение
-                        raise RuntimeError("\n".join(out))
-            if time.time() - t0 > timeout_s:
-                raise TimeoutError(f"Timeout waiting OK for '{cmd}'")
-            time.sleep(0.01)
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    # ответа не будет (или он потерян на линии) — больше его не ждём
+                    self._pending = max(0, self._pending - 1)
+                    raise TimeoutError("Timeout waiting OK")
+                if poll_s > 0:
+                    self._rx_cv.release()
+                    try:
+                        time.sleep(poll_s)
+                    finally:
+                        self._rx_cv.acquire()
+                else:
+                    self._rx_cv.wait(left)
+
+    def send(self, cmd:str, wait_ok:bool=True, print_io:bool=True, timeout_s:float=5.0, poll_s:float=0.0):
+        """Отправить команду и подождать 'ok' (или 'err ...'). Возвращает список строк ответа."""
+        if print_io:
+            print(f">> {cmd}")
+        self.write_cmd(cmd, expect_reply=wait_ok)
+        if not wait_ok:
+            return []
+        try:
+            out = self.read_reply(timeout_s, poll_s)
+        except TimeoutError:
+            self._link_error()
+            raise TimeoutError(f"Timeout waiting OK for '{cmd}'")
+        if print_io:
+            for ln in out:
+                print(ln)
+        if out[-1] == "err NOISE":
+            self._link_error()
+        else:
+            self._link_errors = 0
+        if out[-1].startswith("err"):
+            # всё равно вернём, но бросим исключение
+            raise RuntimeError("\n".join(out))
+        return out
+
+    # ---- скорость линии
+    def _link_error(self):
+        if self._negotiating:
+            return
+        self._link_errors += 1
+        if self._link_errors >= LINK_ERR_MAX and self.baudrate() != self.baud:
+            print(f"[link] {self._link_errors} errors at {self.baudrate()} baud, falling back to {self.baud}",
+                  file=sys.stderr)
+            self._link_errors = 0
+            self.fallback_baud()
+
+    def baudrate(self) -> int:
+        return getattr(self.ser, "baudrate", self.baud)
+
+    def _flush_rx(self):
+        with self._rx_cv:
+            self._rx.clear()
+            self._pending = 0
+
+    def _ping(self, tries: int, timeout_s: float) -> bool:
+        for _ in range(tries):
+            try:
+                self.send("PING", print_io=False, timeout_s=timeout_s)
+                return True
+            except (TimeoutError, RuntimeError):
+                pass
+        return False
+
+    def set_baud(self, target: int) -> bool:
+        """
+        Перейти на target: BAUD target -> 'ok BAUD target' -> переключить порт -> PING/PONG.
+        Без подтверждения прошивка сама вернётся на исходную скорость, мы — тоже.
+        Через брокер скорость не меняем (ею управляет брокер): возвращает False.
+        """
+        if not self.ser or getattr(self.ser, "is_broker", False):
+            return False
+        if self.ser.baudrate == target:
+            return True
+        self._negotiating = True
+        try:
+            try:
+                self.send(f"BAUD {target}", print_io=False, timeout_s=1.0)
+            except (TimeoutError, RuntimeError):
+                return False
+            time.sleep(0.01)              # дать прошивке дослать ok и переинициализировать UART
+            self.ser.baudrate = target
+            self._flush_rx()
+            if self._ping(3, 0.3):
+                self._link_errors = 0
+                return True
+            self.ser.baudrate = self.baud
+            time.sleep(BAUD_CONFIRM_S + 0.2)
+            self._flush_rx()
+            self._ping(1, 0.5)
+            return False
+        finally:
+            self._negotiating = False
+
+    def fallback_baud(self):
+        """Вернуть линию на исходную скорость (self.baud), даже если прошивка нас не слышит."""
+        if not self.ser or getattr(self.ser, "is_broker", False) or self.ser.baudrate == self.baud:
+            return
+        if self.set_baud(self.baud):
+            return
+        # прошивка уже откатилась сама (или откатится по таймауту подтверждения)
+        self._negotiating = True
+        try:
+            self.ser.baudrate = self.baud
+            self._flush_rx()
+            self._ping(5, 0.5)
+        finally:
+            self._negotiating = False
+
+def bench_roundtrip(gl: GLink, cmd: str, n: int, poll_s: float = 0.0) -> list:
+    """n раз cmd -> ok; возвращает отсортированные задержки в мс."""
+    lat = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        gl.send(cmd, print_io=False, poll_s=poll_s)
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    lat.sort()
+    return lat
+
+def load_program(path: str) -> list:
+    """Файл команд: по строке на команду; ';' — комментарий до конца строки, пустые строки пропускаем."""
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for raw in f:
+            s = raw.split(";", 1)[0].strip()
+            if s:
+                out.append(s)
+    return out
+
+def stream_program(gl: GLink, lines: list, window: int = 4, rx_buffer: int = RX_BUFFER,
+                   timeout_s: float = 120.0, stop_on_err: bool = True, verbose: bool = False) -> dict:
+    """
+    Отправить программу по одному соединению, держа в полёте до window команд,
+    но не больше rx_buffer байт (чтобы не переполнить приёмный буфер прошивки).
+    Возвращает статистику: время, задержки по строкам (от отправки до ok/err), ошибки.
+    """
+    inflight = deque()                # (байт, t_отправки, строка)
+    used = 0
+    lat = []
+    errors = 0
+    sent = 0
+    aborted = False
+    t0 = time.perf_counter()
+    while (sent < len(lines) and not aborted) or inflight:
+        while not aborted and sent < len(lines) and len(inflight) < window:
+            ln = lines[sent]
+            n = len(ln) + len(gl.eol)
+            # одиночную длинную строку всё равно пускаем, если буфер пуст
+            if inflight and used + n > rx_buffer:
+                break
+            gl.write_cmd(ln)
+            inflight.append((n, time.perf_counter(), ln))
+            used += n
+            sent += 1
+        out = gl.read_reply(timeout_s)
+        n, t_sent, ln = inflight.popleft()
+        used -= n
+        lat.append((time.perf_counter() - t_sent) * 1000.0)
+        if verbose:
+            print(f">> {ln}")
+            for r in out:
+                print(r)
+        if out[-1].startswith("err"):
+            errors += 1
+            print(f"ERROR at line {len(lat)} '{ln}': {out[-1]}", file=sys.stderr)
+            if stop_on_err:
+                aborted = True        # новые не шлём, ответы на уже отправленные дочитываем
+    total = time.perf_counter() - t0
+    lat.sort()
+    return {"lines": len(lat), "total_s": total, "errors": errors, "lat_ms": lat, "aborted": aborted}
+
+def print_lat(title: str, lat: list):
+    avg = sum(lat) / len(lat) if lat else 0.0
+    print(f"{title:<24} n={len(lat):<5} min={lat[0] if lat else 0:7.2f}  avg={avg:7.2f}  "
+          f"p50={pct(lat, 50):7.2f}  p95={pct(lat, 95):7.2f}  max={lat[-1] if lat else 0:7.2f}  ms")
 
 def build_parser():
     p = argparse.ArgumentParser(description="RPi ↔ Arduino (RAMPS) CLI for your XY table")
-    p.add_argument("--port", "-p", default="/dev/ttyACM0", help="Serial port (e.g. /dev/ttyACM0)")
-    p.add_argument("--baud", "-b", type=int, default=DEFAULT_BAUD, help="Baudrate")
+    p.add_argument("--port", "-p", default="/dev/ttyACM0",
+                   help=f"Serial port (e.g. /dev/ttyACM0) or broker socket ({BROKER_SOCK})")
+    p.add_argument("--baud", "-b", type=int, default=DEFAULT_BAUD, help="Baudrate the firmware starts at")
+    p.add_argument("--link-baud", type=int, default=0, choices=(0,) + FAST_BAUDS,
+                   help="Negotiate this baudrate after connecting (0 = keep --baud)")
     sub = p.add_subparsers(dest="cmd", required=True)
 
     sub.add_parser("repl", help="Interactive mode: keep port open and send lines")
 
     sub.add_parser("ping", help="PING → PONG")
+
+    bench = sub.add_parser("bench", help="Command round-trip latency: condition wait vs legacy 10 ms polling")
+    bench.add_argument("--line", default="M114", help="Command to repeat (default M114)")
+    bench.add_argument("-n", type=int, default=200, help="Round trips per mode")
+    bench.add_argument("--bauds", default="",
+                       help="Comma-separated baudrates to compare instead (e.g. 115200,250000,500000,1000000)")
     sub.add_parser("status", help="M114/M119")
 
     home = sub.add_parser("home", help="Home axes")
@@ -118,6 +368,19 @@ def build_parser():
 
     sub.add_parser("zero", help="Go to (0,0)")
 
+    watch = sub.add_parser("watch", help="Enable position auto-report (M154) and print '@P x y bits' frames")
+    watch.add_argument("--hz", type=int, default=10, help="Report rate while moving, 1..50 (default 10)")
+    watch.add_argument("--seconds", type=float, default=0.0, help="Stop after N seconds (default: until Ctrl+C)")
+
+    stream = sub.add_parser("stream", help="Stream a G-code/command file over one connection")
+    stream.add_argument("file", help="One firmware command per line; ';' starts a comment")
+    stream.add_argument("--window", "-w", type=int, default=4, help="Max commands in flight (default 4)")
+    stream.add_argument("--rx-buffer", type=int, default=RX_BUFFER,
+                        help=f"Firmware serial RX buffer budget in bytes (default {RX_BUFFER})")
+    stream.add_argument("--timeout", type=float, default=120.0, help="Per-line reply timeout, s")
+    stream.add_argument("--continue-on-error", action="store_true", help="Do not stop on 'err' replies")
+    stream.add_argument("--verbose", "-v", action="store_true", help="Print every command and reply")
+
     ssteps = sub.add_parser("set-steps", help="SET STEPS X.. Y..")
     ssteps.add_argument("--x", type=float, required=True)
     ssteps.add_argument("--y", type=float, required=True)
@@ -143,10 +406,26 @@ def main():
         except Exception:
             # не все версии печатают PONG — просто игнорируем
             pass
+        if args.link_baud and not gl.set_baud(args.link_baud):
+            print(f"[link] {args.link_baud} baud not confirmed, staying at {gl.baudrate()}", file=sys.stderr)
 
         if args.cmd == "ping":
             gl.send("PING")
 
+        elif args.cmd == "bench" and args.bauds:
+            for b in [int(x) for x in args.bauds.split(",") if x.strip()]:
+                if not gl.set_baud(b):
+                    print(f"{b} baud: not confirmed, skipped")
+                    continue
+                bench_roundtrip(gl, args.line, 5)   # прогрев
+                print_lat(f"{b} baud", bench_roundtrip(gl, args.line, args.n))
+            gl.fallback_baud()
+
+        elif args.cmd == "bench":
+            bench_roundtrip(gl, args.line, 5)   # прогрев
+            print_lat("legacy poll 10 ms", bench_roundtrip(gl, args.line, args.n, poll_s=0.01))
+            print_lat("condition wait", bench_roundtrip(gl, args.line, args.n))
+
         elif args.cmd == "status":
             gl.send("M114")
             gl.send("M119")
@@ -176,6 +455,29 @@ def main():
         elif args.cmd == "zero":
             gl.send("ZERO")
 
+        elif args.cmd == "watch":
+            gl.on_line(lambda ln: print(f"{time.strftime('%H:%M:%S')} {ln}"))
+            gl.send(f"M154 S{args.hz}")
+            t_end = time.monotonic() + args.seconds if args.seconds > 0 else None
+            try:
+                while t_end is None or time.monotonic() < t_end:
+                    time.sleep(0.1)
+            except KeyboardInterrupt:
+                pass
+            gl.send("M154 S0")
+
+        elif args.cmd == "stream":
+            prog = load_program(args.file)
+            res = stream_program(gl, prog, window=max(1, args.window), rx_buffer=args.rx_buffer,
+                                 timeout_s=args.timeout, stop_on_err=not args.continue_on_error,
+                                 verbose=args.verbose)
+            total = res["total_s"]
+            print(f"{res['lines']}/{len(prog)} lines in {total:.3f} s  "
+                  f"({res['lines'] / total if total > 0 else 0:.1f} lines/s), errors: {res['errors']}")
+            print_lat("per-line latency", res["lat_ms"])
+            if res["errors"]:
+                sys.exit(1)
+
         elif args.cmd == "set-steps":
             gl.send(f"SET STEPS X{args.x} Y{args.y}")
 
@@ -205,6 +507,10 @@ def main():
         print(f"\nERROR: {e}\n", file=sys.stderr)
         sys.exit(1)
     finally:
+        try:
+            gl.fallback_baud()        # после --link-baud: следующий клиент откроет порт на исходной скорости
+        except Exception:
+            pass
         try:
             gl.stop_reader()
             gl.close()
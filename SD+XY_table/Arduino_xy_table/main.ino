@@ -30,6 +30,8 @@ float SCAN_RANGE_X_MM = 65.0f;
 float SCAN_RANGE_Y_MM = 165.0f;
 float BACKOFF_MM      = 3.0f;
 float SLOW_MM_S       = 8.0f;
+// Допуск: концевик, сработавший дальше этого расстояния от нуля, = потеря позиции
+float HOME_TOL_MM     = 1.0f;
 
 // Direction inversion (перевернуть, если ось едет «не туда»)
 bool INVERT_X_DIR = true;
@@ -39,13 +41,32 @@ bool INVERT_Y_DIR = true;
 bool X_ENDSTOP_ACTIVE_LOW = false;  // NC по умолчанию
 bool Y_ENDSTOP_ACTIVE_LOW = false;  // NC по умолчанию
 
+// Serial: старт всегда на 115200; BAUD <rate> переключает скорость.
+// Новая скорость должна быть подтверждена PING за BAUD_CONFIRM_MS, иначе — откат.
+// На повышенной скорости NOISE_MAX мусорных байт подряд (без валидной команды) — тоже откат.
+const unsigned long BAUD_DEFAULT    = 115200UL;
+const unsigned long BAUD_CONFIRM_MS = 2000UL;
+const uint8_t       NOISE_MAX       = 32;
+
+// Автоотчёт позиции (M154 S<Гц>): во время движения кадры "@P <x> <y> <bits>" не чаще AUTO_REPORT_HZ_MAX
+const uint8_t       AUTO_REPORT_HZ_MAX = 50;
+
 /* ===================================== */
 
 AccelStepper stepX(AccelStepper::DRIVER, X_STEP, X_DIR);
 AccelStepper stepY(AccelStepper::DRIVER, Y_STEP, Y_DIR);
 
 String ibuf;
+bool ibufNoise=false;
 bool estop=false;
+unsigned long curBaud = BAUD_DEFAULT;
+unsigned long baudConfirmDeadline = 0;   // 0 — подтверждения не ждём
+uint8_t noiseBytes = 0;
+// Позиция валидна только после успешного хоуминга; сбрасывается при ресете,
+// ESTOP (M112), смене STEPS и «неожиданном» срабатывании концевика
+bool homedX=false, homedY=false;
+unsigned long autoReportMs = 0;          // 0 — автоотчёт выключен
+unsigned long lastAutoReport = 0;
 
 inline bool endActive(uint8_t pin, bool activeLow){
   int v = digitalRead(pin);
@@ -76,7 +97,7 @@ void setKinematicsMax(){
 }
 
 void setup(){
-  Serial.begin(115200);
+  Serial.begin(BAUD_DEFAULT);
   setupPins();
   setKinematicsMax();
   Serial.println("ok READY");
@@ -95,86 +116,200 @@ void movePlan(float x_mm, float y_mm, float f_mm_min){
   stepX.moveTo((long)(x_mm * STEPS_PER_MM_X));
   stepY.moveTo((long)(y_mm * STEPS_PER_MM_Y));
 }
+// концевик сработал там, где по счётчику шагов его быть не может
+inline bool endSurprise(AccelStepper& ax, float spmm){
+  return ax.currentPosition() > (long)(HOME_TOL_MM * spmm);
+}
+void checkEndstopSanity(){
+  if(endActive(X_MIN_PIN, X_ENDSTOP_ACTIVE_LOW) && endSurprise(stepX, STEPS_PER_MM_X)) homedX=false;
+  if(endActive(Y_MIN_PIN, Y_ENDSTOP_ACTIVE_LOW) && endSurprise(stepY, STEPS_PER_MM_Y)) homedY=false;
+}
+// "@P 12.34 56.78 5": позиция в мм и биты: 1=X_MIN, 2=Y_MIN, 4=едем, 8=ESTOP, 16=HOMED
+void posFrame(bool moving){
+  uint8_t bits = 0;
+  if(endActive(X_MIN_PIN, X_ENDSTOP_ACTIVE_LOW)) bits |= 1;
+  if(endActive(Y_MIN_PIN, Y_ENDSTOP_ACTIVE_LOW)) bits |= 2;
+  if(moving)          bits |= 4;
+  if(estop)           bits |= 8;
+  if(homedX && homedY) bits |= 16;
+  Serial.print("@P ");
+  Serial.print(stepX.currentPosition()/STEPS_PER_MM_X, 2); Serial.print(' ');
+  Serial.print(stepY.currentPosition()/STEPS_PER_MM_Y, 2); Serial.print(' ');
+  Serial.println(bits);
+}
+// в движении — по таймеру; по окончании движения — всегда один финальный кадр
+void autoReport(bool moving){
+  if(!autoReportMs) return;
+  unsigned long now = millis();
+  if(moving && now - lastAutoReport < autoReportMs) return;
+  lastAutoReport = now;
+  posFrame(moving);
+}
+
 bool runStep(bool checkEndstops=true){
   if(checkEndstops){
-    if(stepX.speed()<0 && endActive(X_MIN_PIN, X_ENDSTOP_ACTIVE_LOW)) stepX.stop();
-    if(stepY.speed()<0 && endActive(Y_MIN_PIN, Y_ENDSTOP_ACTIVE_LOW)) stepY.stop();
+    if(stepX.speed()<0 && endActive(X_MIN_PIN, X_ENDSTOP_ACTIVE_LOW)){
+      if(endSurprise(stepX, STEPS_PER_MM_X)) homedX=false;
+      stepX.stop();
+    }
+    if(stepY.speed()<0 && endActive(Y_MIN_PIN, Y_ENDSTOP_ACTIVE_LOW)){
+      if(endSurprise(stepY, STEPS_PER_MM_Y)) homedY=false;
+      stepY.stop();
+    }
   }
   bool rx = (stepX.distanceToGo()!=0);
   bool ry = (stepY.distanceToGo()!=0);
   stepX.run(); stepY.run();
+  autoReport(rx || ry);
   return rx || ry;
 }
 
-/* ===== homing to MIN (пер-ось) ===== */
-bool homeAxisToMin(AccelStepper& ax, uint8_t minPin, float spmm, float scanRangeMM, bool minActiveLow){
-  // если стоим на концевике — отъедем
-  ax.setMaxSpeed(SLOW_MM_S * spmm);
-  if(endActive(minPin, minActiveLow)){
-    ax.move((long)(+BACKOFF_MM * spmm));
-    while(ax.distanceToGo()!=0 && endActive(minPin, minActiveLow)) ax.run();
-    delay(5);
+/* ===== homing to MIN (обе оси в одном цикле) ===== */
+// Автомат хоуминга одной оси: отъезд с концевика -> быстрый поиск -> отъезд -> медленный заход.
+// Методы внутри struct — чтобы препроцессор Arduino не генерировал прототипы раньше типа.
+enum HomePhase : uint8_t { HP_LEAVE, HP_SEEK, HP_BACKOFF, HP_SLOW, HP_DONE, HP_FAIL };
+
+struct HomeAxis {
+  AccelStepper& ax; uint8_t pin; float spmm; float scanMM; bool activeLow;
+  HomePhase ph; unsigned long t0, ms;
+
+  HomeAxis(AccelStepper& a, uint8_t p, float s, float scan, bool al)
+    : ax(a), pin(p), spmm(s), scanMM(scan), activeLow(al), ph(HP_DONE), t0(0), ms(0) {}
+
+  bool hit(){ return endActive(pin, activeLow); }
+
+  void seek(){
+    // быстрый поиск в "минус"
+    ax.setMaxSpeed(MAX_FEED_MM_S * spmm);
+    ax.moveTo(ax.currentPosition() - (long)(scanMM * spmm));
+    ph = HP_SEEK;
+  }
+
+  void begin(){
+    t0 = millis(); ms = 0;
+    // если стоим на концевике — отъедем
+    ax.setMaxSpeed(SLOW_MM_S * spmm);
+    if(hit()){ ax.move((long)(+BACKOFF_MM * spmm)); ph = HP_LEAVE; }
+    else seek();
   }
-  // быстрый поиск в "минус"
-  ax.setMaxSpeed(MAX_FEED_MM_S * spmm);
-  long scan = (long)(scanRangeMM * spmm);
-  long start = ax.currentPosition();
-  ax.moveTo(start - scan);
-  bool found=false;
-  while(ax.distanceToGo()!=0){
-    if(endActive(minPin, minActiveLow)){ ax.stop(); found=true; break; }
-    ax.run();
+
+  void finish(HomePhase p){ ph = p; ms = millis() - t0; }
+
+  // один шаг автомата; false — ось закончила (HP_DONE / HP_FAIL)
+  bool tick(){
+    switch(ph){
+      case HP_LEAVE:
+        if(ax.distanceToGo()!=0 && hit()){ ax.run(); return true; }
+        seek(); return true;
+      case HP_SEEK:
+        if(hit()){
+          ax.stop();
+          ax.move((long)(+BACKOFF_MM * spmm));  // отъезд
+          ph = HP_BACKOFF; return true;
+        }
+        if(ax.distanceToGo()==0){ finish(HP_FAIL); return false; }
+        ax.run(); return true;
+      case HP_BACKOFF:
+        if(ax.distanceToGo()!=0){ ax.run(); return true; }
+        // медленный точный заход
+        ax.setMaxSpeed(SLOW_MM_S * spmm);
+        ax.moveTo(ax.currentPosition() - (long)(BACKOFF_MM * spmm * 2));
+        ph = HP_SLOW; return true;
+      case HP_SLOW:
+        if(ax.distanceToGo()!=0 && !hit()){ ax.run(); return true; }
+        ax.setCurrentPosition(0);
+        finish(HP_DONE); return false;
+      default:
+        return false;
+    }
   }
-  if(!found) return false;
-
-  // отъезд + медленный точный заход
-  ax.move((long)(+BACKOFF_MM * spmm));
-  while(ax.distanceToGo()!=0) ax.run();
-  ax.setMaxSpeed(SLOW_MM_S * spmm);
-  ax.moveTo(ax.currentPosition() - (long)(BACKOFF_MM * spmm * 2));
-  while(ax.distanceToGo()!=0){
-    if(endActive(minPin, minActiveLow)){ ax.stop(); break; }
-    ax.run();
+};
+
+// Хоуминг выбранных осей одновременно: шаги обеих осей чередуются в одном цикле,
+// каждая ось завершается по своему концевику. Печатает "HOME X_MS:.. Y_MS:.." перед ok/err.
+bool homeAxes(bool doX, bool doY){
+  HomeAxis hx(stepX, X_MIN_PIN, STEPS_PER_MM_X, SCAN_RANGE_X_MM, X_ENDSTOP_ACTIVE_LOW);
+  HomeAxis hy(stepY, Y_MIN_PIN, STEPS_PER_MM_Y, SCAN_RANGE_Y_MM, Y_ENDSTOP_ACTIVE_LOW);
+  if(doX) hx.begin();
+  if(doY) hy.begin();
+  bool bx=doX, by=doY;
+  while(bx || by){
+    if(bx) bx = hx.tick();
+    if(by) by = hy.tick();
+    autoReport(true);
   }
-  ax.setCurrentPosition(0);
-  return true;
+  if(doX) homedX = (hx.ph==HP_DONE);
+  if(doY) homedY = (hy.ph==HP_DONE);
+  autoReport(false);
+
+  Serial.print("HOME");
+  if(doX){ Serial.print(" X_MS:"); Serial.print(hx.ms); }
+  if(doY){ Serial.print(" Y_MS:"); Serial.print(hy.ms); }
+  Serial.println();
+  return (!doX || homedX) && (!doY || homedY);
 }
 
-bool homeX(){ return homeAxisToMin(stepX, X_MIN_PIN, STEPS_PER_MM_X, SCAN_RANGE_X_MM, X_ENDSTOP_ACTIVE_LOW); }
-bool homeY(){ return homeAxisToMin(stepY, Y_MIN_PIN, STEPS_PER_MM_Y, SCAN_RANGE_Y_MM, Y_ENDSTOP_ACTIVE_LOW); }
-
-bool homeAll(){
-  bool fx = homeX();
-  bool fy = homeY();
-  return fx && fy;
-}
+bool homeX(){ return homeAxes(true, false); }
+bool homeY(){ return homeAxes(false, true); }
+bool homeAll(){ return homeAxes(true, true); }
 
 /* ===== utils ===== */
 void goZero(){ movePlan(0.0f, 0.0f, 1200.0f); while(runStep()){} }
 
 /* ===== reports ===== */
 void reportStatus(){
+  checkEndstopSanity();
   float x = stepX.currentPosition()/STEPS_PER_MM_X;
   float y = stepY.currentPosition()/STEPS_PER_MM_Y;
   Serial.print("STATUS X:"); Serial.print(x,3);
   Serial.print(" Y:");      Serial.print(y,3);
   Serial.print(" X_MIN:");  Serial.print(endActive(X_MIN_PIN,X_ENDSTOP_ACTIVE_LOW)?"TRIG":"open");
   Serial.print(" Y_MIN:");  Serial.print(endActive(Y_MIN_PIN,Y_ENDSTOP_ACTIVE_LOW)?"TRIG":"open");
-  Serial.print(" ESTOP:");  Serial.println(estop?"1":"0");
+  Serial.print(" ESTOP:");  Serial.print(estop?"1":"0");
+  Serial.print(" HOMED:");  Serial.println((homedX && homedY)?"1":"0");
+}
+// параметры кинематики — для расчёта времени перемещений на стороне хоста
+void reportConfig(){
+  Serial.print("CONFIG STEPS_X:"); Serial.print(STEPS_PER_MM_X,3);
+  Serial.print(" STEPS_Y:");      Serial.print(STEPS_PER_MM_Y,3);
+  Serial.print(" FEED:");         Serial.print(MAX_FEED_MM_S,3);
+  Serial.print(" ACC:");          Serial.print(MAX_ACC_MM_S2,3);
+  Serial.print(" X_MAX:");        Serial.print(X_MAX_MM,3);
+  Serial.print(" Y_MAX:");        Serial.println(Y_MAX_MM,3);
+}
+
+/* ===== serial speed ===== */
+void switchBaud(unsigned long b){
+  Serial.flush();            // дождаться отправки ответа на старой скорости
+  Serial.end();
+  Serial.begin(b);
+  curBaud = b;
+  ibuf = ""; ibufNoise = false; noiseBytes = 0;
+  baudConfirmDeadline = 0;
+  if(b!=BAUD_DEFAULT){
+    baudConfirmDeadline = millis() + BAUD_CONFIRM_MS;
+    if(!baudConfirmDeadline) baudConfirmDeadline = 1;  // 0 зарезервирован под «не ждём»
+  }
+}
+bool baudAllowed(unsigned long b){
+  return b==115200UL || b==250000UL || b==500000UL || b==1000000UL;
 }
 
 /* ===== protocol ===== */
 /*
 Команды:
   PING
-  M114 / M119
+  M114 / M119 -> M114: STATUS X.. Y.. X_MIN.. Y_MIN.. ESTOP.. HOMED:0/1
+  M503        -> CONFIG STEPS_X.. STEPS_Y.. FEED(мм/с).. ACC(мм/с^2).. X_MAX.. Y_MAX.. + ok
+  M154 S10    -> автоотчёт позиции 10 Гц во время движения ("@P x y bits", S0 — выкл); сразу один кадр + ok
   M112 / M999
-  G28         -> хоум X и Y
+  G28         -> хоум X и Y (одновременно), ответ: HOME X_MS:.. Y_MS:.. + ok
   G28 X       -> хоум только X
   G28 Y       -> хоум только Y
   CAL         -> хоум обеих + ZERO
   ZERO        -> в (0,0)
   G X.. Y.. F..
+  BAUD 250000 -> ok BAUD 250000, затем смена скорости; подтвердить PING на новой (иначе откат на 115200)
   SET LIM X300 Y300
   SET STEPS X100 Y100
   DX +10 F600 -> сдвиг X на +10 мм (диагностика, без софт-лимитов)
@@ -183,14 +318,30 @@ void reportStatus(){
 void handleLine(String s){
   s.trim(); if(!s.length()) return;
 
-  if(s=="PING"){ Serial.println("PONG"); return; }
+  if(s=="PING"){ baudConfirmDeadline=0; Serial.println("PONG"); return; }
+  if(s.startsWith("BAUD ")){
+    unsigned long b = (unsigned long)s.substring(5).toInt();
+    if(!baudAllowed(b)){ Serial.println("err BAD_BAUD"); return; }
+    Serial.print("ok BAUD "); Serial.println(b);
+    switchBaud(b);
+    return;
+  }
   if(s=="M114"){ reportStatus(); Serial.println("ok"); return; }
+  if(s=="M503"){ reportConfig(); Serial.println("ok"); return; }
+  if(s.startsWith("M154")){
+    int i=s.indexOf('S');
+    long hz = (i<0) ? 0 : s.substring(i+1).toInt();
+    if(hz<0 || hz>AUTO_REPORT_HZ_MAX){ Serial.println("err BAD_ARGS"); return; }
+    autoReportMs = hz ? 1000UL/hz : 0;
+    if(autoReportMs) posFrame(false);
+    Serial.println("ok"); return;
+  }
   if(s=="M119"){
     Serial.print("X_MIN:"); Serial.print(endActive(X_MIN_PIN,X_ENDSTOP_ACTIVE_LOW)?"TRIGGERED":"open"); Serial.print(" ");
     Serial.print("Y_MIN:"); Serial.println(endActive(Y_MIN_PIN,Y_ENDSTOP_ACTIVE_LOW)?"TRIGGERED":"open");
     Serial.println("ok"); return;
   }
-  if(s=="M112"){ estop=true; stepX.stop(); stepY.stop(); motorsEnable(false); Serial.println("ok ESTOP"); return; }
+  if(s=="M112"){ estop=true; homedX=homedY=false; stepX.stop(); stepY.stop(); motorsEnable(false); Serial.println("ok ESTOP"); return; }
   if(s=="M999"){ estop=false; motorsEnable(true); Serial.println("ok CLEAR"); return; }
 
   if(s=="G28"){
@@ -238,6 +389,7 @@ void handleLine(String s){
       i=j+1;
     }
     STEPS_PER_MM_X=xs; STEPS_PER_MM_Y=ys; setKinematicsMax();
+    homedX=homedY=false;  // счётчики шагов больше не соответствуют мм
     Serial.println("ok"); return;
   }
 
@@ -284,7 +436,18 @@ void handleLine(String s){
 void loop(){
   while(Serial.available()){
     char c=Serial.read();
-    if(c=='\n'||c=='\r'){ handleLine(ibuf); ibuf=""; }
-    else { ibuf+=c; if(ibuf.length()>160) ibuf=""; }
+    if(c=='\n'||c=='\r'){
+      if(ibufNoise){ Serial.println("err NOISE"); }
+      else if(ibuf.length()){ noiseBytes=0; handleLine(ibuf); }
+      ibuf=""; ibufNoise=false;
+    }
+    else if(c<0x20 || c>0x7E){
+      // мусор на линии: как правило, рассогласование скорости
+      ibufNoise=true;
+      if(curBaud!=BAUD_DEFAULT && ++noiseBytes>=NOISE_MAX){ switchBaud(BAUD_DEFAULT); return; }
+    }
+    else { ibuf+=c; if(ibuf.length()>160){ ibuf=""; ibufNoise=true; } }
   }
+  // новая скорость не подтверждена PING — возвращаемся на 115200
+  if(baudConfirmDeadline && (long)(millis()-baudConfirmDeadline) >= 0) switchBaud(BAUD_DEFAULT);
 }
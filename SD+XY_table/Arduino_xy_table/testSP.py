@@ -1,4 +1,5 @@
 import sys, time, serial
+from cnc_cli import BrokerSerial, broker_available   # ser_broker.py из Base_Logic_Web
 
 port = sys.argv[1] if len(sys.argv) > 1 else "/dev/ttyACM0"
 cmd  = sys.argv[2] if len(sys.argv) > 2 else "M119"
@@ -49,10 +50,13 @@ def main():
     #   stty -F /dev/ttyACM0 -hupcl
     # чтобы ядро не дёргало DTR при close/open.
 
-    ser = open_noreset(port, baud)
-
-    # Если был ресет — ждём баннер; если нет — быстро пройдём цикл
-    drain_until_ready(ser, wait_s=2.0)
+    if broker_available(port):
+        # порт держит брокер: плата уже готова, ресета и баннера не будет
+        ser = BrokerSerial(port, timeout=0.2, name="testSP")
+    else:
+        ser = open_noreset(port, baud)
+        # Если был ресет — ждём баннер; если нет — быстро пройдём цикл
+        drain_until_ready(ser, wait_s=2.0)
 
     # Отправляем команду
     line = (cmd.strip() + "\n").encode()